@@ -1,10 +1,72 @@
+import importlib
 import logging
-from . import utils
-from .tor import *
-from .integrations import ClientSession, ClientResponse, ClientRequest, RequestsSession
 
 logger = logging.getLogger(__name__)
 
+# the public names and the module defining them. modules are imported on first use,
+# so ```import aionion``` stays cheap and e.g. requests is only loaded by RequestsSession
+_LAZY = {
+    "SocksProxy": "tor",
+    "SocksError": "tor",
+    "Tor": "tor",
+    "TorRC": "tor",
+    "ClientSession": "integrations",
+    "ClientResponse": "integrations",
+    "ClientRequest": "integrations",
+    "ProxyConnectTor": "integrations",
+    "RequestsSession": "requestsession",
+    "TorFleet": "fleet",
+}
+_SUBMODULES = (
+    "autoscale",
+    "breaker",
+    "cache",
+    "control",
+    "discovery",
+    "download",
+    "exits",
+    "fleet",
+    "health",
+    "hedging",
+    "installer",
+    "integrations",
+    "ipcache",
+    "isolation",
+    "metrics",
+    "requestsession",
+    "resolver",
+    "scheduler",
+    "tor",
+    "tracing",
+    "utils",
+)
+# ```from aionion import *``` loads every module, the same names as before they were lazy
+__all__ = [
+    *_LAZY,
+    *_SUBMODULES,
+    "get_running_instance",
+    "set_loglevel",
+    "set_default_limit",
+    "set_default_port",
+    "create_in_background_sync",
+    "create_async",
+    "create_fleet_async",
+]
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        value = getattr(importlib.import_module("." + _LAZY[name], __name__), name)
+        globals()[name] = value
+        return value
+    if name in _SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY) | set(_SUBMODULES))
+
 
 def get_running_instance():
     from . import tor
@@ -22,10 +84,14 @@ def set_loglevel(level=30):
 
 
 def set_default_limit(default=2**16):
+    from . import tor
+
     tor.DEFAULT_LIMIT = default
 
 
 def set_default_port(default=10080):
+    from . import tor
+
     tor.DEFAULT_PORT = default
 
 
@@ -66,3 +132,22 @@ async def create_async(nproxies=10) -> "Tor":
 
     t = tor.Tor(nproxies)
     return await t.start()
+
+
+async def create_fleet_async(nproxies=10, ninstances=None) -> "TorFleet":
+    """
+    async function
+    returns a running ```fleet.TorFleet```, which spreads the proxies over
+    multiple tor processes to use more than one cpu core.
+    make sure you assign this to a variable!
+
+    :param nproxies: (int) total number of proxies over all processes
+    :param ninstances: (int) number of tor processes (default: number of cpu's)
+
+    example:
+        fleet = await create_fleet_async(40)
+    """
+    from . import fleet
+
+    f = fleet.TorFleet(nproxies, ninstances)
+    return await f.start()
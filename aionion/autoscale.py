@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+import math
+import time
+from typing import Optional
+
+__all__ = ["Autoscaler"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+log = logging.getLogger(__name__)
+
+
+class Autoscaler:
+    """
+    adds and removes socks ports of a running ```Tor``` to follow the demand.
+
+    every ```interval``` seconds the requests in flight are sampled from the scheduler
+    (this includes the requests queued for a connection). the pool grows right away when
+    there are more than ```target``` requests per port, or when the average latency
+    exceeds ```max_latency``` while the pool is busy. it only shrinks when the peak of
+    the last ```window``` samples fits in fewer ports, and not within ```cooldown```
+    seconds of the last change. ports to remove are drained first, see ```Tor.remove_socks_ports```.
+
+    sessions read the proxies from the scheduler on every request, so they see
+    the new pool right away.
+
+    :param tor: the ```Tor``` instance to scale
+    :param min_ports: (int) never fewer ports than this
+    :param max_ports: (int) never more ports than this
+    :param target: (float) requests in flight per port to aim for
+    :param max_latency: (float) optional. average latency (s) at which to add ports
+    :param interval: (float) seconds between samples
+    :param window: (int) number of samples the peak for scaling down is taken from
+    :param step: (int) max ports to add or remove at once
+    :param cooldown: (float) seconds after a change before scaling down
+    :param drain_timeout: (float) max seconds to wait for the requests of a removed port
+    """
+
+    def __init__(
+        self,
+        tor,
+        min_ports: int = 2,
+        max_ports: int = 100,
+        target: float = 4,
+        max_latency: Optional[float] = None,
+        interval: float = 5,
+        window: int = 12,
+        step: int = 5,
+        cooldown: float = 60,
+        drain_timeout: float = 30,
+    ):
+        self.tor = tor
+        self.min_ports = max(1, min_ports)
+        self.max_ports = max(self.min_ports, max_ports)
+        self.target = target
+        self.max_latency = max_latency
+        self.interval = interval
+        self.step = step
+        self.cooldown = cooldown
+        self.drain_timeout = drain_timeout
+        self._samples = collections.deque(maxlen=window)
+        self._changed = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self.scaled_up = 0
+        self.scaled_down = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._task) and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def stop(self) -> Optional[asyncio.Task]:
+        """
+        cancels the loop and returns its task, to be awaited by whoever wants it finished
+        """
+        task, self._task = self._task, None
+        if task:
+            task.cancel()
+        return task
+
+    def load(self) -> int:
+        """
+        returns the number of requests in flight over all ports
+        """
+        scheduler = self.tor.scheduler
+        return sum(scheduler.in_flight(p) for p in self.tor.registry.all)
+
+    def latency(self) -> float:
+        """
+        returns the average latency of the proxies in use, 0 when unknown
+        """
+        scheduler = self.tor.scheduler
+        known = [l for l in map(scheduler.latency, self.tor.proxies) if l]
+        return sum(known) / len(known) if known else 0
+
+    def desired(self, ports: int) -> int:
+        """
+        samples the load and returns the number of ports the pool should have
+        """
+        load = self.load()
+        self._samples.append(load)
+        wanted = math.ceil(load / self.target)
+        if (
+            self.max_latency
+            and load >= ports * self.target / 2
+            and self.latency() > self.max_latency
+        ):
+            wanted = max(wanted, ports + 1)
+        if wanted < ports:
+            # only shrink when the recent peak fits as well
+            wanted = max(wanted, math.ceil(max(self._samples) / self.target))
+            if time.monotonic() - self._changed < self.cooldown:
+                wanted = ports
+        wanted = max(self.min_ports, min(self.max_ports, wanted))
+        return max(ports - self.step, min(ports + self.step, wanted))
+
+    async def scale(self) -> int:
+        """
+        samples the load once and adds or removes ports.
+        returns the number of ports added (negative when removed)
+        """
+        ports = len(self.tor.registry) - sum(
+            self.tor.registry.draining(p) for p in self.tor.registry.all
+        )
+        delta = self.desired(ports) - ports
+        if delta > 0:
+            log.info(
+                "adding %d socks ports to %d (load %d)" % (delta, ports, self.load())
+            )
+            await self.tor.add_socks_ports(delta)
+            self.scaled_up += delta
+        elif delta < 0:
+            proxies = self._removable(-delta)
+            log.info("removing %d socks ports of %d" % (len(proxies), ports))
+            await self.tor.remove_socks_ports(proxies, self.drain_timeout)
+            self.scaled_down += len(proxies)
+        if delta:
+            self._changed = time.monotonic()
+        return delta
+
+    def _removable(self, count: int) -> list:
+        # the broken ones first, then the least busy, then the newest
+        registry, scheduler = self.tor.registry, self.tor.scheduler
+        usable = set(map(tuple, registry.proxies))
+
+        def rank(proxy):
+            broken = tuple(proxy) not in usable or (
+                proxy.breaker is not None and not proxy.breaker.available()
+            )
+            return not broken, scheduler.in_flight(proxy), -proxy.port
+
+        candidates = [p for p in registry.all if not registry.draining(p)]
+        return sorted(candidates, key=rank)[:count]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.tor.running:
+                continue
+            try:
+                await self.scale()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.warning("autoscaling %s failed" % self.tor, exc_info=True)
+
+    def __repr__(self):
+        return "%s(%d..%d ports, target = %s, up = %d, down = %d)" % (
+            self.__class__.__name__,
+            self.min_ports,
+            self.max_ports,
+            self.target,
+            self.scaled_up,
+            self.scaled_down,
+        )
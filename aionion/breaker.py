@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import asyncio
+from enum import Enum
+import logging
+import sys
+import threading
+import time
+from typing import Callable
+from typing import Optional
+from typing import Union
+
+__all__ = ["BreakerState", "CircuitBreaker", "is_circuit_failure", "create_breaker"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+log = logging.getLogger(__name__)
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+def is_circuit_failure(error: BaseException) -> bool:
+    """
+    returns True when ```error``` says something about the circuit:
+    a connection error or a timeout. an http error status, a bad url
+    or too many redirects do not
+    """
+    # an error of a library which is not imported can not occur,
+    # so the libraries are only looked at, not imported
+    requests = sys.modules.get("requests")
+    if requests is not None and isinstance(error, requests.RequestException):
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+    failures = [OSError, asyncio.TimeoutError]
+    aiohttp = sys.modules.get("aiohttp")
+    if aiohttp is not None:
+        failures.append(aiohttp.ClientConnectionError)
+    python_socks = sys.modules.get("python_socks")
+    if python_socks is not None:
+        failures.extend(
+            (
+                python_socks.ProxyError,
+                python_socks.ProxyTimeoutError,
+                python_socks.ProxyConnectionError,
+            )
+        )
+    return isinstance(error, tuple(failures))
+
+
+class CircuitBreaker:
+    """
+    circuit breaker of a single proxy (```SocksProxy.breaker```).
+
+        closed    - requests pass. ```failures``` connection errors or timeouts
+                    in a row open the breaker
+        open      - the proxy is skipped by the scheduler for ```cooldown``` seconds
+        half_open - a single request is let through as a probe. when it succeeds
+                    the breaker closes, when it fails it opens again,
+                    with twice the cooldown (up to ```max_cooldown```)
+
+    :param failures: (int) failures in a row before the breaker opens
+    :param cooldown: (float) seconds the breaker stays open the first time
+    :param max_cooldown: (float) max seconds the breaker stays open
+    :param on_trip: optional callable(breaker), called whenever the breaker opens
+    """
+
+    # number of breakers which are not closed, so the scheduler can skip
+    # filtering while every proxy is fine
+    tripped = 0
+    _tripped_lock = threading.Lock()
+
+    def __init__(
+        self,
+        failures: int = 5,
+        cooldown: float = 30,
+        max_cooldown: float = 300,
+        on_trip: Callable[[CircuitBreaker], None] = None,
+    ):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.on_trip = on_trip
+        self.state = BreakerState.CLOSED
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.opened_at = 0.0
+        self._open_for = cooldown
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        """
+        returns True when a request may be sent. does not reserve the probe
+        of a half-open breaker, see ```acquired```
+        """
+        if self.state is BreakerState.CLOSED:
+            return True
+        with self._lock:
+            if self.state is BreakerState.OPEN:
+                if time.monotonic() - self.opened_at < self._open_for:
+                    return False
+                self._set_state(BreakerState.HALF_OPEN)
+            return not self._probing
+
+    def acquired(self):
+        """
+        tells the breaker a request is sent. when half-open, that request is the probe
+        """
+        if self.state is BreakerState.HALF_OPEN:
+            with self._lock:
+                self._probing = True
+
+    def success(self):
+        if self.state is BreakerState.CLOSED and not self.consecutive_failures:
+            return
+        with self._lock:
+            self.consecutive_failures = 0
+            if self.state is not BreakerState.CLOSED:
+                self._open_for = self.cooldown
+                self._set_state(BreakerState.CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state is BreakerState.HALF_OPEN:
+                self._open_for = min(self._open_for * 2, self.max_cooldown)
+            elif (
+                self.state is BreakerState.OPEN
+                or self.consecutive_failures < self.failures
+            ):
+                return
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            self._set_state(BreakerState.OPEN)
+        if self.on_trip:
+            try:
+                self.on_trip(self)
+            except Exception:
+                log.warning("on_trip of %r failed" % self, exc_info=True)
+
+    def record(self, error: Union[BaseException, bool, None] = None):
+        """
+        feeds the outcome of a request. errors which are not a circuit failure
+        (see ```is_circuit_failure```) count as a success, since the circuit worked.
+
+        :param error: the exception the request failed with, True for an unknown failure
+        """
+        if error is True or (error and is_circuit_failure(error)):
+            self.failure()
+        else:
+            self.success()
+
+    def cancelled(self):
+        """
+        a request ended without an outcome. frees the probe of a half-open breaker
+        """
+        if self._probing:
+            with self._lock:
+                self._probing = False
+
+    def reset(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._open_for = self.cooldown
+            self._set_state(BreakerState.CLOSED)
+
+    def _set_state(self, state: BreakerState):
+        # called with the lock held
+        previous, self.state = self.state, state
+        self._probing = False
+        if (previous is BreakerState.CLOSED) != (state is BreakerState.CLOSED):
+            with CircuitBreaker._tripped_lock:
+                CircuitBreaker.tripped += 1 if previous is BreakerState.CLOSED else -1
+        if previous is not state:
+            log.debug("breaker %s -> %s" % (previous.value, state.value))
+
+    def __repr__(self):
+        return "%s(%s, failures = %d, trips = %d)" % (
+            self.__class__.__name__,
+            self.state.value,
+            self.consecutive_failures,
+            self.trips,
+        )
+
+
+def create_breaker(
+    proxy, breaker: Union[bool, dict, CircuitBreaker, None] = None
+) -> Optional[CircuitBreaker]:
+    """
+    returns the breaker for ```proxy```: ```breaker``` when it is a CircuitBreaker
+    already, None when it is False, otherwise a new one using ```breaker``` as settings.
+
+    the settings take an extra ```renew_circuit``` (default True): when the breaker
+    trips, ```proxy.renew_circuit()``` moves new connections of that proxy to a fresh circuit
+    """
+    if breaker is False:
+        return None
+    if isinstance(breaker, CircuitBreaker):
+        return breaker
+    settings = dict(breaker or {})
+    renew = settings.pop("renew_circuit", True)
+    if renew and "on_trip" not in settings:
+        settings["on_trip"] = lambda _: proxy.renew_circuit()
+    return CircuitBreaker(**settings)
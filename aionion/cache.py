@@ -0,0 +1,526 @@
+from __future__ import annotations
+
+import calendar
+import collections
+import email.utils
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Iterable
+from typing import Optional
+from typing import Union
+import weakref
+
+__all__ = ["HttpCache", "CacheEntry", "create_cache", "cache_stats"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+log = logging.getLogger(__name__)
+
+# statuses which may be stored without explicit freshness, RFC 9111 4.2.2
+CACHEABLE = frozenset((200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501))
+# stored. other cacheable statuses are mostly errors, which are better asked again
+STORED = frozenset((200, 203, 300, 301, 308))
+# headers of a 304 which do not replace the stored ones
+_KEEP_ON_UPDATE = frozenset(("content-length", "content-encoding", "transfer-encoding"))
+
+# the caches in use, for the metrics
+_instances = weakref.WeakSet()
+# directory -> cache, so sessions using the same directory share the index
+_by_directory = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+
+
+def parse_cache_control(value: Optional[str]) -> dict:
+    """
+    returns the directives of a Cache-Control header as ```{name: value or True}```
+    """
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip().strip('"') if arg else True
+    return directives
+
+
+def _seconds(value) -> Optional[int]:
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        parsed = email.utils.parsedate_tz(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if parsed is None:
+        return None
+    return calendar.timegm(parsed[:9]) - (parsed[9] or 0)
+
+
+def _lower(headers) -> dict:
+    """
+    the headers of a request or response as ```{lowercase name: value}```
+    """
+    if headers is None:
+        return {}
+    items = headers.items() if hasattr(headers, "items") else headers
+    merged = {}
+    for name, value in items:
+        name = name.lower()
+        merged[name] = "%s, %s" % (merged[name], value) if name in merged else value
+    return merged
+
+
+class CacheEntry:
+    """
+    a stored response: status, headers and when it was received.
+    the body is kept in a file of the cache directory
+    """
+
+    __slots__ = (
+        "key",
+        "url",
+        "status",
+        "reason",
+        "headers",
+        "vary",
+        "response_time",
+        "size",
+        "_lower",
+    )
+
+    def __init__(
+        self,
+        key: str,
+        url: str,
+        status: int,
+        reason: str,
+        headers: list,
+        vary: dict,
+        response_time: float,
+        size: int,
+    ):
+        self.key = key
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = [tuple(h) for h in headers]
+        self.vary = vary
+        self.response_time = response_time
+        self.size = size
+        self._lower = _lower(self.headers)
+
+    def header(self, name: str) -> Optional[str]:
+        return self._lower.get(name.lower())
+
+    @property
+    def cache_control(self) -> dict:
+        return parse_cache_control(self.header("cache-control"))
+
+    def matches(self, request_headers: dict) -> bool:
+        """
+        True when the headers named by Vary are the same as for the stored request
+        """
+        return all(request_headers.get(k) == v for k, v in self.vary.items())
+
+    def age(self, now: float = None) -> float:
+        """
+        the current age, RFC 9111 4.2.3
+        """
+        now = time.time() if now is None else now
+        date = _http_date(self.header("date")) or self.response_time
+        initial = max(self.response_time - date, _seconds(self.header("age")) or 0, 0)
+        return initial + now - self.response_time
+
+    def lifetime(self, heuristic: float, max_heuristic: float) -> float:
+        """
+        the freshness lifetime, RFC 9111 4.2.1: max-age, else Expires, else a share
+        ```heuristic``` of the time since Last-Modified
+        """
+        cc = self.cache_control
+        max_age = _seconds(cc.get("max-age"))
+        if max_age is not None:
+            return max_age
+        date = _http_date(self.header("date")) or self.response_time
+        if self.header("expires") is not None:
+            # an invalid date means already expired
+            expires = _http_date(self.header("expires"))
+            return max(0, expires - date) if expires else 0
+        modified = _http_date(self.header("last-modified"))
+        if modified and self.status in CACHEABLE:
+            return min(max_heuristic, max(0, date - modified) * heuristic)
+        return 0
+
+    def to_json(self) -> dict:
+        return dict(
+            url=self.url,
+            status=self.status,
+            reason=self.reason,
+            headers=self.headers,
+            vary=self.vary,
+            response_time=self.response_time,
+            size=self.size,
+        )
+
+    def __repr__(self):
+        return "%s(%s, %d, %d bytes)" % (
+            self.__class__.__name__,
+            self.url,
+            self.status,
+            self.size,
+        )
+
+
+class HttpCache:
+    """
+    http cache shared by ```ClientSession``` and ```RequestsSession``` (```cache=``` parameter),
+    following RFC 9111 for a private cache.
+
+    responses to GET which may be stored (Cache-Control, status, Vary) are kept on disk,
+    the body and the headers in two files per url, with an index in memory.
+    a fresh response is answered from the cache without using a proxy. a stale one
+    is revalidated with If-None-Match / If-Modified-Since, and a 304 renews it.
+    unsafe requests (POST, PUT, DELETE, ...) to a url drop its entry.
+    when the bodies exceed ```max_size```, the least recently used entries are dropped.
+
+        cache = HttpCache("~/.cache/myapp", max_size=512 * 2**20)
+        async with aionion.ClientSession(tor, cache=cache) as session:
+            ...
+        session = aionion.RequestsSession(tor, cache=cache)
+
+    :param directory: where to store the responses. default: ```http-cache``` in the aionion data directory
+    :param max_size: (int) max bytes of all bodies
+    :param max_entry_size: (int) max bytes of one body. default: an eighth of ```max_size```
+    :param heuristic: (float) share of the age of the Last-Modified date a response without
+                      explicit freshness is fresh for
+    :param max_heuristic: (float) max seconds of such a heuristic freshness
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path, None] = None,
+        max_size: int = 256 * 2**20,
+        max_entry_size: int = None,
+        heuristic: float = 0.1,
+        max_heuristic: float = 24 * 3600,
+    ):
+        if directory is None:
+            from .utils import get_appdata_dir
+
+            directory = get_appdata_dir("aionion") / "http-cache"
+        self.directory = Path(directory).expanduser()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size or max_size // 8
+        self.heuristic = heuristic
+        self.max_heuristic = max_heuristic
+        self._index: collections.OrderedDict[str, CacheEntry] = (
+            collections.OrderedDict()
+        )
+        self._size = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.revalidated = 0
+        self.stored = 0
+        self.evicted = 0
+        self._load()
+        _instances.add(self)
+
+    def lookup(
+        self, method: str, url: str, headers=None
+    ) -> tuple[Optional[CacheEntry], bool]:
+        """
+        returns ```(entry, fresh)``` for a request. the entry is None on a miss,
+        and when ```fresh``` is False it has to be revalidated before use
+        """
+        if method.upper() not in ("GET", "HEAD"):
+            return None, False
+        headers = _lower(headers)
+        request_cc = parse_cache_control(headers.get("cache-control"))
+        if "range" in headers or "no-store" in request_cc:
+            return None, False
+        key = self._key(url)
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None or not entry.matches(headers):
+                self.misses += 1
+                return None, False
+            self._index.move_to_end(key)
+            age = entry.age()
+            lifetime = entry.lifetime(self.heuristic, self.max_heuristic)
+            max_age = _seconds(request_cc.get("max-age"))
+            if max_age is not None:
+                lifetime = min(lifetime, max_age)
+            fresh = age < lifetime and not (
+                "no-cache" in request_cc
+                or "no-cache" in entry.cache_control
+                or "no-cache" in headers.get("pragma", "")
+            )
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale += 1
+            return entry, fresh
+
+    def conditional_headers(self, entry: CacheEntry) -> dict:
+        """
+        the headers which turn a request into a revalidation of ```entry```
+        """
+        headers = {}
+        if entry.header("etag"):
+            headers["If-None-Match"] = entry.header("etag")
+        if entry.header("last-modified"):
+            headers["If-Modified-Since"] = entry.header("last-modified")
+        return headers
+
+    def storable(
+        self, method: str, status: int, request_headers, response_headers
+    ) -> bool:
+        """
+        True when the response to a request may be stored
+        """
+        if method.upper() != "GET" or status not in STORED:
+            return False
+        request_headers = _lower(request_headers)
+        response_headers = _lower(response_headers)
+        if "range" in request_headers:
+            return False
+        request_cc = parse_cache_control(request_headers.get("cache-control"))
+        response_cc = parse_cache_control(response_headers.get("cache-control"))
+        if "no-store" in request_cc or "no-store" in response_cc:
+            return False
+        if response_headers.get("vary", "").strip() == "*":
+            return False
+        length = _seconds(response_headers.get("content-length"))
+        if length is not None and length > self.max_entry_size:
+            return False
+        # without freshness or a validator it would never be used
+        return bool(
+            "max-age" in response_cc
+            or "expires" in response_headers
+            or "etag" in response_headers
+            or "last-modified" in response_headers
+        )
+
+    def store(
+        self,
+        url: str,
+        request_headers,
+        status: int,
+        reason: str,
+        response_headers: Iterable,
+        body: bytes,
+    ) -> Optional[CacheEntry]:
+        """
+        stores a response which is ```storable```, returns its entry
+        """
+        if len(body) > self.max_entry_size:
+            return None
+        key = self._key(url)
+        headers = [(str(k), str(v)) for k, v in _items(response_headers)]
+        request_headers = _lower(request_headers)
+        vary = {
+            name.strip().lower(): request_headers.get(name.strip().lower())
+            for name in _lower(headers).get("vary", "").split(",")
+            if name.strip()
+        }
+        entry = CacheEntry(
+            key, url, status, reason, headers, vary, time.time(), len(body)
+        )
+        with self._lock:
+            try:
+                self._write(self._path(key, ".body"), body)
+                self._write_meta(entry)
+            except OSError as e:
+                log.warning("could not store %s in the cache: %r" % (url, e))
+                self._remove(key)
+                return None
+            old = self._index.pop(key, None)
+            if old is not None:
+                self._size -= old.size
+            self._index[key] = entry
+            self._size += entry.size
+            self.stored += 1
+            self._evict()
+        return entry
+
+    def refresh(self, entry: CacheEntry, response_headers) -> CacheEntry:
+        """
+        updates ```entry``` with the headers of a 304 answering its revalidation
+        """
+        updates = {
+            k.lower(): (k, v)
+            for k, v in _items(response_headers)
+            if k.lower() not in _KEEP_ON_UPDATE
+        }
+        headers = [h for h in entry.headers if h[0].lower() not in updates]
+        headers += [(str(k), str(v)) for k, v in updates.values()]
+        refreshed = CacheEntry(
+            entry.key,
+            entry.url,
+            entry.status,
+            entry.reason,
+            headers,
+            entry.vary,
+            time.time(),
+            entry.size,
+        )
+        with self._lock:
+            self.revalidated += 1
+            if self._index.get(entry.key) is entry:
+                self._index[entry.key] = refreshed
+                try:
+                    self._write_meta(refreshed)
+                except OSError as e:
+                    log.warning("could not update %s in the cache: %r" % (entry.url, e))
+        return refreshed
+
+    def body(self, entry: CacheEntry) -> Optional[bytes]:
+        """
+        returns the stored body, or None when it is gone (the entry is dropped then)
+        """
+        try:
+            body = self._path(entry.key, ".body").read_bytes()
+        except OSError:
+            body = None
+        if body is None or len(body) != entry.size:
+            self.invalidate(entry.url)
+            return None
+        return body
+
+    def invalidate(self, url: str):
+        """
+        drops the entry of ```url```
+        """
+        with self._lock:
+            self._remove(self._key(url))
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._index):
+                self._remove(key)
+
+    def stats(self) -> dict:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            stale=self.stale,
+            revalidated=self.revalidated,
+            stored=self.stored,
+            evicted=self.evicted,
+            entries=len(self._index),
+            bytes=self._size,
+        )
+
+    def _key(self, url: str) -> str:
+        return hashlib.sha256(str(url).encode()).hexdigest()
+
+    def _path(self, key: str, suffix: str) -> Path:
+        return self.directory / (key + suffix)
+
+    def _write(self, path: Path, data: bytes):
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def _write_meta(self, entry: CacheEntry):
+        self._write(
+            self._path(entry.key, ".json"), json.dumps(entry.to_json()).encode()
+        )
+
+    def _remove(self, key: str):
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
+        for suffix in (".json", ".body"):
+            try:
+                self._path(key, suffix).unlink()
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self._size > self.max_size and self._index:
+            key = next(iter(self._index))
+            self._remove(key)
+            self.evicted += 1
+
+    def _load(self):
+        entries = []
+        for path in self.directory.glob("*.json"):
+            key = path.stem
+            try:
+                meta = json.loads(path.read_bytes())
+                body = self._path(key, ".body").stat()
+                if body.st_size != meta["size"]:
+                    raise ValueError("incomplete body")
+                entries.append(CacheEntry(key, **meta))
+            except (OSError, ValueError, TypeError, KeyError):
+                self._remove(key)
+        # the oldest first, as a guess of the least recently used
+        for entry in sorted(entries, key=lambda e: e.response_time):
+            self._index[entry.key] = entry
+            self._size += entry.size
+        self._evict()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return "%s(%s, %d entries, %d bytes, hits = %d, misses = %d)" % (
+            self.__class__.__name__,
+            self.directory,
+            len(self),
+            self._size,
+            self.hits,
+            self.misses,
+        )
+
+
+def _items(headers) -> Iterable:
+    return headers.items() if hasattr(headers, "items") else headers
+
+
+def create_cache(cache: Union[bool, str, Path, HttpCache, None]) -> Optional[HttpCache]:
+    """
+    returns the ```HttpCache``` for the ```cache``` parameter of the sessions:
+    a cache, a directory, True for the default directory, or None / False for no cache.
+    sessions given the same directory share one cache
+    """
+    if cache is None or cache is False:
+        return None
+    if isinstance(cache, HttpCache):
+        return cache
+    directory = None if cache is True else Path(cache).expanduser().resolve()
+    with _lock:
+        instance = _by_directory.get(directory)
+        if instance is None:
+            instance = _by_directory[directory] = HttpCache(directory)
+        return instance
+
+
+def cache_stats() -> Optional[dict]:
+    """
+    the sums of the ```stats()``` of all caches in use, or None when there are none
+    """
+    caches = list(_instances)
+    if not caches:
+        return None
+    totals = collections.Counter()
+    for cache in caches:
+        totals.update(cache.stats())
+    return dict(totals)
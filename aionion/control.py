@@ -0,0 +1,412 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import hashlib
+import hmac
+import logging
+import os
+from pathlib import Path
+import re
+import time
+from typing import Callable
+from typing import Union
+
+__all__ = [
+    "ControlClient",
+    "ControlReply",
+    "ControlEvent",
+    "ControlError",
+    "ControlClosed",
+    "hash_control_password",
+    "parse_keywords",
+]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+log = logging.getLogger(__name__)
+
+# tor refuses NEWNYM more often than this (seconds)
+NEWNYM_INTERVAL = 10
+
+_SAFECOOKIE_SERVER_KEY = b"Tor safe cookie authentication server-to-controller hash"
+_SAFECOOKIE_CLIENT_KEY = b"Tor safe cookie authentication controller-to-server hash"
+
+_AUTH_METHODS_REGEX = re.compile(r"METHODS=(\S+)")
+_COOKIE_FILE_REGEX = re.compile(r'COOKIEFILE="((?:[^"\\]|\\.)*)"')
+_KEYWORD_REGEX = re.compile(r'(\w+)=("(?:[^"\\]|\\.)*"|\S+)')
+
+
+class ControlError(Exception):
+    """
+    tor answered a command with an error status
+    """
+
+    def __init__(self, reply: ControlReply):
+        super().__init__("%d %s" % (reply.status, reply.message))
+        self.reply = reply
+        self.status = reply.status
+
+
+class ControlClosed(ConnectionError):
+    """
+    the connection to the control port is gone
+    """
+
+
+class ControlReply:
+    """
+    a (synchronous) reply to a command.
+
+    :param status: (int) the status code. 250 means OK
+    :param lines: (list) the text of each reply line, without status code.
+                  data replies (250+) are joined into one line with newlines
+    """
+
+    def __init__(self, status: int, lines: list[str]):
+        self.status = status
+        self.lines = lines
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status < 300
+
+    @property
+    def message(self) -> str:
+        return self.lines[-1] if self.lines else ""
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise ControlError(self)
+        return self
+
+    def __repr__(self):
+        return "%s(status = %d, lines = %r)" % (
+            self.__class__.__name__,
+            self.status,
+            self.lines,
+        )
+
+
+class ControlEvent(ControlReply):
+    """
+    an asynchronous event (650) tor sends after SETEVENTS.
+
+        type    - event name, like CIRC, STREAM or STATUS_CLIENT
+        args    - the remainder of the first line
+    """
+
+    def __init__(self, status: int, lines: list[str]):
+        super().__init__(status, lines)
+        self.type, _, self.args = lines[0].partition(" ")
+
+    def keywords(self) -> dict:
+        """
+        returns the KEY=VALUE arguments of the event
+        """
+        return parse_keywords(self.args)
+
+
+class ControlClient:
+    """
+    asyncio client for the tor control protocol.
+
+    commands are pipelined: they are written immediately and their
+    replies are matched in order by a single reader task, so concurrent
+    callers never wait for each other's round-trip and never block the loop.
+
+    example:
+        controller = await ControlClient.connect(port=tor.config.control_port)
+        await controller.authenticate(cookie_path=tor.config.data_directory / "control_auth_cookie")
+        print(await controller.get_info("version"))
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._pending = collections.deque()
+        self._listeners = collections.defaultdict(list)
+        self._last_newnym = 0
+        self._closed = False
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=9051) -> ControlClient:
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    def is_alive(self) -> bool:
+        return not self._closed and not self._read_task.done()
+
+    async def msg(self, command: str) -> ControlReply:
+        """
+        sends a raw command and returns the reply, whatever its status
+        """
+        if not self.is_alive():
+            raise ControlClosed("control connection is closed")
+        fut = asyncio.get_running_loop().create_future()
+        # write and enqueue without awaiting in between, so replies stay in order
+        self._writer.write(command.encode() + b"\r\n")
+        self._pending.append(fut)
+        return await fut
+
+    async def request(self, command: str) -> ControlReply:
+        """
+        sends a command and raises ControlError unless it succeeded
+        """
+        return (await self.msg(command)).raise_for_status()
+
+    async def protocol_info(self) -> dict:
+        reply = await self.request("PROTOCOLINFO 1")
+        info = {"methods": [], "cookie_file": None, "version": None}
+        for line in reply.lines:
+            if line.startswith("AUTH "):
+                methods = _AUTH_METHODS_REGEX.search(line)
+                if methods:
+                    info["methods"] = methods[1].split(",")
+                cookie_file = _COOKIE_FILE_REGEX.search(line)
+                if cookie_file:
+                    info["cookie_file"] = _unquote('"%s"' % cookie_file[1])
+            elif line.startswith("VERSION "):
+                info["version"] = parse_keywords(line[8:]).get("Tor")
+        return info
+
+    async def authenticate(
+        self, password: str = None, cookie_path: Union[str, Path] = None
+    ):
+        """
+        authenticates using the best method tor offers:
+        none, safecookie, cookie or password (in that order).
+
+        :param password: (str) the plain text control password
+        :param cookie_path: (str, Path) the cookie file. defaults to the one tor reports
+        """
+        info = await self.protocol_info()
+        methods = info["methods"]
+        cookie_path = cookie_path or info["cookie_file"]
+        cookie = None
+        if cookie_path and ("COOKIE" in methods or "SAFECOOKIE" in methods):
+            try:
+                cookie = Path(cookie_path).read_bytes()
+            except OSError:
+                log.debug("could not read cookie file %s" % cookie_path, exc_info=True)
+
+        if "NULL" in methods:
+            await self.request("AUTHENTICATE")
+        elif cookie and "SAFECOOKIE" in methods:
+            await self._authenticate_safecookie(cookie)
+        elif cookie and "COOKIE" in methods:
+            await self.request("AUTHENTICATE %s" % cookie.hex())
+        elif password is not None and "HASHEDPASSWORD" in methods:
+            await self.request("AUTHENTICATE %s" % _quote(password))
+        else:
+            raise ControlError(
+                ControlReply(515, ["no usable authentication method in %s" % methods])
+            )
+        return self
+
+    async def _authenticate_safecookie(self, cookie: bytes):
+        client_nonce = os.urandom(32)
+        reply = await self.request("AUTHCHALLENGE SAFECOOKIE %s" % client_nonce.hex())
+        challenge = parse_keywords(reply.message.partition(" ")[2])
+        server_hash = bytes.fromhex(challenge["SERVERHASH"])
+        server_nonce = bytes.fromhex(challenge["SERVERNONCE"])
+        message = cookie + client_nonce + server_nonce
+        expected = hmac.new(_SAFECOOKIE_SERVER_KEY, message, hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, server_hash):
+            raise ControlError(ControlReply(515, ["safecookie server hash mismatch"]))
+        client_hash = hmac.new(_SAFECOOKIE_CLIENT_KEY, message, hashlib.sha256)
+        await self.request("AUTHENTICATE %s" % client_hash.hexdigest())
+
+    async def get_info(self, *keys: str) -> dict:
+        """
+        returns a dict of key -> value for the GETINFO keys
+        """
+        reply = await self.request("GETINFO %s" % " ".join(keys))
+        result = {}
+        for line in reply.lines:
+            key, sep, value = line.partition("=")
+            if not sep:
+                continue
+            if value.startswith("\n"):
+                value = value[1:]
+            result[key] = value
+        return result
+
+    async def get_conf(self, key: str) -> list[str]:
+        reply = await self.request("GETCONF %s" % key)
+        values = []
+        for line in reply.lines:
+            _, sep, value = line.partition("=")
+            if sep:
+                values.append(_unquote(value))
+        return values
+
+    async def set_conf(self, key: str, value):
+        await self.set_options({key: value})
+
+    async def set_options(self, options: dict):
+        """
+        sets multiple options in one SETCONF.
+        list values set the option multiple times (like SocksPort)
+        """
+        params = []
+        for key, value in options.items():
+            if value is None:
+                params.append(key)
+                continue
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            params.extend("%s=%s" % (key, _quote(str(v))) for v in value)
+        await self.request("SETCONF %s" % " ".join(params))
+
+    async def signal(self, signal: str):
+        signal = str(getattr(signal, "value", signal)).upper()
+        await self.request("SIGNAL %s" % signal)
+        if signal == "NEWNYM":
+            self._last_newnym = time.monotonic()
+
+    def get_newnym_wait(self) -> float:
+        """
+        seconds until tor accepts the next NEWNYM from us
+        """
+        return max(0.0, NEWNYM_INTERVAL - (time.monotonic() - self._last_newnym))
+
+    async def add_event_listener(self, callback: Callable, *events: str):
+        """
+        calls ```callback(event)``` for each of ```events```.
+        callback may be a function or a coroutine function
+        """
+        for event in events:
+            self._listeners[event.upper()].append(callback)
+        await self._set_events()
+
+    async def remove_event_listener(self, callback: Callable):
+        for event in list(self._listeners):
+            listeners = self._listeners[event]
+            if callback in listeners:
+                listeners.remove(callback)
+            if not listeners:
+                del self._listeners[event]
+        await self._set_events()
+
+    async def _set_events(self):
+        await self.request(" ".join(["SETEVENTS", *self._listeners]))
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._read_task.cancel()
+        self._fail_pending(ControlClosed("control connection closed"))
+        if not self._writer.is_closing():
+            self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def _read_reply(self) -> tuple[int, list[str]]:
+        lines = []
+        while True:
+            line = await self._readline()
+            status, sep, text = line[:3], line[3:4], line[4:]
+            if sep == "+":
+                data = []
+                while True:
+                    data_line = await self._readline()
+                    if data_line == ".":
+                        break
+                    if data_line.startswith("."):
+                        data_line = data_line[1:]
+                    data.append(data_line)
+                text = "\n".join([text, *data])
+            lines.append(text)
+            if sep == " ":
+                return int(status), lines
+
+    async def _readline(self) -> str:
+        line = await self._reader.readline()
+        if not line:
+            raise ControlClosed("control connection closed by tor")
+        return line.decode("utf-8", "replace").rstrip("\r\n")
+
+    async def _read_loop(self):
+        try:
+            while True:
+                status, lines = await self._read_reply()
+                if status == 650:
+                    self._dispatch(ControlEvent(status, lines))
+                elif self._pending:
+                    fut = self._pending.popleft()
+                    if not fut.done():
+                        fut.set_result(ControlReply(status, lines))
+                else:
+                    log.debug(
+                        "unexpected reply from control port: %s %s" % (status, lines)
+                    )
+        except (ControlClosed, ConnectionError, ValueError) as e:
+            self._closed = True
+            self._fail_pending(ControlClosed(str(e)))
+
+    def _dispatch(self, event: ControlEvent):
+        for callback in list(self._listeners.get(event.type, ())):
+            try:
+                result = callback(event)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            except Exception:
+                log.debug(
+                    "error in %s listener %s" % (event.type, callback), exc_info=True
+                )
+
+    def _fail_pending(self, exc: Exception):
+        while self._pending:
+            fut = self._pending.popleft()
+            if not fut.done():
+                fut.set_exception(exc)
+
+    def __repr__(self):
+        return "%s(alive = %s, pending = %d)" % (
+            self.__class__.__name__,
+            self.is_alive(),
+            len(self._pending),
+        )
+
+
+def parse_keywords(text: str) -> dict:
+    """
+    parses KEY=VALUE KEY2="quoted value" into a dict
+    """
+    return {key: _unquote(value) for key, value in _KEYWORD_REGEX.findall(text)}
+
+
+def hash_control_password(password: str, salt: bytes = None) -> str:
+    """
+    returns ```password``` hashed the way tor expects for HashedControlPassword
+    (the same as ```tor --hash-password```)
+    """
+    salt = salt or os.urandom(8)
+    indicator = 0x60
+    count = (16 + (indicator & 15)) << ((indicator >> 4) + 6)
+    secret = salt + password.encode()
+    digest = hashlib.sha1()
+    while count > 0:
+        chunk = secret[:count]
+        digest.update(chunk)
+        count -= len(chunk)
+    return "16:" + (salt + bytes([indicator]) + digest.digest()).hex().upper()
+
+
+def _quote(value: str) -> str:
+    return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _unquote(value: str) -> str:
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return re.sub(r"\\(.)", r"\1", value[1:-1])
+    return value
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+import time
+from typing import Optional
+
+__all__ = ["ExitDiscovery"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+log = logging.getLogger(__name__)
+
+
+class ExitDiscovery:
+    """
+    finds the exit relay and public ip of a socks port through tor's control port,
+    instead of asking an outside ip lookup service:
+
+        1. a RESOLVE stream is sent through the port, from a local port we know,
+           and isolated like the requests of the port would be
+        2. its STREAM events (matched by ```SOURCE_ADDR```) tell the circuit tor attached it to
+        3. ```GETINFO circuit-status``` gives the path of that circuit. the last hop is the exit
+        4. ```GETINFO ns/id/<fingerprint>``` gives the address of the exit
+
+    nothing but the name lookup leaves tor. the time the resolve takes (a round trip
+    over the circuit) is recorded as the latency of the proxy.
+    when the control port can not tell, the lookup falls back to ```PublicIPService```.
+
+        tor = Tor(ip_lookup="control")   # the default, used by the health probes
+
+    :param tor: the ```Tor``` whose control port to use
+    :param resolve_host: (str) the host name to resolve through the port
+    :param fallback: (bool) use ```PublicIPService``` when the control port can not tell
+    """
+
+    def __init__(self, tor, resolve_host: str = "torproject.org", fallback=True):
+        self.tor = tor
+        self.resolve_host = resolve_host
+        self.fallback = fallback
+        self._controller = None
+        self._subscribing: Optional[asyncio.Future] = None
+        # "host:port" of our side of a probe connection -> future of its circuit id
+        self._sources: dict[str, asyncio.Future] = {}
+        # stream id -> future of its circuit id
+        self._streams: dict[str, asyncio.Future] = {}
+        # fingerprint -> address of the relay
+        self._relays: dict[str, str] = {}
+        self.lookups = 0
+        self.fallbacks = 0
+
+    async def lookup(self, proxy, timeout: float = 5):
+        """
+        sets ```proxy.public_ip```, ```exit_fingerprint``` and ```latency```.
+        same signature as a ```HealthMonitor``` probe
+        """
+        start = time.monotonic()
+        try:
+            # leave the fallback some of the time
+            await asyncio.wait_for(
+                self.discover(proxy), timeout / 2 if self.fallback else timeout
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not self.fallback or not self.tor.running:
+                raise
+            log.debug("control port discovery for %s failed: %r" % (proxy, e))
+            from .utils import PublicIPService
+
+            self.fallbacks += 1
+            remaining = max(timeout - (time.monotonic() - start), 0.1)
+            return await PublicIPService.get_ip(proxy, timeout=remaining)
+        return proxy
+
+    async def discover(self, proxy):
+        from .tor import SOCKS5_RESOLVE
+        from .tor import SocksError
+        from .tor import _read_socks5_reply
+        from .tor import _socks5_request
+
+        controller = await self.tor.get_controller()
+        if not controller:
+            raise LookupError("no control connection")
+        await self._subscribe(controller)
+        loop = asyncio.get_running_loop()
+        reader, writer = await asyncio.open_connection(proxy.host, proxy.port)
+        source = "%s:%d" % writer.get_extra_info("sockname")[:2]
+        circuit = self._sources[source] = loop.create_future()
+        try:
+            credentials = proxy.credentials_for() or (None, None)
+            start = time.perf_counter()
+            writer.write(
+                _socks5_request(SOCKS5_RESOLVE, self.resolve_host, 0, *credentials)
+            )
+            try:
+                await _read_socks5_reply(reader)
+            except SocksError as e:
+                # a name which does not resolve still went over the circuit
+                if e.code is None:
+                    raise
+            latency = time.perf_counter() - start
+            circuit_id = await circuit
+        finally:
+            writer.close()
+            self._sources.pop(source, None)
+            for stream_id, fut in list(self._streams.items()):
+                if fut is circuit:
+                    del self._streams[stream_id]
+        fingerprint, address = await self.exit_of(controller, circuit_id)
+        self.lookups += 1
+        proxy._latency = latency
+        proxy.public_ip = address
+        proxy.exit_fingerprint = fingerprint
+        proxy._public_ip_provided_by = "control port"
+        return proxy
+
+    async def exit_of(self, controller, circuit_id: str) -> tuple[str, str]:
+        """
+        returns the fingerprint and address of the last hop of a circuit
+        """
+        status = (await controller.get_info("circuit-status"))["circuit-status"]
+        for line in status.splitlines():
+            fields = line.split()
+            if len(fields) >= 3 and fields[0] == circuit_id:
+                # $FINGERPRINT~nickname (or =nickname), the exit is the last hop
+                hop = fields[2].split(",")[-1]
+                fingerprint = hop.lstrip("$").replace("=", "~").split("~")[0]
+                break
+        else:
+            raise LookupError("circuit %s is not known" % circuit_id)
+        address = self._relays.get(fingerprint)
+        if address is None:
+            key = "ns/id/%s" % fingerprint
+            entry = (await controller.get_info(key))[key]
+            for line in entry.splitlines():
+                # r nickname identity digest date time address orport dirport
+                if line.startswith("r "):
+                    address = line.split()[6]
+                    break
+            else:
+                raise LookupError("no address for relay %s" % fingerprint)
+            self._relays[fingerprint] = address
+        return fingerprint, address
+
+    def close(self):
+        """
+        cancels the subscription and the lookups waiting for their circuit, see ```Tor.aclose```
+        """
+        if self._subscribing:
+            self._subscribing.cancel()
+            self._subscribing = None
+        for circuit in self._sources.values():
+            circuit.cancel()
+        self._sources.clear()
+        self._streams.clear()
+        self._controller = None
+
+    async def _subscribe(self, controller):
+        if self._controller is controller:
+            return
+        if self._subscribing is None:
+            self._subscribing = asyncio.ensure_future(
+                controller.add_event_listener(self._on_stream, "STREAM")
+            )
+            self._subscribing.add_done_callback(
+                functools.partial(self._on_subscribed, controller)
+            )
+        # a waiter which is cancelled does not cancel the subscription of the others
+        await asyncio.shield(self._subscribing)
+
+    def _on_subscribed(self, controller, task: asyncio.Future):
+        # runs before the waiters resume, and also when none of them is left
+        if self._subscribing is task:
+            self._subscribing = None
+        if task.cancelled():
+            return
+        if task.exception():
+            log.debug("could not subscribe to STREAM events: %r" % task.exception())
+            return
+        self._controller = controller
+
+    def _on_stream(self, event):
+        # 650 STREAM <id> <status> <circuit id> <target> [SOURCE_ADDR=...] ...
+        fields = event.args.split()
+        if len(fields) < 3:
+            return
+        stream_id, status, circuit_id = fields[:3]
+        circuit = self._streams.get(stream_id)
+        if circuit is None:
+            circuit = self._sources.get(event.keywords().get("SOURCE_ADDR"))
+            if circuit is None:
+                return
+            self._streams[stream_id] = circuit
+        if circuit.done():
+            return
+        if circuit_id != "0":
+            circuit.set_result(circuit_id)
+        elif status in ("FAILED", "CLOSED"):
+            circuit.set_exception(LookupError("stream %s %s" % (stream_id, status)))
+
+    def __repr__(self):
+        return "%s(lookups = %d, fallbacks = %d, relays = %d)" % (
+            self.__class__.__name__,
+            self.lookups,
+            self.fallbacks,
+            len(self._relays),
+        )
@@ -0,0 +1,389 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import mmap
+import os
+from pathlib import Path
+import re
+import time
+from typing import Optional
+from typing import Union
+
+import aiohttp
+
+__all__ = ["SegmentedDownload"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+log = logging.getLogger(__name__)
+
+_CONTENT_RANGE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)")
+
+
+class _Segment:
+    """
+    a byte range ```[pos, end)``` still to fetch. ```end``` shrinks when
+    another worker takes over the second half of it. ```rival``` is the segment
+    fetching the same range over another proxy, the one which finishes last is cancelled
+    """
+
+    __slots__ = ("pos", "end", "proxy", "started", "fetched", "rival", "fetch")
+
+    def __init__(self, pos: int, end: int):
+        self.pos = pos
+        self.end = end
+        self.proxy = None
+        self.started = 0.0
+        self.fetched = 0
+        self.rival: Optional[_Segment] = None
+        self.fetch: Optional[asyncio.Task] = None
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.pos
+
+    def speed(self, now: float) -> float:
+        """
+        bytes per second since the fetch started, 0 when unknown
+        """
+        elapsed = now - self.started
+        return self.fetched / elapsed if elapsed > 0 else 0.0
+
+    def eta(self, now: float) -> float:
+        speed = self.speed(now)
+        return self.remaining / speed if speed else float("inf")
+
+
+class SegmentedDownload:
+    """
+    downloads one url in byte ranges, fetched in parallel over different proxies,
+    since a single circuit rarely gets beyond a few hundred KB/s.
+
+    a first request for the first byte tells the size and whether the server serves ranges.
+    the file is then split in up to ```segments``` parts of at least ```min_segment``` bytes.
+    every part goes over a proxy the other parts are not using. a part which gets no data
+    for ```stall_timeout``` seconds is given up and continued from where it stopped over another proxy,
+    and a worker which is done takes over the end of the part which would finish last,
+    as much of it as its own speed is ahead. when that would be less than ```min_segment```,
+    the worker fetches the whole rest of that part too, if a fresh connection at its speed
+    would be done sooner, and the part which finishes last is cancelled.
+    the ranges carry ```If-Range```, so a file which changes in between fails the download
+    instead of mixing versions.
+
+    the data is written as it arrives, into a memory map of the file, which is preallocated
+    under ```<path>.part``` and renamed when complete, or into a ```bytearray``` without a path.
+    servers without ranges (or without a known size) are downloaded in a single stream.
+
+    use ```ClientSession.download```:
+
+        await session.download("https://example.com/big.iso", "big.iso", segments=8)
+
+    :param session: the ```ClientSession``` to use
+    :param url: the url to download
+    :param segments: (int) max parts in flight. default: one per proxy, at most 8
+    :param min_segment: (int) min bytes of a part
+    :param stall_timeout: (float) seconds without data before a part moves to another proxy
+    :param max_retries: (int) max failed or stalled parts before the download fails
+    :param kwargs: further arguments for every request, e.g. headers
+    """
+
+    def __init__(
+        self,
+        session,
+        url,
+        segments: int = None,
+        min_segment: int = 1 << 20,
+        stall_timeout: float = 10,
+        max_retries: int = 5,
+        **kwargs,
+    ):
+        self.session = session
+        self.url = url
+        self.scheduler = session.connector.scheduler
+        self.segments = segments or max(1, min(8, len(self.scheduler.proxies)))
+        self.min_segment = max(1, min_segment)
+        self.stall_timeout = stall_timeout
+        self.max_retries = max_retries
+        self.kwargs = kwargs
+        self.size: Optional[int] = None
+        self.ranges = False
+        self._validator: Optional[str] = None
+        self._pending: list[_Segment] = []
+        self._active: set[_Segment] = set()
+        self._avoid = set()
+        self._buffer = None
+        self.failures = 0
+        self.taken_over = 0
+        # seconds from a request to its first chunk, a moving average
+        self._first_byte: Optional[float] = None
+        self.proxies_used = set()
+
+    async def run(self, path: Union[str, Path, None] = None) -> Union[Path, bytearray]:
+        """
+        downloads to ```path``` and returns it, or returns the content without a path
+        """
+        probe = await self._probe(self._headers(0, 1))
+        if probe.status == 416:
+            # an empty file has no first byte
+            probe.release()
+            probe = await self._probe(self._headers())
+        try:
+            self._inspect(probe)
+            if not self.ranges:
+                log.debug("%s does not serve ranges, using a single stream" % self.url)
+                return await self._single(probe, path)
+        finally:
+            probe.release()
+        if path is None:
+            self._buffer = bytearray(self.size)
+            await self._fetch_all()
+            return self._buffer
+        path = Path(path)
+        part = path.with_name(path.name + ".part")
+        try:
+            with open(part, "w+b") as f:
+                if self.size:
+                    f.truncate(self.size)
+                    with mmap.mmap(f.fileno(), self.size) as self._buffer:
+                        await self._fetch_all()
+                        self._buffer.flush()
+                    self._buffer = None
+            os.replace(part, path)
+        except BaseException:
+            part.unlink(missing_ok=True)
+            raise
+        return path
+
+    def _inspect(self, resp):
+        resp.raise_for_status()
+        match = _CONTENT_RANGE.match(resp.headers.get("Content-Range", ""))
+        if resp.status == 206 and match and match.group(3) != "*":
+            self.ranges = True
+            self.size = int(match.group(3))
+            # a weak etag does not guarantee the same bytes
+            etag = resp.headers.get("ETag", "")
+            self._validator = (
+                etag if etag and not etag.startswith("W/") else None
+            ) or resp.headers.get("Last-Modified")
+        else:
+            self.size = resp.content_length
+
+    async def _single(self, resp, path) -> Union[Path, bytearray]:
+        if path is None:
+            buffer = bytearray()
+            async for chunk in resp.content.iter_any():
+                buffer += chunk
+            return buffer
+        path = Path(path)
+        part = path.with_name(path.name + ".part")
+        try:
+            with open(part, "wb") as f:
+                async for chunk in resp.content.iter_any():
+                    f.write(chunk)
+            os.replace(part, path)
+        except BaseException:
+            part.unlink(missing_ok=True)
+            raise
+        return path
+
+    async def _fetch_all(self):
+        count = max(1, min(self.segments, self.size // self.min_segment))
+        bounds = [self.size * i // count for i in range(count + 1)]
+        self._pending = [_Segment(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+        workers = [asyncio.ensure_future(self._worker()) for _ in range(count)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        log.debug(
+            "downloaded %s (%d bytes) over %d proxies, %d parts taken over, %d failures"
+            % (
+                self.url,
+                self.size,
+                len(self.proxies_used),
+                self.taken_over,
+                self.failures,
+            )
+        )
+
+    async def _worker(self):
+        speed = None
+        while True:
+            segment = self._next(speed)
+            if segment is None:
+                return
+            self._active.add(segment)
+            fetch = segment.fetch = asyncio.ensure_future(self._fetch(segment))
+            try:
+                # not awaited directly, since the rival of the segment may cancel it
+                await asyncio.wait([fetch])
+            finally:
+                fetch.cancel()
+                self._active.discard(segment)
+            if fetch.cancelled():
+                # the rival got the range first
+                continue
+            rival, segment.rival = segment.rival, None
+            if rival is not None:
+                rival.rival = None
+            e = fetch.exception()
+            if e is None:
+                speed = segment.speed(time.perf_counter())
+                if rival is not None and rival.fetch is not None:
+                    rival.end = rival.pos
+                    rival.fetch.cancel()
+                continue
+            if not isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError, OSError)):
+                raise e
+            self.failures += 1
+            speed = None
+            if segment.proxy is not None:
+                self._avoid.add(segment.proxy)
+            log.debug(
+                "part %d-%d of %s failed over %s: %r"
+                % (segment.pos, segment.end, self.url, segment.proxy, e)
+            )
+            if self.failures > self.max_retries:
+                raise e
+            if rival is None:
+                # continued from where it stopped, over another proxy
+                self._pending.append(segment)
+
+    def _next(self, speed: float = None) -> Optional[_Segment]:
+        """
+        returns the next part to fetch. when there is none left, a part of the segment
+        which would finish last is taken over, in proportion to the speed of this worker
+        (bytes/s of its last part) to the speed of that segment.
+        when that part would be less than ```min_segment```, the whole rest of the segment
+        is fetched a second time, if this worker would be done with it first
+        """
+        if self._pending:
+            return self._pending.pop(0)
+        now = time.perf_counter()
+        # a segment which is fetched twice already is left alone
+        slowest = max(
+            (s for s in self._active if s.rival is None),
+            key=lambda s: s.eta(now),
+            default=None,
+        )
+        if slowest is None or slowest.remaining <= 0:
+            return None
+        slow = slowest.speed(now)
+        share = speed / (speed + slow) if speed and slow else 0.5
+        middle = slowest.end - int(slowest.remaining * share)
+        if slowest.end - middle >= self.min_segment:
+            segment = _Segment(middle, slowest.end)
+            slowest.end = middle
+            self.taken_over += 1
+            return segment
+        if not speed or self._first_byte is None:
+            return None
+        if slowest.eta(now) <= self._first_byte + slowest.remaining / speed:
+            return None
+        segment = _Segment(slowest.pos, slowest.end)
+        segment.rival = slowest
+        slowest.rival = segment
+        self.taken_over += 1
+        return segment
+
+    def _proxy(self):
+        proxies = self.scheduler.proxies
+        busy = {s.proxy for s in self._active}
+        for candidates in (
+            [p for p in proxies if p not in busy and p not in self._avoid],
+            [p for p in proxies if p not in self._avoid],
+            proxies,
+        ):
+            if candidates:
+                return self.scheduler.pick(candidates)
+        return None
+
+    async def _fetch(self, segment: _Segment):
+        segment.proxy = self._proxy()
+        segment.started = time.perf_counter()
+        segment.fetched = 0
+        async with await self._request(
+            self._headers(segment.pos, segment.end), segment.proxy
+        ) as resp:
+            self.proxies_used.add(resp.proxy)
+            if resp.status != 206:
+                resp.raise_for_status()
+                raise aiohttp.ClientPayloadError(
+                    "%s changed during the download (status %d to a range request)"
+                    % (self.url, resp.status)
+                )
+            while segment.pos < segment.end:
+                chunk = await asyncio.wait_for(
+                    resp.content.readany(), self.stall_timeout
+                )
+                if not segment.fetched:
+                    self._observe_first_byte(time.perf_counter() - segment.started)
+                if not chunk:
+                    raise aiohttp.ClientPayloadError(
+                        "%s ended %d bytes early" % (self.url, segment.remaining)
+                    )
+                # the end moves when another worker took over a part of the segment
+                chunk = chunk[: segment.end - segment.pos]
+                self._buffer[segment.pos : segment.pos + len(chunk)] = chunk
+                segment.pos += len(chunk)
+                segment.fetched += len(chunk)
+
+    def _observe_first_byte(self, seconds: float):
+        if self._first_byte is None:
+            self._first_byte = seconds
+        else:
+            self._first_byte += (seconds - self._first_byte) / 4
+
+    def _headers(self, start: int = None, end: int = None) -> dict:
+        headers = dict(self.kwargs.get("headers") or {})
+        # ranges of a compressed response would be ranges of the compressed bytes
+        headers["Accept-Encoding"] = "identity"
+        if start is not None:
+            headers["Range"] = "bytes=%d-%d" % (start, end - 1)
+            if self._validator:
+                headers["If-Range"] = self._validator
+        return headers
+
+    async def _probe(self, headers: dict):
+        """
+        the first request, retried over another proxy when it fails or stalls
+        """
+        while True:
+            proxy = self._proxy()
+            try:
+                return await self._request(headers, proxy)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                self.failures += 1
+                self._avoid.add(proxy)
+                log.debug("probing %s over %s failed: %r" % (self.url, proxy, e))
+                if self.failures > self.max_retries:
+                    raise
+
+    async def _request(self, headers: dict, proxy=None):
+        from .integrations import _RequestSlot
+        from .integrations import _request_slot
+
+        token = _request_slot.set(_RequestSlot(proxies=[proxy] if proxy else None))
+        try:
+            return await asyncio.wait_for(
+                self.session.get(self.url, **dict(self.kwargs, headers=headers)),
+                self.stall_timeout,
+            )
+        finally:
+            _request_slot.reset(token)
+
+    def __repr__(self):
+        return "%s(%s, size = %s, ranges = %s, taken over = %d, failures = %d)" % (
+            self.__class__.__name__,
+            self.url,
+            self.size,
+            self.ranges,
+            self.taken_over,
+            self.failures,
+        )
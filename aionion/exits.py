@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import collections
+import itertools
+import math
+from typing import Iterable
+
+__all__ = ["ExitIndex", "exit_diversity"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+# bumped whenever the public ip of any proxy changes, see SocksProxy.public_ip
+_epoch = itertools.count(1)
+_current = 0
+
+
+def changed():
+    global _current
+    _current = next(_epoch)
+
+
+class ExitIndex:
+    """
+    groups proxies by their exit, the public ip found by ```PublicIPService```.
+    several socks ports often share an exit, so the number of groups is the
+    parallelism a rate limited target actually sees.
+
+    the groups are cached per list of proxies and only rebuilt when the list
+    or the public ip of a proxy changes.
+    """
+
+    def __init__(self):
+        self._cache = collections.OrderedDict()
+
+    def exits(self, proxies: list) -> dict:
+        """
+        returns ```{public ip: [proxies]}```. proxies with an unknown ip are left out
+        """
+        return self._lookup(proxies)[0]
+
+    def groups(self, proxies: list) -> list[list]:
+        """
+        returns the proxies grouped by exit. every proxy with an unknown ip
+        is a group of its own, since it may well have an exit of its own
+        """
+        return self._lookup(proxies)[1]
+
+    def _lookup(self, proxies: list) -> tuple:
+        ident = tuple(proxies)
+        cached = self._cache.get(ident)
+        if cached is not None and cached[0] == _current:
+            self._cache.move_to_end(ident)
+            return cached[1]
+        exits = {}
+        unknown = []
+        for proxy in proxies:
+            if proxy.public_ip:
+                exits.setdefault(proxy.public_ip, []).append(proxy)
+            else:
+                unknown.append([proxy])
+        result = exits, list(exits.values()) + unknown
+        self._cache[ident] = _current, result
+        if len(self._cache) > 8:
+            self._cache.popitem(last=False)
+        return result
+
+
+def exit_diversity(proxies: Iterable) -> dict:
+    """
+    describes how the proxies with a known public ip spread over the exits:
+
+        exits     - number of distinct exits
+        effective - effective number of exits (the exponential of the shannon entropy).
+                    equals ```exits``` when every exit has as many proxies,
+                    and drops towards 1 when most proxies share one exit
+        largest   - proxies on the most shared exit
+        known     - proxies with a known public ip
+    """
+    counts = collections.Counter(p.public_ip for p in proxies if p.public_ip)
+    known = sum(counts.values())
+    entropy = -sum(n / known * math.log(n / known) for n in counts.values())
+    return dict(
+        exits=len(counts),
+        effective=round(math.exp(entropy), 3) if known else 0,
+        largest=max(counts.values(), default=0),
+        known=known,
+    )
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+
+from . import utils
+from .metrics import collect
+from .scheduler import ProxyScheduler
+from .scheduler import create_scheduler
+from .tor import DEFAULT_PORT
+from .tor import Tor
+from .tor import TorRC
+from .tor import _check_requirements
+
+__all__ = ["TorFleet"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+log = logging.getLogger(__name__)
+
+FLEET_DATA_FOLDER = utils.APP_DATA / "fleet"
+
+
+class TorFleet(object):
+    """
+    a pool of tor processes, sharing the socks ports between them.
+
+    tor does most of its relay crypto on a single thread, so one process
+    serving all ports is bound to one cpu core. a fleet runs several processes,
+    each with its own (warm, reused) data directory, control port and share of the socks ports,
+    and exposes them as one list of proxies.
+
+    it can be used wherever a Tor instance is expected by the sessions:
+
+        fleet = await TorFleet(num_socks=40).start()
+        async with aionion.ClientSession(fleet) as session:
+            ...
+
+    :param num_socks: (int) total number of socks ports over all processes
+    :param num_instances: (int) number of tor processes. defaults to the number of cpu's,
+                          but never more than num_socks
+    :param start_port: (int) first port to try. each process gets its own port range
+    :param scheduler: see ```Tor```. the scheduler of the fleet spans all processes
+    :param health: see ```Tor```
+    :param breaker: see ```Tor```
+    :param autoscale: see ```Tor```. every process scales its own ports,
+                      so ```min_ports``` and ```max_ports``` are per process
+    :param max_per_exit: see ```Tor```. applies to the proxies of each process
+    :param ip_lookup: see ```Tor```
+    :param resolver: see ```Tor```. the fleet resolves over the DNSPort of its first process
+    """
+
+    def __init__(
+        self,
+        num_socks=15,
+        num_instances: int = None,
+        start_port=DEFAULT_PORT,
+        scheduler=None,
+        health=None,
+        breaker=None,
+        autoscale=None,
+        max_per_exit: int = None,
+        ip_lookup: str = "control",
+        resolver: dict = None,
+    ):
+        if not num_instances:
+            num_instances = os.cpu_count() or 1
+        num_instances = max(1, min(num_instances, num_socks))
+
+        self._num_socks = num_socks
+        self._start_port = start_port
+        self.instances: list[Tor] = []
+        for n in range(num_instances):
+            share = num_socks // num_instances + (n < num_socks % num_instances)
+            self.instances.append(
+                Tor(
+                    share,
+                    health=health,
+                    breaker=breaker,
+                    autoscale=autoscale,
+                    max_per_exit=max_per_exit,
+                    ip_lookup=ip_lookup,
+                    resolver=resolver,
+                )
+            )
+        self.scheduler: ProxyScheduler = create_scheduler(scheduler, self)
+        for tor in self.instances:
+            # sessions acquire from the fleet's scheduler, the processes drain,
+            # autoscale and spread their exits by its requests in flight
+            tor.scheduler.share(self.scheduler)
+        self.resolver = self.instances[0].resolver
+        self._proxies = []
+        self._versions = ()
+
+    @property
+    def running(self) -> bool:
+        return bool(self.instances) and all(t.running for t in self.instances)
+
+    @property
+    def proxies(self):
+        # only merged again when one of the registries changed
+        versions = tuple(tor.registry.version for tor in self.instances)
+        if versions != self._versions:
+            self._proxies = [p for tor in self.instances for p in tor.proxies]
+            self._versions = versions
+        return self._proxies
+
+    def stats(self) -> dict:
+        """
+        see ```Tor.stats```. covers the proxies of all processes
+        """
+        proxies = [p for tor in self.instances for p in tor.registry.all]
+        return collect(
+            proxies, [tor.registry for tor in self.instances], self.scheduler
+        )
+
+    def _configs(self) -> list[TorRC]:
+        configs = []
+        port = utils.free_port(self._start_port)
+        for tor in self.instances:
+            # warm data directories are reused between runs, see utils.DataDirectory
+            if not tor._data_directory:
+                tor._data_directory = utils.DataDirectory.claim(FLEET_DATA_FOLDER)
+            torrc = TorRC(
+                socks_ports=[port + i for i in range(tor._num_socks)],
+                data_directory=tor._data_directory.path,
+            )
+            configs.append(torrc)
+            # the next process starts after this one's control, dns and http tunnel port
+            port = utils.free_port(
+                max(torrc.http_tunnel_port, torrc.dns_port, torrc.control_port) + 1
+            )
+        return configs
+
+    async def start(self):
+        # make sure the binary is there before the processes race to download it
+        await asyncio.get_running_loop().run_in_executor(
+            Tor._EXECUTOR, _check_requirements
+        )
+        await asyncio.gather(
+            *[tor.start(torrc) for tor, torrc in zip(self.instances, self._configs())]
+        )
+        log.info("started %s" % self)
+        return self
+
+    def newnym(self) -> bool:
+        """
+        requests new circuits from every process without waiting for them, see ```Tor.newnym```.
+        returns True when at least one of them accepted the signal
+        """
+        results = [tor.newnym() for tor in self.instances]
+        self.scheduler.forget()
+        return any(results)
+
+    async def newnym_async(self) -> bool:
+        """
+        requests new circuits from every process.
+        returns True when at least one of them accepted the signal
+        """
+        results = await asyncio.gather(*[tor.newnym_async() for tor in self.instances])
+        self.scheduler.forget()
+        return any(results)
+
+    def stop(self):
+        for tor in self.instances:
+            if tor.process:
+                tor.stop()
+
+    async def aclose(self):
+        """
+        stops every process and waits until they exited, see ```Tor.aclose```
+        """
+        await asyncio.gather(*[tor.aclose() for tor in self.instances if tor.process])
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} < running {self.running}, instances: {len(self.instances)}, socksports: {self._num_socks} >"
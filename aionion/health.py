@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import asyncio
+from enum import Enum
+import logging
+import random
+import time
+from typing import Awaitable
+from typing import Callable
+from typing import Iterable
+from typing import Optional
+
+__all__ = ["ProxyState", "ProxyHealth", "ProxyRegistry", "HealthMonitor"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+log = logging.getLogger(__name__)
+
+
+class ProxyState(Enum):
+    UNKNOWN = "unknown"
+    HEALTHY = "healthy"
+    DEGRADED = "degraded"
+    DEAD = "dead"
+
+
+class ProxyHealth:
+    """
+    health record of a single proxy, kept by the registry
+    """
+
+    __slots__ = ("state", "failures", "last_check", "next_check", "last_error")
+
+    def __init__(self):
+        self.state = ProxyState.UNKNOWN
+        self.failures = 0
+        self.last_check = 0.0
+        self.next_check = 0.0
+        self.last_error: Optional[BaseException] = None
+
+    def __repr__(self):
+        return "%s(state = %s, failures = %d)" % (
+            self.__class__.__name__,
+            self.state.value,
+            self.failures,
+        )
+
+
+class ProxyRegistry:
+    """
+    the set of proxies of a tor instance, indexed by (host, port).
+
+    ```proxies``` is the list to pick from: every proxy which is not dead
+    (or all of them, when all are dead) and not being drained. it is rebuilt only
+    when a proxy is added, removed or changes state, so reading it is O(1).
+    """
+
+    def __init__(self):
+        self._index: dict[tuple, object] = {}
+        self._health: dict[tuple, ProxyHealth] = {}
+        self._draining: set[tuple] = set()
+        self._proxies: list = []
+        self.version = 0
+
+    @property
+    def proxies(self) -> list:
+        return self._proxies
+
+    @property
+    def all(self) -> list:
+        return list(self._index.values())
+
+    def get(self, host: str, port: int):
+        return self._index.get((host, int(port)))
+
+    def health(self, proxy) -> Optional[ProxyHealth]:
+        return self._health.get(tuple(proxy))
+
+    def state(self, proxy) -> Optional[ProxyState]:
+        health = self.health(proxy)
+        return health.state if health else None
+
+    def draining(self, proxy) -> bool:
+        return tuple(proxy) in self._draining
+
+    def drain(self, proxies: Iterable):
+        """
+        stops handing out ```proxies```, which are about to be removed.
+        requests already using them are not affected
+        """
+        self._draining.update(tuple(p) for p in proxies if tuple(p) in self._index)
+        self._rebuild()
+
+    def sync(self, proxies: Iterable):
+        """
+        replaces the registered proxies, keeping the existing objects
+        (and their health) for the ones which are already known
+
+        :param proxies: SocksProxy instances, or anything iterable as (host, port)
+        :return: (list) the proxies which were not registered before
+        """
+        index = {}
+        for proxy in proxies:
+            key = tuple(proxy)
+            index[key] = self._index.get(key, proxy)
+        self._health = {key: self._health.get(key) or ProxyHealth() for key in index}
+        added = [proxy for key, proxy in index.items() if key not in self._index]
+        self._index = index
+        self._draining &= index.keys()
+        self._rebuild()
+        return added
+
+    def set_state(self, proxy, state: ProxyState):
+        health = self.health(proxy)
+        if not health or health.state is state:
+            return
+        log.debug("%s is %s" % (proxy, state.value))
+        health.state = state
+        self._rebuild()
+
+    def clear(self):
+        self.sync([])
+
+    def _rebuild(self):
+        usable = {
+            key: proxy
+            for key, proxy in self._index.items()
+            if key not in self._draining
+        }
+        alive = [
+            proxy
+            for key, proxy in usable.items()
+            if self._health[key].state is not ProxyState.DEAD
+        ]
+        self._proxies = alive or list(usable.values()) or list(self._index.values())
+        self.version += 1
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self.all)
+
+    def __repr__(self):
+        counts = {}
+        for health in self._health.values():
+            counts[health.state.value] = counts.get(health.state.value, 0) + 1
+        return "%s(%s)" % (
+            self.__class__.__name__,
+            ", ".join("%s: %d" % kv for kv in counts.items()),
+        )
+
+
+async def _lookup_ip(proxy, timeout):
+    from .utils import PublicIPService
+
+    # a probe has to go through the proxy, an answer from the cache says nothing about it
+    return await PublicIPService.get_ip(proxy, timeout=timeout, cached=False)
+
+
+class HealthMonitor:
+    """
+    probes the proxies of a registry in the background.
+
+    every proxy is checked when it is added and then every ```interval``` seconds.
+    a failed probe marks it degraded, ```dead_after``` failures in a row dead.
+    failing proxies are retried with an exponential backoff, capped at ```max_backoff```.
+    all delays get some random jitter, so the probes do not come in bursts,
+    and at most ```concurrency``` probes run at the same time.
+
+    :param registry: (ProxyRegistry) the proxies to watch
+    :param probe: async callable(proxy, timeout), raising on failure.
+                  default: a public ip lookup, which also sets ```proxy.public_ip``` and ```latency```
+    :param interval: (float) seconds between checks of a healthy proxy
+    :param concurrency: (int) max probes running at the same time
+    :param timeout: (float) seconds before a probe fails
+    :param backoff: (float) first retry delay after a failure
+    :param max_backoff: (float) max retry delay
+    :param dead_after: (int) failures in a row before a proxy is considered dead
+    :param jitter: (float) fraction of every delay to randomize
+    :param on_check: optional callable(proxy, state), called after every probe
+    """
+
+    def __init__(
+        self,
+        registry: ProxyRegistry,
+        probe: Callable[..., Awaitable] = None,
+        interval: float = 300,
+        concurrency: int = 4,
+        timeout: float = 5,
+        backoff: float = 1,
+        max_backoff: float = 120,
+        dead_after: int = 3,
+        jitter: float = 0.2,
+        on_check: Callable = None,
+    ):
+        self.registry = registry
+        self.probe = probe or _lookup_ip
+        self.interval = interval
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.dead_after = dead_after
+        self.jitter = jitter
+        self.on_check = on_check
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._checking = set()
+
+    @property
+    def running(self) -> bool:
+        return bool(self._task) and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def stop(self) -> Optional[asyncio.Task]:
+        """
+        cancels the loop and returns its task, to be awaited by whoever wants it finished
+        """
+        task, self._task = self._task, None
+        if task:
+            task.cancel()
+        return task
+
+    def recheck(self, proxies: Iterable = None):
+        """
+        schedules the given proxies (default: all) to be probed right away,
+        for example after new circuits were requested
+        """
+        for proxy in self.registry.all if proxies is None else proxies:
+            health = self.registry.health(proxy)
+            if health:
+                health.next_check = 0
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def check(self, proxy) -> ProxyState:
+        """
+        probes a proxy now and returns its new state
+        """
+        health = self.registry.health(proxy)
+        try:
+            await asyncio.wait_for(self.probe(proxy, self.timeout), self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not health:
+                return None
+            health.failures += 1
+            health.last_error = e
+            delay = min(self.backoff * 2 ** (health.failures - 1), self.max_backoff)
+            state = (
+                ProxyState.DEAD
+                if health.failures >= self.dead_after
+                else ProxyState.DEGRADED
+            )
+            log.debug("probe of %s failed (%d): %r" % (proxy, health.failures, e))
+        else:
+            if not health:
+                return None
+            health.failures = 0
+            health.last_error = None
+            delay = self.interval
+            state = ProxyState.HEALTHY
+        health.last_check = time.monotonic()
+        health.next_check = health.last_check + self._jittered(delay)
+        self.registry.set_state(proxy, state)
+        if self.on_check:
+            self.on_check(proxy, state)
+        return state
+
+    def _jittered(self, delay: float) -> float:
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    async def _check(self, proxy, semaphore: asyncio.Semaphore):
+        try:
+            async with semaphore:
+                await self.check(proxy)
+        finally:
+            self._checking.discard(tuple(proxy))
+            self._wakeup.set()
+
+    async def _run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        try:
+            while True:
+                now = time.monotonic()
+                wait = self.interval
+                for proxy in self.registry.all:
+                    key = tuple(proxy)
+                    health = self.registry.health(proxy)
+                    if key in self._checking or not health:
+                        continue
+                    if health.next_check <= now:
+                        self._checking.add(key)
+                        task = asyncio.ensure_future(self._check(proxy, semaphore))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                    else:
+                        wait = min(wait, health.next_check - now)
+                self._wakeup.clear()
+                try:
+                    # wake up for the next due check, a recheck() or a finished probe
+                    await asyncio.wait_for(self._wakeup.wait(), max(wait, 0.05))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._checking.clear()
+
+    def __repr__(self):
+        return "%s(running = %s, %r)" % (
+            self.__class__.__name__,
+            self.running,
+            self.registry,
+        )
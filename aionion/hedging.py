@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import collections
+import threading
+from typing import Optional
+from typing import Union
+
+__all__ = ["HedgePolicy", "create_hedging"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+class HedgePolicy:
+    """
+    decides when a request gets a second attempt over another circuit.
+
+    when the first attempt has not answered after ```delay()``` seconds
+    (the ```percentile``` of the recently observed latencies), the same request
+    is sent through a different proxy. the first response wins, the other attempt is cancelled.
+
+    hedges are paid from a budget: every request adds ```budget``` tokens,
+    every hedge costs one, so at most ```budget``` (e.g. 5%) extra requests are sent,
+    plus a burst of ```burst``` hedges.
+
+    only requests with an idempotent method and a body which can be sent twice are hedged.
+
+    :param percentile: (float) latency percentile after which to hedge
+    :param budget: (float) max extra requests, as a share of all requests
+    :param burst: (float) max hedges which can be saved up
+    :param initial_delay: (float) delay to use until ```min_samples``` latencies are known
+    :param min_delay: (float) never hedge sooner than this
+    :param window: (int) number of recent latencies the percentile is taken from
+    :param methods: the http methods which may be hedged
+    """
+
+    IDEMPOTENT = ("GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE")
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        budget: float = 0.05,
+        burst: float = 10,
+        initial_delay: float = 1.0,
+        min_delay: float = 0.05,
+        window: int = 1000,
+        min_samples: int = 20,
+        methods=IDEMPOTENT,
+    ):
+        self.percentile = percentile
+        self.budget = budget
+        self.burst = burst
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.methods = frozenset(m.upper() for m in methods)
+        self._latencies = collections.deque(maxlen=window)
+        self._delay = initial_delay
+        self._stale = 0
+        self._tokens = burst
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def applies(self, method: str, data=None) -> bool:
+        """
+        returns True when a request may be hedged
+        """
+        if method.upper() not in self.methods:
+            return False
+        # a stream or file can only be sent once
+        return data is None or isinstance(data, (bytes, str, dict, list, tuple))
+
+    def delay(self) -> float:
+        """
+        seconds to wait for the first attempt before hedging
+        """
+        with self._lock:
+            if self._stale and len(self._latencies) >= self.min_samples:
+                # the percentile is recalculated lazily, at most once per 10% new samples
+                if self._stale >= max(1, len(self._latencies) // 10):
+                    ordered = sorted(self._latencies)
+                    idx = int(len(ordered) * self.percentile / 100)
+                    self._delay = ordered[min(idx, len(ordered) - 1)]
+                    self._stale = 0
+            return max(self._delay, self.min_delay)
+
+    def observe(self, latency: float):
+        """
+        records the latency of an attempt (up to the response headers)
+        """
+        with self._lock:
+            self._latencies.append(latency)
+            self._stale += 1
+
+    def request(self):
+        """
+        accounts a hedgeable request, which adds to the budget
+        """
+        with self._lock:
+            self.requests += 1
+            self._tokens = min(self.burst, self._tokens + self.budget)
+
+    def try_hedge(self) -> bool:
+        """
+        takes a hedge from the budget. returns False when the budget is used up
+        """
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self.hedged += 1
+            return True
+
+    def won(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    def stats(self) -> dict:
+        return dict(
+            requests=self.requests,
+            hedged=self.hedged,
+            hedge_wins=self.hedge_wins,
+            delay=round(self.delay(), 6),
+        )
+
+    def __repr__(self):
+        return "%s(p%s, budget = %s, requests = %d, hedged = %d, wins = %d)" % (
+            self.__class__.__name__,
+            self.percentile,
+            self.budget,
+            self.requests,
+            self.hedged,
+            self.hedge_wins,
+        )
+
+
+def create_hedging(
+    hedging: Union[bool, float, HedgePolicy, None] = None,
+) -> Optional[HedgePolicy]:
+    """
+    returns ```hedging``` when it is a HedgePolicy already, a default policy for True,
+    a policy with ```hedging``` as budget for a number, or None when hedging is off
+    """
+    if isinstance(hedging, HedgePolicy) or not hedging:
+        return hedging or None
+    if hedging is True:
+        return HedgePolicy()
+    return HedgePolicy(budget=float(hedging))
@@ -0,0 +1,465 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+from html.parser import HTMLParser
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import re
+import shutil
+import ssl
+import sys
+import tarfile
+import tempfile
+import time
+from typing import Callable
+from typing import Optional
+from typing import Union
+import urllib.parse
+from urllib.request import urlopen
+
+from . import utils
+
+__all__ = ["TorInstaller", "InstallError", "Release"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 16
+CHECKSUM_FILES = ("sha256sums-signed-build.txt", "sha256sums-unsigned-build.txt")
+_RELEASE = re.compile(r"(\d+(?:\.\d+)*)/?")
+_PLATFORMS = {"windows": ("windows",), "osx": ("macos", "osx"), "linux": ("linux",)}
+_ARCHES = {"amd64": "x86_64", "arm64": "aarch64", "x86": "i686", "i386": "i686"}
+
+
+class InstallError(RuntimeError):
+    """
+    no release to install was found, or the archive does not match its checksum
+    """
+
+
+class Release:
+    """
+    an expert bundle of a tor release
+
+    :param version: (str) e.g. "13.5.1"
+    :param name: (str) file name of the archive
+    :param url: (str) where to get it, a url or a local path
+    :param sha256: (str) the published checksum, None when there is none
+    """
+
+    __slots__ = ("version", "name", "url", "sha256")
+
+    def __init__(self, version: str, name: str, url: str, sha256: str = None):
+        self.version = version
+        self.name = name
+        self.url = url
+        self.sha256 = sha256
+
+    def as_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __repr__(self):
+        return "%s(%s, %s, sha256 = %s)" % (
+            self.__class__.__name__,
+            self.version,
+            self.name,
+            self.sha256,
+        )
+
+
+class _Links(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            href = dict(attrs).get("href")
+            if href:
+                self.links.append(href)
+
+
+class TorInstaller:
+    """
+    installs the tor expert bundle.
+
+    the newest stable release is found on the index pages of ```mirror```, and its archive is
+    streamed to disk while its sha256 is computed, and checked against the published
+    ```sha256sums-*-build.txt``` of the release. archives are kept in ```cache_dir``` by their sha256,
+    next to the tree they extract to, and the release found is remembered for ```index_ttl``` seconds.
+    so installing again (e.g. in every container of a fleet sharing the cache directory)
+    neither reads the index pages nor downloads anything, and copies the extracted tree.
+
+    ```mirror``` may also be a local directory laid out like dist.torproject.org/torbrowser
+    (```<version>/tor-expert-bundle-*.tar.gz``` and its checksums), and ```install(archive=...)```
+    installs a local archive, for offline installs.
+
+        TorInstaller(cache_dir="/shared/aionion").install()
+        TorInstaller(mirror="/mnt/tor-mirror").install(version="13.5.1")
+
+    the defaults of ```cache_dir``` and ```mirror``` can be set with the environment variables
+    ```AIONION_TOR_CACHE``` and ```AIONION_TOR_MIRROR```.
+
+    :param cache_dir: (str, Path) directory of the archives and extracted trees
+    :param mirror: (str, Path) base url or directory of the releases
+    :param index_ttl: (float) seconds the release found on the index pages is reused
+    :param verify: (bool) refuse archives without a published or given checksum
+    :param progress: optional callable(bytes done, total bytes or None), called while downloading.
+                     by default the progress is logged every 10%
+    :param ssl_context: optional ```ssl.SSLContext``` for https mirrors
+    """
+
+    def __init__(
+        self,
+        cache_dir: Union[str, Path] = None,
+        mirror: Union[str, Path] = None,
+        index_ttl: float = 86400,
+        verify: bool = True,
+        progress: Callable[[int, Optional[int]], None] = None,
+        ssl_context: ssl.SSLContext = None,
+    ):
+        self.cache_dir = Path(
+            cache_dir or os.environ.get("AIONION_TOR_CACHE") or utils.APP_DATA / "cache"
+        ).expanduser()
+        self.mirror = str(
+            mirror or os.environ.get("AIONION_TOR_MIRROR") or utils.URL_BASE
+        )
+        self.index_ttl = index_ttl
+        self.verify = verify
+        self.progress = progress
+        self.ssl_context = ssl_context
+        self.downloaded = 0
+
+    @property
+    def archives(self) -> Path:
+        return self.cache_dir / "archives"
+
+    @property
+    def versions(self) -> Path:
+        return self.cache_dir / "versions"
+
+    def install(
+        self,
+        output_dir: Union[str, Path] = None,
+        version: str = None,
+        archive: Union[str, Path] = None,
+        sha256: str = None,
+    ) -> Path:
+        """
+        installs into ```output_dir``` (default: ```utils.TOR_BIN_FOLDER```) and returns the path
+        of the tor executable
+
+        :param version: (str) the release to install. default: the newest stable one
+        :param archive: (str, Path) a local archive to install instead. it is verified with ```sha256```,
+                        or with the checksums file next to it
+        :param sha256: (str) the expected checksum of the archive
+        """
+        output_dir = Path(output_dir or utils.TOR_BIN_FOLDER)
+        if archive is not None:
+            name = Path(archive).name
+            archive = self._add_archive(Path(archive), sha256)
+        else:
+            release = self.release(version)
+            if sha256:
+                release.sha256 = sha256.lower()
+            name = release.name
+            archive = self.fetch(release)
+        tree = self.extract(archive)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        shutil.copytree(tree, output_dir, symlinks=True, dirs_exist_ok=True)
+        executable = output_dir / "tor" / ("tor.exe" if utils.WIN else "tor")
+        if not executable.exists():
+            raise InstallError("%s has no tor executable" % archive)
+        log.info("installed %s to %s" % (name, output_dir))
+        return executable
+
+    def release(self, version: str = None) -> Release:
+        """
+        returns the release of ```version``` (default: the newest stable one),
+        from the cached index when it is recent enough
+        """
+        key = "%s|%s|%s" % (self.mirror, utils.URL_PLAT_NAME, version or "latest")
+        index = self._read_index()
+        entry = index.get(key)
+        if entry and time.time() - entry["checked"] < self.index_ttl:
+            return Release(**entry["release"])
+        if version is None:
+            version = self._latest_version()
+        base = self._join(self.mirror, version + "/")
+        names = self._list(base)
+        name = self._pick_bundle(names)
+        if name is None:
+            raise InstallError(
+                "no expert bundle for %s in %s" % (utils.URL_PLAT_NAME, base)
+            )
+        release = Release(version, name, self._join(base, name))
+        release.sha256 = self._published_checksum(base, names, name)
+        index[key] = dict(checked=time.time(), release=release.as_dict())
+        self._write_index(index)
+        return release
+
+    def fetch(self, release: Release) -> Path:
+        """
+        returns the cached archive of ```release```, downloading and verifying it when it is not cached
+        """
+        if release.sha256:
+            cached = self.archives / (release.sha256 + ".tar.gz")
+            if cached.exists():
+                log.debug("%s is cached as %s" % (release.name, cached))
+                return cached
+        elif self.verify:
+            raise InstallError(
+                "%s has no published checksum. pass sha256 or verify=False"
+                % release.name
+            )
+        self.archives.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.archives, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                digest = self._download(release.url, f)
+            if release.sha256 and digest != release.sha256:
+                raise InstallError(
+                    "%s does not match its checksum (%s, expected %s)"
+                    % (release.name, digest, release.sha256)
+                )
+            cached = self.archives / (digest + ".tar.gz")
+            os.replace(tmp, cached)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        return cached
+
+    def extract(self, archive: Path) -> Path:
+        """
+        returns the extracted tree of a cached archive, extracting it once
+        """
+        tree = self.versions / archive.name.split(".")[0]
+        if tree.exists():
+            return tree
+        self.versions.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=self.versions, suffix=".part"))
+        try:
+            with tarfile.open(archive) as tf:
+                _safe_extract(tf, tmp)
+            # another process may have extracted it meanwhile
+            os.rename(tmp, tree)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not tree.exists():
+                raise
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return tree
+
+    def clear(self):
+        """
+        removes the cached archives, trees and index
+        """
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _add_archive(self, path: Path, sha256: str = None) -> Path:
+        expected = sha256.lower() if sha256 else None
+        if expected is None:
+            names = [p.name for p in path.parent.iterdir()]
+            expected = self._published_checksum(str(path.parent), names, path.name)
+        if expected is None and self.verify:
+            raise InstallError("no checksum for %s. pass sha256 or verify=False" % path)
+        if expected and (self.archives / (expected + ".tar.gz")).exists():
+            return self.archives / (expected + ".tar.gz")
+        return self.fetch(Release("local", path.name, str(path), expected))
+
+    def _latest_version(self) -> str:
+        versions = []
+        for name in self._list(self.mirror):
+            match = _RELEASE.fullmatch(name)
+            if match:
+                versions.append(match.group(1))
+        if not versions:
+            raise InstallError("no releases found in %s" % self.mirror)
+        return max(versions, key=lambda v: tuple(int(n) for n in v.split(".")))
+
+    @staticmethod
+    def _pick_bundle(names: list) -> Optional[str]:
+        platforms = _PLATFORMS.get(utils.URL_PLAT_NAME, (utils.URL_PLAT_NAME,))
+        machine = platform.machine().lower()
+        arch = _ARCHES.get(machine, machine)
+        bundles = [
+            name
+            for name in names
+            if "expert-bundle" in name
+            and name.endswith(".tar.gz")
+            and any(p in name for p in platforms)
+        ]
+        for wanted in (arch, "64"):
+            for name in bundles:
+                if wanted in name:
+                    return name
+        return None
+
+    def _published_checksum(self, base: str, names: list, name: str) -> Optional[str]:
+        for checksums in CHECKSUM_FILES:
+            if checksums not in names:
+                continue
+            with self._open(self._join(base, checksums)) as (f, _):
+                for line in f.read().decode().splitlines():
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1].lstrip("*") == name:
+                        return parts[0].lower()
+        return None
+
+    def _download(self, url: str, f) -> str:
+        digest = hashlib.sha256()
+        done = logged = 0
+        with self._open(url) as (source, total):
+            log.info("fetching %s (%s bytes)" % (url, total or "unknown"))
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                digest.update(chunk)
+                done += len(chunk)
+                if self.progress is not None:
+                    self.progress(done, total)
+                elif total and done * 10 // total > logged:
+                    logged = done * 10 // total
+                    log.info("fetched %d%% of %s" % (logged * 10, url))
+        self.downloaded += done
+        return digest.hexdigest()
+
+    def _list(self, location: str) -> list[str]:
+        """
+        the entries of a directory, or the links of an index page. directories end with a slash
+        """
+        if not _is_url(location):
+            return [
+                p.name + "/" if p.is_dir() else p.name for p in Path(location).iterdir()
+            ]
+        with self._open(location) as (f, _):
+            parser = _Links()
+            parser.feed(f.read().decode(errors="replace"))
+        links = []
+        for href in parser.links:
+            path = urllib.parse.urlsplit(href).path
+            # relative links of the page itself only
+            if path and not path.startswith(("/", "..")) and "://" not in href:
+                links.append(urllib.parse.unquote(path))
+        return links
+
+    def _open(self, location: str):
+        return _Source(location, self.ssl_context)
+
+    @staticmethod
+    def _join(base: str, name: str) -> str:
+        if _is_url(base):
+            return urllib.parse.urljoin(
+                base if base.endswith("/") else base + "/", name
+            )
+        return os.path.join(base, name)
+
+    def _read_index(self) -> dict:
+        try:
+            return json.loads((self.cache_dir / "index.json").read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index: dict):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, self.cache_dir / "index.json")
+
+    def __repr__(self):
+        return "%s(%s, cache = %s)" % (
+            self.__class__.__name__,
+            self.mirror,
+            self.cache_dir,
+        )
+
+
+class _Source:
+    """
+    opens a url or a local file, as ```(file object, size or None)```
+    """
+
+    def __init__(self, location: str, ssl_context: ssl.SSLContext = None):
+        self.location = location
+        self.ssl_context = ssl_context
+        self._f = None
+
+    def __enter__(self):
+        if _is_url(self.location):
+            context = self.ssl_context
+            if context is None and self.location.startswith("https:"):
+                context = ssl.create_default_context()
+            self._f = urlopen(self.location, context=context)
+            length = self._f.headers.get("Content-Length")
+            return self._f, int(length) if length else None
+        self._f = open(self.location, "rb")
+        return self._f, os.fstat(self._f.fileno()).st_size
+
+    def __exit__(self, *exc):
+        self._f.close()
+
+
+def _is_url(location: str) -> bool:
+    return urllib.parse.urlsplit(location).scheme in ("http", "https")
+
+
+def _safe_extract(tf: tarfile.TarFile, path: Path):
+    if hasattr(tarfile, "data_filter"):
+        tf.extractall(path, filter="data")
+        return
+    root = path.resolve()
+    for member in tf.getmembers():
+        target = (path / member.name).resolve()
+        if root != target and root not in target.parents:
+            raise InstallError("%s leaves the archive directory" % member.name)
+        if member.issym() or member.islnk():
+            link = (target.parent / member.linkname).resolve()
+            if root not in link.parents:
+                raise InstallError("%s links outside of the archive" % member.name)
+    tf.extractall(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m aionion.installer",
+        description="installs the tor expert bundle",
+    )
+    parser.add_argument("--output", help="install directory")
+    parser.add_argument("--version", help="release to install, default the newest")
+    parser.add_argument("--archive", help="install a local archive instead")
+    parser.add_argument("--sha256", help="expected checksum of the archive")
+    parser.add_argument("--mirror", help="base url or directory of the releases")
+    parser.add_argument("--cache", help="cache directory")
+    parser.add_argument("--no-verify", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    installer = TorInstaller(
+        cache_dir=args.cache, mirror=args.mirror, verify=not args.no_verify
+    )
+    try:
+        executable = installer.install(
+            args.output, args.version, args.archive, args.sha256
+        )
+    except (InstallError, OSError) as e:
+        log.error(e)
+        return 1
+    print(executable)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
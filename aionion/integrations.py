@@ -1,20 +1,20 @@
 import asyncio
-import itertools
+import collections
+import functools
+import contextvars
 import json
 import logging
+from pathlib import Path
+import time
 
 from ssl import SSLContext
-from itertools import cycle
 
 from types import SimpleNamespace
 
 from typing import Any
-from typing import Callable
-from typing import IO
+from typing import AsyncIterator
 from typing import List
-from typing import MutableMapping
 from typing import Optional
-from typing import Text
 from typing import Tuple
 from typing import Type
 from typing import Union
@@ -22,7 +22,10 @@ from typing import Iterable
 from typing import Mapping
 
 from aiohttp import BasicAuth
-from aiohttp import ClientRequest as ClientRequest
+from aiohttp import RequestInfo
+from aiohttp import StreamReader
+from aiohttp.base_protocol import BaseProtocol
+from aiohttp import ClientRequest as _ClientRequest
 from aiohttp import ClientResponse
 from aiohttp import ClientTimeout
 from aiohttp import ClientWebSocketResponse as ClientWebSocketResponse
@@ -32,40 +35,245 @@ from aiohttp import HttpVersion11
 from aiohttp import TraceConfig
 from aiohttp.abc import AbstractCookieJar
 from aiohttp.client import ClientSession as _ClientSession
+from aiohttp.client_exceptions import ClientConnectorCertificateError
+from aiohttp.client_exceptions import ClientConnectorSSLError
+from aiohttp.client_exceptions import cert_errors
+from aiohttp.client_exceptions import ssl_errors
+from aiohttp.client_proto import ResponseHandler
+from aiohttp.client_reqrep import ConnectionKey
+from aiohttp.connector import Connection
+from aiohttp.helpers import ceil_timeout
 from aiohttp.helpers import sentinel
 from aiohttp.typedefs import JSONEncoder
 from aiohttp.typedefs import LooseCookies
 from aiohttp.typedefs import LooseHeaders
 from aiohttp.typedefs import StrOrURL
 from aiohttp_socks.connector import ProxyConnector as _ProxyConnector
+from multidict import CIMultiDict
+from multidict import CIMultiDictProxy
+from multidict import MultiDict
 from aiohttp_socks.connector import ProxyType as _ProxyType
-
-import requests.auth
+from python_socks.async_.asyncio.v2 import Proxy as _SocksClient
+from yarl import URL
 
 import aionion
+from aionion.cache import CacheEntry
+from aionion.cache import HttpCache
+from aionion.cache import create_cache
+from aionion.download import SegmentedDownload
+from aionion.hedging import HedgePolicy
+from aionion.hedging import create_hedging
+from aionion.isolation import CircuitIsolation
+from aionion.isolation import create_isolation
+from aionion.resolver import TorResolver
+from aionion.scheduler import ProxyScheduler
+from aionion.scheduler import create_scheduler
+from aionion.tracing import RequestTracer
+from aionion.tracing import create_tracer
+from aionion.utils import _request_args
 from aionion.tor import Tor
 
-
 log = logging.getLogger(__name__)
 
-__all__ = ["log", "ClientSession", "RequestsSession", "ClientRequest", "ClientResponse"]
+__all__ = [
+    "log",
+    "ClientSession",
+    "RequestsSession",
+    "ClientRequest",
+    "ClientResponse",
+    "ProxyConnectTor",
+]
 
 
 def __getattr__(name):
+    if name == "RequestsSession":
+        # requests is only imported by the sessions using it
+        from aionion.requestsession import RequestsSession
+
+        return RequestsSession
     if name not in __all__:
         raise AttributeError(name)
 
 
+class _RequestSlot:
+    """
+    holds the proxy acquired from the scheduler for one ClientSession request,
+    and the socks credentials to isolate its circuit with.
+    redirects of the same request stay on the same proxy and circuit.
+    ```proxies``` optionally restricts the proxies the scheduler may pick from.
+    ```phases``` collects the phase timings when the request is traced (see ```RequestTracer```).
+    ```affinity_key``` routes the request when the scheduler has affinity, instead of the host.
+    """
+
+    __slots__ = ("proxy", "credentials", "proxies", "phases", "affinity_key")
+
+    def __init__(self, credentials: Tuple[str, str] = None, proxies: list = None):
+        self.proxy = None
+        self.credentials = credentials
+        self.proxies = proxies
+        self.phases = None
+        self.affinity_key = None
+
+
+# the slot of the ClientSession request running in the current task.
+# set by ClientSession._request, filled in when the connector picks a proxy.
+# a fresh slot set by the caller (ClientSession.fetch_many) is used as is.
+_request_slot = contextvars.ContextVar("aionion_request_slot", default=None)
+
+
+def _replay(body: bytes, loop: asyncio.AbstractEventLoop) -> StreamReader:
+    """
+    a stream holding ```body```, for the ```content``` of a response whose body was read
+    """
+    stream = StreamReader(BaseProtocol(loop), 2**16, loop=loop)
+    if body:
+        stream.feed_data(body)
+    stream.feed_eof()
+    return stream
+
+
+class ClientRequest(_ClientRequest):
+    """
+    ```aiohttp.ClientRequest``` which keys pooled connections by the proxy
+    and socks credentials it was sent through, so a keep-alive connection
+    is only ever reused on the same circuit.
+    """
+
+    socks_proxy = None
+    socks_credentials = None
+
+    @property
+    def connection_key(self) -> ConnectionKey:
+        key = super().connection_key
+        if self.socks_proxy is None:
+            return key
+        return ConnectionKey(
+            key.host,
+            key.port,
+            key.is_ssl,
+            key.ssl,
+            self.socks_proxy,
+            BasicAuth(*self.socks_credentials) if self.socks_credentials else None,
+            key.proxy_headers_hash,
+        )
+
+
+class _MeteredTransport:
+    """
+    wraps the transport of a pooled connection to count the bytes sent
+    """
+
+    __slots__ = ("_transport", "_protocol")
+
+    def __init__(self, transport: asyncio.Transport, protocol: "_MeteredHandler"):
+        self._transport = transport
+        self._protocol = protocol
+
+    def write(self, data):
+        self._protocol.on_write(len(data))
+        self._transport.write(data)
+
+    def writelines(self, list_of_data):
+        for data in list_of_data:
+            self.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
+
+
+class _MeteredHandler(ResponseHandler):
+    """
+    ```ResponseHandler``` feeding the metrics of the proxy it is connected through:
+    bytes in and out, open connections and the time to first byte
+    """
+
+    metrics = None
+    _sent_at = None
+    # the StreamWriter of the socks handshake, which closes the transport when it is
+    # collected (python >= 3.11.5), so it has to live as long as the connection
+    _socks_writer = None
+
+    def attach(self, metrics, transport: asyncio.Transport):
+        self.metrics = metrics
+        self.transport = _MeteredTransport(transport, self)
+        metrics.connection_opened()
+
+    def on_write(self, nbytes: int):
+        self.metrics.sent(nbytes)
+        if self._sent_at is None:
+            self._sent_at = time.perf_counter()
+
+    def data_received(self, data: bytes):
+        if self.metrics is not None:
+            self.metrics.received(len(data))
+            if self._sent_at is not None:
+                self.metrics.observe("ttfb", time.perf_counter() - self._sent_at)
+                self._sent_at = None
+        super().data_received(data)
+
+    def connection_lost(self, exc):
+        if self.metrics is not None:
+            self.metrics.connection_closed()
+            self.metrics = None
+        super().connection_lost(exc)
+
+
 class ProxyConnectTor(_ProxyConnector):
+    """
+    connector which sends every new connection through a proxy of the Tor instance.
+
+    idle keep-alive connections are pooled per (proxy, host, port, ssl).
+    a request to a host for which an idle connection exists is routed to
+    that connection's proxy, otherwise the scheduler picks the proxy,
+    so rotation still applies whenever a new connection is needed.
+    a scheduler with affinity (like ```consistent_hash```) always picks the proxy,
+    by the target host or the ```affinity_key``` of the request.
+
+    :param scheduler: a ```ProxyScheduler``` or the name of a strategy. default: the one of ```tor```.
+                      another one counts the requests in flight together with the one of ```tor```
+                      (see ```ProxyScheduler.share```), so its ports are drained and autoscaled by them
+    :param limit: (int) max number of connections in total (aiohttp default 100)
+    :param limit_per_proxy: (int) max number of connections per proxy. 0 is unlimited
+    :param limit_per_host: (int) max number of connections per (host, port, ssl),
+                           over all proxies together. 0 is unlimited
+    :param keepalive_timeout: (float) seconds an idle connection is kept in the pool
+    :param force_close: (bool) disables pooling. every request gets a new connection
+    :param resolve: (bool) or a ```resolver.TorResolver```: connects to the address of the host
+                    when it is cached (default: ```tor.resolver```) instead of having the exit
+                    resolve it again, and keys the affinity and ```limit_per_host``` by it,
+                    so names of the same server share them. names which are not cached are
+                    looked up through tor in the background. nothing is resolved locally
+    """
+
     @property
     def proxy(self):
         return self._proxy
 
     def __init__(
-        self, tor: Tor, rdns=None, force_close=True, use_dns_cache=False, **kwargs
+        self,
+        tor: Tor,
+        rdns=None,
+        force_close=False,
+        use_dns_cache=False,
+        scheduler: Union[str, ProxyScheduler] = None,
+        limit_per_proxy: int = 0,
+        limit_per_host: int = 0,
+        resolve: Union[bool, TorResolver] = False,
+        **kwargs
     ):
-        # create the generator from current proxies
-        self.proxy_cycle = cycle(tor.proxies)
+        self.tor = tor
+        self.resolver: Optional[TorResolver] = None
+        if resolve is True:
+            self.resolver = getattr(tor, "resolver", None)
+            if self.resolver is None:
+                self.resolver = TorResolver(tor)
+        elif resolve:
+            self.resolver = resolve
+        self.scheduler = tor.scheduler
+        if scheduler:
+            self.scheduler = create_scheduler(scheduler, tor)
+            # its requests count for tor as well, which drains and autoscales the ports by them
+            self.scheduler.share(tor.scheduler)
 
         # this is bogus to initialize the parent
         super().__init__(
@@ -79,22 +287,194 @@ class ProxyConnectTor(_ProxyConnector):
             use_dns_cache=use_dns_cache,
             **kwargs
         )
+        # aiohttp's own limit_per_host would count per (host, proxy) pair
+        # since the proxy is part of the connection key. we do our own accounting
+        self._limit_per_proxy = limit_per_proxy
+        self._limit_per_target = limit_per_host
         self._proxy = None
+        self._factory = functools.partial(_MeteredHandler, loop=self._loop)
+
+    @property
+    def limit_per_proxy(self) -> int:
+        return self._limit_per_proxy
 
-    def next_proxy(self):
-        p = next(self.proxy_cycle)
-        self._proxy_host, self._proxy_port = p
+    @property
+    def limit_per_host(self) -> int:
+        return self._limit_per_target
+
+    def next_proxy(self, req: ClientRequest = None):
+        """
+        returns the proxy to use for ```req```.
+        when running inside a ClientSession request, the proxy is acquired
+        from the scheduler once and reused for all connections (redirects) of it.
+        """
+        slot = _request_slot.get()
+        if slot is None:
+            p = self._select_proxy(req, acquire=False)
+        else:
+            if slot.proxy is None:
+                slot.proxy = self._select_proxy(req, acquire=True, proxies=slot.proxies)
+            p = slot.proxy
         self._proxy = p
+        return p
+
+    def _select_proxy(self, req: ClientRequest = None, acquire=False, proxies=None):
+        if proxies is None:
+            proxies = self.scheduler.proxies
+        slot = _request_slot.get()
+        key = slot.affinity_key if slot is not None else None
+        if key is None and req is not None:
+            key = self._target(req.host)
+        idle = None
+        if req is not None and self._conns:
+            # prefer proxies which have an idle connection to the same host
+            # on the same (isolated) circuit
+            host, port, is_ssl = req.host, req.port, req.is_ssl()
+            credentials = req.socks_credentials
+            auth = BasicAuth(*credentials) if credentials else None
+            idle = {
+                conn_key.proxy
+                for conn_key, conns in self._conns.items()
+                if conns
+                and conn_key.host == host
+                and conn_key.port == port
+                and conn_key.is_ssl == is_ssl
+                and conn_key.proxy_auth == auth
+            }
+            # a scheduler with affinity weighs them itself
+            if idle and not self.scheduler.affinity:
+                candidates = [
+                    p
+                    for p in proxies
+                    if p in idle and (p.breaker is None or p.breaker.available())
+                ]
+                if candidates:
+                    proxies = candidates
+        if acquire:
+            return self.scheduler.acquire(proxies, key, idle)
+        return self.scheduler.pick(proxies, key, idle)
+
+    async def connect(
+        self, req: ClientRequest, traces: list, timeout: ClientTimeout
+    ) -> Connection:
+        if not isinstance(req, ClientRequest):
+            raise TypeError(
+                "%s requires requests of type %s.%s, got %s"
+                % (
+                    self.__class__.__name__,
+                    ClientRequest.__module__,
+                    ClientRequest.__name__,
+                    type(req).__name__,
+                )
+            )
+        slot = _request_slot.get()
+        req.socks_credentials = slot.credentials if slot is not None else None
+        req.socks_proxy = self.next_proxy(req)
+        # a renewed proxy tags the credentials, see SocksProxy.renew_circuit
+        req.socks_credentials = req.socks_proxy.credentials_for(
+            *req.socks_credentials or ()
+        )
+        return await super().connect(req, traces, timeout)
+
+    def _available_connections(self, key: ConnectionKey) -> int:
+        available = super()._available_connections(key)
+        if available < 1 or not (self._limit_per_proxy or self._limit_per_target):
+            return available
+        per_proxy = per_target = 0
+        for acquired_key, acquired in self._acquired_per_host.items():
+            if acquired_key.proxy is key.proxy:
+                per_proxy += len(acquired)
+            if acquired_key.port == key.port and (
+                acquired_key.host == key.host
+                or self._target(acquired_key.host) == self._target(key.host)
+            ):
+                per_target += len(acquired)
+        if self._limit_per_proxy:
+            available = min(available, self._limit_per_proxy - per_proxy)
+        if self._limit_per_target:
+            available = min(available, self._limit_per_target - per_target)
+        return available
+
+    def _target(self, host: str) -> str:
+        """
+        the cached address of ```host``` when resolving is on, else ```host```
+        """
+        if self.resolver is None or not host:
+            return host
+        return self.resolver.cached(host) or host
 
     async def _wrap_create_connection(
-        self, protocol_factory, host, port, *, ssl, **kwargs
+        self,
+        protocol_factory,
+        host,
+        port,
+        *,
+        ssl,
+        req: ClientRequest = None,
+        timeout: ClientTimeout = None,
+        server_hostname: str = None,
+        **kwargs
     ):
-        # get next proxy from generator and set it to proxy_host and proxy_port
-        self.next_proxy()
-        log.debug("using proxy %s for request" % (self.proxy))
-        return await super()._wrap_create_connection(
-            protocol_factory, host, port, ssl=ssl, **kwargs
-        )
+        proxy = req.socks_proxy if req is not None else None
+        if proxy is None:
+            proxy = self.next_proxy(req)
+        self._proxy_host, self._proxy_port = proxy
+        credentials = req.socks_credentials if req is not None else None
+        self._proxy_username, self._proxy_password = credentials or (None, None)
+        log.debug("using proxy %s for new connection to %s:%s" % (proxy, host, port))
+        dest_host = host
+        if self.resolver is not None:
+            dest_host = self.resolver.cached(host)
+            if dest_host is None:
+                self.resolver.prefetch(host)
+                dest_host = host
+
+        # the socks handshake and tls are done in separate steps, so both can be timed
+        connect_timeout = getattr(timeout, "sock_connect", None)
+        start = time.perf_counter()
+        stream = await _SocksClient.create(
+            proxy_type=self._proxy_type,
+            host=self._proxy_host,
+            port=self._proxy_port,
+            username=self._proxy_username,
+            password=self._proxy_password,
+            rdns=self._rdns,
+            loop=self._loop,
+        ).connect(dest_host=dest_host, dest_port=port, timeout=connect_timeout)
+        connected = time.perf_counter()
+        proxy.metrics.observe("connect", connected - start)
+        slot = _request_slot.get()
+        phases = slot.phases if slot is not None else None
+        if phases is not None:
+            phases["socks"] = connected - start
+
+        transport = stream.writer.transport
+        protocol = protocol_factory()
+        protocol._socks_writer = stream.writer
+        transport.set_protocol(protocol)
+        if ssl:
+            try:
+                async with ceil_timeout(connect_timeout):
+                    transport = await self._loop.start_tls(
+                        transport,
+                        protocol,
+                        ssl,
+                        server_hostname=server_hostname or host,
+                    )
+            except BaseException as exc:
+                stream.writer.close()
+                if isinstance(exc, cert_errors):
+                    raise ClientConnectorCertificateError(req.connection_key, exc)
+                if isinstance(exc, ssl_errors):
+                    raise ClientConnectorSSLError(req.connection_key, exc)
+                raise
+            proxy.metrics.observe("tls", time.perf_counter() - connected)
+            if phases is not None:
+                phases["tls"] = time.perf_counter() - connected
+        protocol.transport = transport
+        if isinstance(protocol, _MeteredHandler):
+            protocol.attach(proxy.metrics, transport)
+        return transport, protocol
 
     @classmethod
     def from_url(cls, url, **kwargs):
@@ -111,6 +491,7 @@ class ClientSession(_ClientSession):
         tor: Tor = None,
         base_url: Optional[StrOrURL] = None,
         *,
+        connector: Optional[ProxyConnectTor] = None,
         loop: Optional[asyncio.AbstractEventLoop] = None,
         cookies: Optional[LooseCookies] = None,
         headers: Optional[LooseHeaders] = None,
@@ -131,8 +512,25 @@ class ClientSession(_ClientSession):
         trust_env: bool = False,
         requote_redirect_url: bool = True,
         trace_configs: Optional[List[TraceConfig]] = None,
-        read_bufsize: int = 2**16
+        read_bufsize: int = 2**16,
+        scheduler: Union[str, ProxyScheduler] = None,
+        isolation: Union[str, CircuitIsolation, None] = None,
+        tracing: Union[float, RequestTracer, None] = None,
+        hedging: Union[bool, float, HedgePolicy, None] = None,
+        cache: Union[bool, str, HttpCache, None] = None,
+        resolve: Union[bool, TorResolver] = False
     ) -> None:
+        """
+        :param tracing: a sample rate (0..1) or a ```RequestTracer``` to time
+                        the phases of the requests. off by default
+        :param hedging: True, a budget (share of extra requests) or a ```HedgePolicy```
+                        to send slow idempotent requests a second time over another proxy.
+                        off by default
+        :param cache: an ```HttpCache```, a directory for one, or True for the default directory,
+                      to answer repeated requests from disk. off by default
+        :param resolve: True or a ```TorResolver``` to connect to the cached addresses of the hosts,
+                        resolved through tor (see ```ProxyConnectTor```). off by default
+        """
         if not tor:
             instances = aionion.get_running_instance()
             if not len(instances):
@@ -141,7 +539,19 @@ class ClientSession(_ClientSession):
                 tor = instances[-1]  # take last launched instance
         # the missing parameter (connector) is being created here based on the provided Tor instance,  so it uses the correct proxies
         self.tor = tor
-        connector = ProxyConnectTor(tor)
+        self.isolation = create_isolation(isolation)
+        self.tracer = create_tracer(tracing)
+        self.hedging = create_hedging(hedging)
+        self.cache = create_cache(cache)
+        if self.tracer:
+            trace_configs = [*(trace_configs or []), self.tracer.trace_config]
+        if connector is None:
+            connector = ProxyConnectTor(tor, scheduler=scheduler, resolve=resolve)
+        if not issubclass(request_class, ClientRequest):
+            raise TypeError(
+                "request_class should be a subclass of %s.%s"
+                % (ClientRequest.__module__, ClientRequest.__name__)
+            )
 
         super().__init__(
             base_url,
@@ -177,6 +587,165 @@ class ClientSession(_ClientSession):
     #
 
     async def _request(
+        self,
+        method: str,
+        str_or_url: StrOrURL,
+        *,
+        hedge: Optional[bool] = None,
+        **kwargs
+    ) -> ClientResponse:
+        """
+        :param hedge: (bool) False to never hedge this request. see ```HedgePolicy```
+        """
+        if self.cache is not None:
+            return await self._cached_request(method, str_or_url, hedge, kwargs)
+        return await self._send(method, str_or_url, hedge, kwargs)
+
+    async def _send(
+        self, method: str, str_or_url: StrOrURL, hedge: Optional[bool], kwargs: dict
+    ) -> ClientResponse:
+        policy = self.hedging
+        if (
+            hedge is False
+            or policy is None
+            or not policy.applies(method, kwargs.get("data"))
+        ):
+            return await self._request_once(method, str_or_url, **kwargs)
+        return await self._hedged_request(policy, method, str_or_url, kwargs)
+
+    async def _cached_request(
+        self, method: str, str_or_url: StrOrURL, hedge: Optional[bool], kwargs: dict
+    ) -> ClientResponse:
+        """
+        answers from ```self.cache``` when it holds a fresh response, revalidates
+        a stale one, and stores the response when it may be. see ```HttpCache```
+        """
+        cache = self.cache
+        url = self._build_url(str_or_url)
+        if kwargs.get("params"):
+            # the same merge as aiohttp's ClientRequest
+            query = MultiDict(url.query)
+            query.extend(url.with_query(kwargs["params"]).query)
+            url = url.with_query(query)
+        headers = self._prepare_headers(kwargs.get("headers"))
+        entry, fresh = cache.lookup(method, str(url), headers)
+        body = cache.body(entry) if entry is not None else None
+        if body is not None:
+            if fresh:
+                return self._cached_response(method, entry, body)
+            conditional = CIMultiDict(headers)
+            conditional.update(cache.conditional_headers(entry))
+            resp = await self._send(
+                method, str_or_url, hedge, dict(kwargs, headers=conditional)
+            )
+            if resp.status == 304:
+                resp.release()
+                entry = cache.refresh(entry, resp.headers)
+                return self._cached_response(method, entry, body, resp.proxy)
+        else:
+            resp = await self._send(method, str_or_url, hedge, kwargs)
+        resp.from_cache = False
+        if method.upper() not in ("GET", "HEAD", "OPTIONS", "TRACE"):
+            if resp.status < 400:
+                cache.invalidate(str(url))
+        elif not resp.history and cache.storable(
+            method, resp.status, headers, resp.headers
+        ):
+            body = await resp.read()
+            cache.store(str(url), headers, resp.status, resp.reason, resp.headers, body)
+            # the body was read for the cache, it can still be streamed
+            resp.content = _replay(body, self._loop)
+        return resp
+
+    def _cached_response(
+        self, method: str, entry: CacheEntry, body: bytes, proxy=None
+    ) -> ClientResponse:
+        url = URL(entry.url)
+        resp = self._response_class(
+            method,
+            url,
+            writer=None,
+            continue100=None,
+            timer=None,
+            request_info=RequestInfo(url, method, CIMultiDictProxy(CIMultiDict()), url),
+            traces=[],
+            loop=self._loop,
+            session=self,
+        )
+        resp.status = entry.status
+        resp.reason = entry.reason
+        resp._headers = CIMultiDictProxy(CIMultiDict(entry.headers))
+        resp._raw_headers = tuple((k.encode(), v.encode()) for k, v in entry.headers)
+        resp._body = body if method.upper() != "HEAD" else b""
+        resp.content = _replay(resp._body, self._loop)
+        # the proxy of the revalidation, None when answered without one
+        resp.proxy = proxy
+        resp.from_cache = True
+        return resp
+
+    async def _hedged_request(
+        self, policy: HedgePolicy, method: str, str_or_url: StrOrURL, kwargs: dict
+    ) -> ClientResponse:
+        """
+        sends the request, and once more over another proxy when the first attempt
+        is slower than the policy's delay. the first response wins
+        """
+        policy.request()
+        loop = asyncio.get_running_loop()
+
+        def attempt(proxies: list = None):
+            slot = _RequestSlot(proxies=proxies)
+
+            async def run():
+                _request_slot.set(slot)
+                start = loop.time()
+                try:
+                    resp = await self._request_once(method, str_or_url, **kwargs)
+                except asyncio.CancelledError:
+                    # the time of a cancelled attempt is a lower bound, but it keeps the tail honest
+                    policy.observe(loop.time() - start)
+                    raise
+                policy.observe(loop.time() - start)
+                return resp
+
+            return slot, asyncio.ensure_future(run())
+
+        first_slot, first = attempt()
+        tasks = [first]
+        winner = None
+        try:
+            await asyncio.wait(tasks, timeout=policy.delay())
+            if not first.done() and policy.try_hedge():
+                proxies = [
+                    p
+                    for p in self.connector.scheduler.proxies
+                    if p is not first_slot.proxy
+                ]
+                tasks.append(attempt(proxies or None)[1])
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if task is not first:
+                            policy.won()
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif task is not winner and not task.cancelled():
+                    if task.exception() is None:
+                        # both answered at the same time. the loser's connection is released
+                        task.result().release()
+
+    async def _request_once(
         self,
         method: str,
         str_or_url: StrOrURL,
@@ -202,36 +771,75 @@ class ClientSession(_ClientSession):
         ssl: Optional[Union[SSLContext, bool, Fingerprint]] = None,
         trace_request_ctx: Optional[SimpleNamespace] = None,
         read_bufsize: Optional[int] = None,
+        isolation_key: Any = None,
+        affinity_key: Any = None,
         **kwargs
     ) -> ClientResponse:
-        self.connector.next_proxy()
-        proxy = self.connector.proxy
-        resp = await super()._request(
-            method,
-            str_or_url,
-            params=params,
-            data=data,
-            json=json,
-            cookies=cookies,
-            headers=headers,
-            skip_auto_headers=skip_auto_headers,
-            auth=auth,
-            allow_redirects=allow_redirects,
-            max_redirects=max_redirects,
-            compress=compress,
-            chunked=chunked,
-            expect100=expect100,
-            raise_for_status=raise_for_status,
-            read_until_eof=read_until_eof,
-            timeout=timeout,
-            verify_ssl=verify_ssl,
-            fingerprint=fingerprint,
-            ssl_context=ssl_context,
-            ssl=ssl,
-            trace_request_ctx=trace_request_ctx,
-            read_bufsize=read_bufsize,
-            **kwargs
+        """
+        :param isolation_key: optional. requests with the same key share a circuit,
+                              different keys get different circuits. see ```CircuitIsolation```
+        :param affinity_key: optional. with a ```consistent_hash``` scheduler, requests with
+                             the same key stick to the same proxy. default: the target host
+        """
+        scheduler = self.connector.scheduler
+        slot = _request_slot.get()
+        if slot is None or slot.proxy is not None:
+            slot = _RequestSlot()
+        slot.credentials = self.isolation.credentials(
+            host=self._build_url(str_or_url).host, key=isolation_key
         )
+        if self.tracer:
+            slot.phases = self.tracer.sample()
+        slot.affinity_key = affinity_key
+        token = _request_slot.set(slot)
+        start = time.perf_counter()
+        try:
+            resp = await super()._request(
+                method,
+                str_or_url,
+                params=params,
+                data=data,
+                json=json,
+                cookies=cookies,
+                headers=headers,
+                skip_auto_headers=skip_auto_headers,
+                auth=auth,
+                allow_redirects=allow_redirects,
+                max_redirects=max_redirects,
+                compress=compress,
+                chunked=chunked,
+                expect100=expect100,
+                raise_for_status=raise_for_status,
+                read_until_eof=read_until_eof,
+                timeout=timeout,
+                verify_ssl=verify_ssl,
+                fingerprint=fingerprint,
+                ssl_context=ssl_context,
+                ssl=ssl,
+                trace_request_ctx=trace_request_ctx,
+                read_bufsize=read_bufsize,
+                **kwargs
+            )
+        except asyncio.CancelledError:
+            if slot.proxy is not None:
+                scheduler.release(slot.proxy)
+            raise
+        except Exception as e:
+            if slot.proxy is not None:
+                elapsed = time.perf_counter() - start
+                scheduler.release(slot.proxy, elapsed, error=e)
+                slot.proxy.metrics.request_done(elapsed, error=e)
+            raise
+        else:
+            if slot.proxy is not None:
+                elapsed = time.perf_counter() - start
+                # waiting for a pooled connection is not the proxy's doing
+                queued = slot.phases.get("queued", 0) if slot.phases else 0
+                scheduler.release(slot.proxy, elapsed - queued)
+                slot.proxy.metrics.request_done(elapsed)
+        finally:
+            _request_slot.reset(token)
+        proxy = slot.proxy
         try:
             # add the used proxy to the response
             resp.proxy = proxy
@@ -242,79 +850,129 @@ class ClientSession(_ClientSession):
             )
         return resp
 
-    def __del__(self, _warnings: Any = None) -> None:
-        super().__del__()
+    async def fetch_many(
+        self,
+        requests: Iterable,
+        concurrency: int = 16,
+        per_proxy_concurrency: int = None,
+        read: bool = True,
+    ) -> AsyncIterator[Tuple[Any, Union[ClientResponse, Exception], Any]]:
+        """
+        sends many requests with at most ```concurrency``` in flight,
+        and yields a ```(request, response or exception, proxy)``` tuple as each one completes.
 
+        requests are taken from ```requests``` only when there is room for them,
+        so it can be a (lazy, async) iterator over millions of items.
+        an item is a url, a ```(method, url)``` or ```(method, url, kwargs)``` tuple,
+        or a dict of keyword arguments for ```request()```, including "url" and optionally "method".
 
-class RequestsSession(requests.Session):
-    """
-    Drop-in replacement for ```requests.Session``` for use with Aionion
-    """
+            async for request, resp, proxy in session.fetch_many(urls, concurrency=50):
+                if isinstance(resp, Exception):
+                    ...
+                body = await resp.text()
 
-    def __init__(self, tor: Tor = None) -> None:
-        if not tor:
-            instances = aionion.get_running_instance()
-            if not len(instances):
-                tor = aionion.create_in_background_sync()
-            else:
-                tor = instances[-1]  # take last launched instance
-        self.proxy_cycle = itertools.cycle(tor.proxies)
-        super().__init__()
+        :param requests: iterable or async iterable of requests
+        :param concurrency: (int) max requests in flight
+        :param per_proxy_concurrency: (int) max requests in flight per proxy. default: no limit
+        :param read: (bool) read the body before yielding the response, which releases
+                     the connection. with False, the caller must release every response
+        """
+        scheduler = self.connector.scheduler
+        results = asyncio.Queue()
+        in_flight = collections.Counter()
+        tasks = set()
+        is_async = hasattr(requests, "__aiter__")
+        pending = requests.__aiter__() if is_async else iter(requests)
+        running = 0
+        exhausted = False
+        held = None
+        try:
+            while True:
+                while running < concurrency and not exhausted:
+                    if held is None:
+                        try:
+                            if is_async:
+                                held = await pending.__anext__()
+                            else:
+                                held = next(pending)
+                        except (StopIteration, StopAsyncIteration):
+                            exhausted = True
+                            break
+                    proxy = None
+                    if per_proxy_concurrency:
+                        candidates = [
+                            p
+                            for p in scheduler.proxies
+                            if in_flight[p] < per_proxy_concurrency
+                        ]
+                        if not candidates:
+                            # every proxy is busy. wait for one to finish
+                            break
+                        proxy = scheduler.pick(candidates)
+                        in_flight[proxy] += 1
+                    task = asyncio.ensure_future(
+                        self._fetch_one(held, proxy, read, results)
+                    )
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    running += 1
+                    held = None
+                if not running:
+                    break
+                request, result, reserved, proxy = await results.get()
+                running -= 1
+                if reserved is not None:
+                    in_flight[reserved] -= 1
+                yield request, result, proxy
+        finally:
+            for task in tasks:
+                task.cancel()
 
-    def request(
+    async def download(
         self,
-        method: str,
-        url: Union[str, bytes, Text],
-        params=None,
-        data=None,
-        headers: Optional[MutableMapping[Text, Text]] = None,
-        cookies: Union[
-            None, requests.sessions.RequestsCookieJar, MutableMapping[Text, Text]
-        ] = None,
-        files: Optional[MutableMapping[Text, IO[Any]]] = None,
-        auth: Union[
-            None,
-            Tuple[Text, Text],
-            requests.auth.AuthBase,
-            Callable[
-                [requests.sessions.PreparedRequest], requests.sessions.PreparedRequest
-            ],
-        ] = None,
-        timeout: Union[None, float, Tuple[float, float], Tuple[float, None]] = None,
-        allow_redirects: Optional[bool] = None,
-        proxies=None,
-        hooks=None,
-        stream: Optional[bool] = None,
-        verify: Union[None, bool, Text] = None,
-        cert: Union[Text, Tuple[Text, Text], None] = None,
-        json: Optional[Any] = None,
-    ) -> requests.Response:
-        proxy = next(self.proxy_cycle)
-        proxies = {"http": proxy.socks_url, "https": proxy.socks_url}
-        response = super().request(
-            method,
+        url: StrOrURL,
+        path: Union[str, Path, None] = None,
+        segments: int = None,
+        min_segment: int = 1 << 20,
+        stall_timeout: float = 10,
+        **kwargs
+    ):
+        """
+        downloads ```url``` in parallel byte ranges over different proxies,
+        see ```download.SegmentedDownload```. falls back to a single stream
+        when the server does not serve ranges.
+
+            await session.download("https://example.com/big.iso", "big.iso")
+
+        :param path: the file to write. returns its ```Path```, or the content
+                     as a ```bytearray``` when no path is given
+        :param segments: (int) max ranges in flight. default: one per proxy, at most 8
+        :param min_segment: (int) min bytes of a range
+        :param stall_timeout: (float) seconds without data before a range moves to another proxy
+        :param kwargs: further arguments for the requests, e.g. headers
+        """
+        return await SegmentedDownload(
+            self,
             url,
-            params,
-            data,
-            headers,
-            cookies,
-            files,
-            auth,
-            timeout,
-            allow_redirects,
-            proxies,  # here, the proxies defined above, are used
-            hooks,
-            stream,
-            verify,
-            cert,
-            json,
-        )
+            segments=segments,
+            min_segment=min_segment,
+            stall_timeout=stall_timeout,
+            **kwargs
+        ).run(path)
+
+    async def _fetch_one(self, request, reserved, read: bool, results: asyncio.Queue):
+        slot = _RequestSlot(proxies=[reserved] if reserved is not None else None)
+        _request_slot.set(slot)
         try:
-            # add the used proxy to the response
-            response.proxy = proxy
-        except:
-            log.debug(
-                "could not determine the proxy used for this request. error: ",
-                exc_info=True,
-            )
-        return response
+            # a malformed item is the result of that item, like a failed request
+            method, url, kwargs = _request_args(request)
+            result = await self._request(method, url, **kwargs)
+            if read:
+                async with result:
+                    await result.read()
+        except Exception as e:
+            result = e
+        results.put_nowait((request, result, reserved, slot.proxy or reserved))
+
+    def __del__(self, _warnings: Any = None) -> None:
+        super().__del__()
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import threading
+import time
+from typing import Optional
+
+__all__ = ["IPCache", "RateLimiter"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+class IPCache:
+    """
+    the public ip and latency found for each proxy, per circuit generation
+    (see ```SocksProxy.generation```).
+
+    an entry expires after ```ttl``` seconds, or as soon as the proxy gets a new circuit:
+    ```Tor.newnym``` moves every proxy to the next generation, ```SocksProxy.renew_circuit``` only
+    the one proxy, so the entries of the other proxies stay valid.
+
+    :param ttl: (float) seconds an entry is valid
+    :param maxsize: (int) max entries, the least recently used are dropped first
+    """
+
+    def __init__(self, ttl: float = 120, maxsize: int = 4096):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, proxy) -> Optional[tuple[str, float, str]]:
+        """
+        returns ```(public ip, latency, provider)``` of the current circuit of ```proxy```,
+        or None when it is not known or expired
+        """
+        key = (proxy.host, proxy.port)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                generation, expires, value = entry
+                if generation == proxy.generation and expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, proxy, public_ip: str, latency: float, provider: str = None):
+        key = (proxy.host, proxy.port)
+        with self._lock:
+            self._entries[key] = (
+                proxy.generation,
+                time.monotonic() + self.ttl,
+                (public_ip, latency, provider),
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, proxies=None):
+        """
+        drops the entries of ```proxies``` (default: all)
+        """
+        with self._lock:
+            if proxies is None:
+                self._entries.clear()
+                return
+            for proxy in proxies:
+                self._entries.pop((proxy.host, proxy.port), None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "%s(%d entries, ttl = %s, hits = %d, misses = %d)" % (
+            self.__class__.__name__,
+            len(self),
+            self.ttl,
+            self.hits,
+            self.misses,
+        )
+
+
+class RateLimiter:
+    """
+    token bucket shared across threads and event loops.
+    allows ```rate``` acquisitions per second on average, and bursts of up to ```burst```.
+    callers beyond that wait their turn, in order.
+
+    :param rate: (float) acquisitions per second
+    :param burst: (float) max acquisitions without waiting
+    """
+
+    def __init__(self, rate: float = 10, burst: float = 10):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited = 0
+
+    def reserve(self) -> float:
+        """
+        takes a token and returns the seconds to wait before using it
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            self.waited += 1
+            return -self._tokens / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    def __repr__(self):
+        return "%s(rate = %s/s, burst = %s, waited = %d)" % (
+            self.__class__.__name__,
+            self.rate,
+            self.burst,
+            self.waited,
+        )
@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import hashlib
+import secrets
+from typing import Optional
+from typing import Union
+
+__all__ = ["CircuitIsolation", "create_isolation"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+class CircuitIsolation:
+    """
+    generates the SOCKS5 username/password to send with a connection.
+
+    tor never puts streams with different socks credentials on the same circuit
+    (IsolateSOCKSAuth, which is on by default for every SocksPort). so instead of
+    opening a port per circuit, or sending the global NEWNYM signal, thousands of
+    logical circuits can share a few ports just by varying the credentials.
+
+    modes:
+        none     - no credentials. circuits are only separated per port
+        request  - new credentials, so a new circuit, for every request
+        session  - the same credentials for the whole session. ```rotate()``` for a new identity
+        host     - the same credentials per target host within the session
+
+    a caller supplied key (```isolation_key``` on a request) always wins over the mode:
+    all requests with the same key share their credentials.
+    """
+
+    MODES = ("none", "request", "session", "host")
+
+    def __init__(self, mode="none"):
+        if mode not in self.MODES:
+            raise ValueError(
+                "unknown isolation mode %r. choose one of %s"
+                % (mode, ", ".join(self.MODES))
+            )
+        self.mode = mode
+        self._secret = secrets.token_bytes(16)
+
+    def credentials(self, host: str = None, key=None) -> Optional[tuple[str, str]]:
+        """
+        returns a (username, password) tuple, or None when no credentials should be sent
+
+        :param host: (str) the target host of the request
+        :param key: a caller supplied routing key, overrides the mode
+        """
+        if key is not None:
+            return self._derive("key", key)
+        if self.mode == "none":
+            return None
+        if self.mode == "request":
+            return ("aionion-" + secrets.token_hex(12), "aionion")
+        if self.mode == "host":
+            return self._derive("host", host or "")
+        return self._derive("session", "")
+
+    def rotate(self):
+        """
+        switches to a new identity for every session, host and key
+        derived credential. only new connections are affected.
+        """
+        self._secret = secrets.token_bytes(16)
+
+    def _derive(self, kind: str, value) -> tuple[str, str]:
+        digest = hashlib.blake2b(
+            ("%s:%s" % (kind, value)).encode(), key=self._secret, digest_size=12
+        ).hexdigest()
+        return ("aionion-" + digest, "aionion")
+
+    def __repr__(self):
+        return "%s(mode = %s)" % (self.__class__.__name__, self.mode)
+
+
+def create_isolation(
+    isolation: Union[str, CircuitIsolation, None] = None,
+) -> CircuitIsolation:
+    """
+    returns ```isolation``` when it is a CircuitIsolation already,
+    otherwise a new one using ```isolation``` as mode (default "none")
+    """
+    if isinstance(isolation, CircuitIsolation):
+        return isolation
+    return CircuitIsolation(isolation or "none")
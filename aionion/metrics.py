@@ -0,0 +1,380 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import collections
+import json
+import logging
+import threading
+import time
+from typing import Iterable
+
+from .cache import cache_stats
+from .exits import exit_diversity
+
+__all__ = [
+    "Histogram",
+    "ProxyMetrics",
+    "MetricsServer",
+    "collect",
+    "to_prometheus",
+]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+log = logging.getLogger(__name__)
+
+# seconds. covers a local socks handshake up to a slow onion circuit
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# name -> help text of the latency histograms kept per proxy
+PHASES = {
+    "connect": "socks connect (handshake and circuit) time",
+    "tls": "tls handshake time",
+    "ttfb": "time from sending a request to its first response byte",
+    "request": "total time of a request, as seen by the session",
+}
+
+
+class Histogram:
+    """
+    fixed bucket histogram. ```observe``` is a bisect and two additions
+    """
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip((*self.buckets, "+Inf"), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return dict(count=self.count, sum=round(self.sum, 6), buckets=buckets)
+
+
+class ProxyMetrics:
+    """
+    counters and latency histograms of a single proxy (```SocksProxy.metrics```).
+    updated by the sessions, the connector and ```SocksProxy.open_connection```,
+    possibly from several threads
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections = 0
+        self.open_connections = 0
+        self.latency = {phase: Histogram() for phase in PHASES}
+
+    def observe(self, phase: str, seconds: float):
+        with self._lock:
+            self.latency[phase].observe(seconds)
+
+    def request_done(self, seconds: float = None, error: BaseException = None):
+        with self._lock:
+            self.requests += 1
+            if error is not None:
+                self.errors[type(error).__name__] += 1
+            if seconds is not None:
+                self.latency["request"].observe(seconds)
+
+    def connection_opened(self, tracked: bool = True):
+        """
+        :param tracked: (bool) the caller reports ```connection_closed``` as well
+        """
+        with self._lock:
+            self.connections += 1
+            if tracked:
+                self.open_connections += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.open_connections -= 1
+
+    def received(self, nbytes: int):
+        self.bytes_in += nbytes
+
+    def sent(self, nbytes: int):
+        self.bytes_out += nbytes
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(
+                requests=self.requests,
+                errors=dict(self.errors),
+                bytes_in=self.bytes_in,
+                bytes_out=self.bytes_out,
+                connections=self.connections,
+                open_connections=self.open_connections,
+                latency={k: v.snapshot() for k, v in self.latency.items()},
+            )
+
+    def __repr__(self):
+        return "%s(requests = %d, errors = %d, open connections = %d)" % (
+            self.__class__.__name__,
+            self.requests,
+            sum(self.errors.values()),
+            self.open_connections,
+        )
+
+
+def collect(proxies: Iterable, registries: Iterable = (), scheduler=None) -> dict:
+    """
+    builds the stats of a pool: per proxy metrics, health and breaker state, and pool wide gauges
+    including the exit diversity (see ```exits.exit_diversity```) and the counters
+    of the http caches in use (see ```cache.HttpCache```).
+    used by ```Tor.stats()``` and ```TorFleet.stats()```
+
+    :param proxies: the proxies to report
+    :param registries: the ```health.ProxyRegistry```s holding their states
+    :param scheduler: optional ```ProxyScheduler```, for the in-flight requests
+    """
+    registries = list(registries)
+    proxies = list(proxies)
+    per_proxy = {}
+    states = collections.Counter()
+    totals = collections.Counter(
+        dict.fromkeys(
+            (
+                "requests",
+                "errors",
+                "bytes_in",
+                "bytes_out",
+                "open_connections",
+                "in_flight",
+            ),
+            0,
+        )
+    )
+    for proxy in proxies:
+        state = None
+        for registry in registries:
+            state = registry.state(proxy)
+            if state is not None:
+                state = state.value
+                break
+        stats = proxy.metrics.snapshot()
+        stats["state"] = state
+        stats["breaker"] = proxy.breaker.state.value if proxy.breaker else None
+        stats["public_ip"] = proxy.public_ip or None
+        stats["in_flight"] = scheduler.in_flight(proxy) if scheduler else 0
+        per_proxy["%s:%d" % tuple(proxy)] = stats
+        states[state or "unknown"] += 1
+        for key in ("requests", "bytes_in", "bytes_out", "open_connections"):
+            totals[key] += stats[key]
+        totals["in_flight"] += stats["in_flight"]
+        totals["errors"] += sum(stats["errors"].values())
+    pool = dict(proxies=len(per_proxy), states=dict(states), **totals)
+    pool["exits"] = exit_diversity(proxies)
+    cache = cache_stats()
+    if cache:
+        pool["cache"] = cache
+    return dict(time=time.time(), pool=pool, proxies=per_proxy)
+
+
+def _labels(**labels) -> str:
+    return ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels.items()
+    )
+
+
+def to_prometheus(stats: dict, prefix: str = "aionion") -> str:
+    """
+    renders the output of ```collect``` in the prometheus text exposition format
+    """
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append("# HELP %s_%s %s" % (prefix, name, help))
+        lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+        for suffix, labels, value in samples:
+            labels = "{%s}" % labels if labels else ""
+            lines.append("%s_%s%s%s %s" % (prefix, name, suffix, labels, value))
+
+    proxies = stats["proxies"]
+    counters = [
+        ("requests_total", "requests", "requests sent through the proxy"),
+        ("bytes_received_total", "bytes_in", "bytes received through the proxy"),
+        ("bytes_sent_total", "bytes_out", "bytes sent through the proxy"),
+        ("connections_total", "connections", "connections opened through the proxy"),
+    ]
+    for name, key, help in counters:
+        samples = [("", _labels(proxy=p), s[key]) for p, s in proxies.items()]
+        metric(name, "counter", help, samples)
+    samples = [
+        ("", _labels(proxy=p, error=error), count)
+        for p, s in proxies.items()
+        for error, count in s["errors"].items()
+    ]
+    metric("errors_total", "counter", "failed requests by error class", samples)
+    gauges = [
+        ("open_connections", "open_connections", "open connections"),
+        ("in_flight", "in_flight", "requests in flight"),
+    ]
+    for name, key, help in gauges:
+        samples = [("", _labels(proxy=p), s[key]) for p, s in proxies.items()]
+        metric(name, "gauge", help, samples)
+    samples = [
+        ("", _labels(proxy=p, state=s["state"] or "unknown"), 1)
+        for p, s in proxies.items()
+    ]
+    metric("proxy_state", "gauge", "health state of the proxy", samples)
+    samples = [
+        ("", _labels(proxy=p, state=s["breaker"]), 1)
+        for p, s in proxies.items()
+        if s["breaker"]
+    ]
+    metric("breaker_state", "gauge", "circuit breaker state of the proxy", samples)
+    for phase, help in PHASES.items():
+        samples = []
+        for p, s in proxies.items():
+            histogram = s["latency"][phase]
+            for bound, count in histogram["buckets"].items():
+                samples.append(("_bucket", _labels(proxy=p, le=bound), count))
+            samples.append(("_sum", _labels(proxy=p), histogram["sum"]))
+            samples.append(("_count", _labels(proxy=p), histogram["count"]))
+        metric("%s_seconds" % phase, "histogram", help, samples)
+    samples = [
+        ("", _labels(state=state), count)
+        for state, count in stats["pool"]["states"].items()
+    ]
+    metric("proxies", "gauge", "proxies in the pool by health state", samples)
+    exits = stats["pool"]["exits"]
+    metric("exits", "gauge", "distinct exit ips", [("", "", exits["exits"])])
+    metric(
+        "exit_diversity",
+        "gauge",
+        "effective number of exits the proxies spread over",
+        [("", "", exits["effective"])],
+    )
+    cache = stats["pool"].get("cache")
+    if cache:
+        samples = [
+            ("", _labels(result=result), cache[result])
+            for result in ("hits", "misses", "stale", "revalidated")
+        ]
+        metric(
+            "cache_lookups_total",
+            "counter",
+            "http cache lookups: fresh hits, misses, and stale entries "
+            "of which revalidated by a 304",
+            samples,
+        )
+        metric(
+            "cache_stored_total",
+            "counter",
+            "responses stored in the http cache",
+            [("", "", cache["stored"])],
+        )
+        metric(
+            "cache_evicted_total",
+            "counter",
+            "responses evicted from the http cache",
+            [("", "", cache["evicted"])],
+        )
+        metric(
+            "cache_bytes",
+            "gauge",
+            "bytes in the http cache",
+            [("", "", cache["bytes"])],
+        )
+    dns = stats["pool"].get("dns")
+    if dns:
+        samples = [
+            ("", _labels(result=result), dns[result])
+            for result in ("hits", "misses", "coalesced")
+        ]
+        metric(
+            "dns_lookups_total",
+            "counter",
+            "name lookups through tor: cache hits, misses, and misses "
+            "which waited for a lookup in flight",
+            samples,
+        )
+        metric(
+            "dns_names",
+            "gauge",
+            "names in the resolver cache",
+            [("", "", dns["names"])],
+        )
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    tiny local http endpoint serving the stats of a ```Tor``` or ```TorFleet```:
+    ```/metrics``` in prometheus text format and ```/metrics.json``` as json.
+
+        server = await MetricsServer(tor, port=9101).start()
+
+    :param source: anything with a ```stats()``` method
+    """
+
+    def __init__(self, source, host: str = "127.0.0.1", port: int = 9101):
+        self.source = source
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        log.info("serving metrics on http://%s:%d/metrics" % (self.host, self.port))
+        return self
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            path = request.split(b" ", 2)[1].split(b"?")[0]
+            if path == b"/metrics":
+                status = b"200 OK"
+                ctype = b"text/plain; version=0.0.4"
+                body = to_prometheus(self.source.stats()).encode()
+            elif path == b"/metrics.json":
+                status, ctype = b"200 OK", b"application/json"
+                body = json.dumps(self.source.stats()).encode()
+            else:
+                status, ctype, body = b"404 Not Found", b"text/plain", b"not found\n"
+            writer.write(
+                b"HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n"
+                b"Connection: close\r\n\r\n%s" % (status, ctype, len(body), body)
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, IndexError):
+            pass
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def __repr__(self):
+        return "%s(http://%s:%s/metrics)" % (
+            self.__class__.__name__,
+            self.host,
+            self.port,
+        )
@@ -0,0 +1,335 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import queue
+import threading
+import time
+from typing import Any
+from typing import Callable
+from typing import IO
+from typing import Iterable
+from typing import MutableMapping
+from typing import Optional
+from typing import Text
+from typing import Tuple
+from typing import Union
+import urllib.parse
+
+import requests.adapters
+import requests.auth
+
+import aionion
+from aionion.cache import CacheEntry
+from aionion.cache import HttpCache
+from aionion.cache import create_cache
+from aionion.isolation import CircuitIsolation
+from aionion.isolation import create_isolation
+from aionion.scheduler import ProxyScheduler
+from aionion.scheduler import create_scheduler
+from aionion.tor import Tor
+from aionion.utils import _request_args
+
+__all__ = ["RequestsSession"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+log = logging.getLogger(__name__)
+
+
+class _ProxyAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter serving a single proxy. the pool managers (one per socks url,
+    so per set of isolation credentials) are created under a lock,
+    so concurrent threads never build two pools for the same url.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._manager_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        with self._manager_lock:
+            return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+
+class RequestsSession(requests.Session):
+    """
+    Drop-in replacement for ```requests.Session``` for use with Aionion
+
+    the session can be used from several threads at once. ```map()``` runs
+    many requests on a thread pool.
+
+    :param scheduler: a ```ProxyScheduler``` or the name of a strategy. default: the one of ```tor```.
+                      another one counts the requests in flight together with the one of ```tor```
+                      (see ```ProxyScheduler.share```).
+                      with ```consistent_hash```, requests to the same host (or with the same
+                      ```affinity_key```) stick to the same proxy
+    :param pool_per_proxy: (bool) send the requests through a dedicated adapter
+                           per proxy, with its own bounded connection pools
+    :param pool_maxsize: (int) max connections kept per proxy and host (with pool_per_proxy)
+    :param pool_block: (bool) with pool_per_proxy, wait for a free connection
+                       instead of opening more than ```pool_maxsize```
+    :param cache: an ```HttpCache```, a directory for one, or True for the default directory,
+                  to answer repeated requests from disk. off by default
+    """
+
+    def __init__(
+        self,
+        tor: Tor = None,
+        scheduler: Union[str, ProxyScheduler] = None,
+        isolation: Union[str, CircuitIsolation, None] = None,
+        pool_per_proxy: bool = False,
+        pool_maxsize: int = requests.adapters.DEFAULT_POOLSIZE,
+        pool_block: bool = False,
+        cache: Union[bool, str, HttpCache, None] = None,
+    ) -> None:
+        if not tor:
+            instances = aionion.get_running_instance()
+            if not len(instances):
+                tor = aionion.create_in_background_sync()
+            else:
+                tor = instances[-1]  # take last launched instance
+        self.tor = tor
+        self.scheduler = tor.scheduler
+        if scheduler:
+            self.scheduler = create_scheduler(scheduler, tor)
+            # its requests count for tor as well, which drains and autoscales the ports by them
+            self.scheduler.share(tor.scheduler)
+        self.isolation = create_isolation(isolation)
+        self.cache = create_cache(cache)
+        self.pool_per_proxy = pool_per_proxy
+        self._pool_maxsize = pool_maxsize
+        self._pool_block = pool_block
+        self._proxy_adapters: dict = {}
+        self._adapters_lock = threading.Lock()
+        # the proxy of the request running in the current thread
+        self._local = threading.local()
+        super().__init__()
+
+    def request(
+        self,
+        method: str,
+        url: Union[str, bytes, Text],
+        params=None,
+        data=None,
+        headers: Optional[MutableMapping[Text, Text]] = None,
+        cookies: Union[
+            None, requests.sessions.RequestsCookieJar, MutableMapping[Text, Text]
+        ] = None,
+        files: Optional[MutableMapping[Text, IO[Any]]] = None,
+        auth: Union[
+            None,
+            Tuple[Text, Text],
+            requests.auth.AuthBase,
+            Callable[
+                [requests.sessions.PreparedRequest], requests.sessions.PreparedRequest
+            ],
+        ] = None,
+        timeout: Union[None, float, Tuple[float, float], Tuple[float, None]] = None,
+        allow_redirects: Optional[bool] = None,
+        proxies=None,
+        hooks=None,
+        stream: Optional[bool] = None,
+        verify: Union[None, bool, Text] = None,
+        cert: Union[Text, Tuple[Text, Text], None] = None,
+        json: Optional[Any] = None,
+        isolation_key: Any = None,
+        affinity_key: Any = None,
+    ) -> requests.Response:
+        cache, entry, body = self.cache, None, None
+        if cache is not None:
+            prepared = self.prepare_request(
+                requests.Request(method, url, params=params, headers=headers)
+            )
+            entry, fresh = cache.lookup(method, prepared.url, prepared.headers)
+            body = cache.body(entry) if entry is not None else None
+            if body is not None:
+                if fresh:
+                    return self._cached_response(entry, body, prepared)
+                headers = dict(headers or {}, **cache.conditional_headers(entry))
+        host = urllib.parse.urlsplit(requests.utils.to_native_string(url)).hostname
+        proxy = self.scheduler.acquire(
+            key=affinity_key if affinity_key is not None else host
+        )
+        credentials = self.isolation.credentials(host=host, key=isolation_key)
+        proxy_url = proxy.socks_url_for(*credentials or ())
+        if proxy_url.startswith("socks5://"):
+            # urllib3 resolves names of socks5:// proxies locally, socks5h:// leaves it to tor
+            proxy_url = "socks5h" + proxy_url[len("socks5") :]
+        proxies = {"http": proxy_url, "https": proxy_url}
+        self._local.proxy = self._local.last_proxy = proxy
+        start = time.perf_counter()
+        try:
+            response = super().request(
+                method,
+                url,
+                params,
+                data,
+                headers,
+                cookies,
+                files,
+                auth,
+                timeout,
+                allow_redirects,
+                proxies,  # here, the proxies defined above, are used
+                hooks,
+                stream,
+                verify,
+                cert,
+                json,
+            )
+        except Exception as e:
+            elapsed = time.perf_counter() - start
+            self.scheduler.release(proxy, elapsed, error=e)
+            proxy.metrics.request_done(elapsed, error=e)
+            raise
+        else:
+            elapsed = time.perf_counter() - start
+            self.scheduler.release(proxy, elapsed)
+            proxy.metrics.request_done(elapsed)
+            if not stream:
+                proxy.metrics.received(len(response.content))
+        finally:
+            self._local.proxy = None
+            if credentials and self.isolation.mode == "request" and not stream:
+                # a pool for one-off credentials would never be used again
+                self._drop_proxy_manager(proxy_url)
+        try:
+            # add the used proxy to the response
+            response.proxy = proxy
+        except:
+            log.debug(
+                "could not determine the proxy used for this request. error: ",
+                exc_info=True,
+            )
+        if cache is not None:
+            if body is not None and response.status_code == 304:
+                entry = cache.refresh(entry, response.headers)
+                response.close()
+                return self._cached_response(entry, body, prepared, proxy)
+            response.from_cache = False
+            if method.upper() not in ("GET", "HEAD", "OPTIONS", "TRACE"):
+                if response.status_code < 400:
+                    cache.invalidate(prepared.url)
+            elif (
+                not stream
+                and not response.history
+                and cache.storable(
+                    method, response.status_code, prepared.headers, response.headers
+                )
+            ):
+                cache.store(
+                    prepared.url,
+                    prepared.headers,
+                    response.status_code,
+                    response.reason,
+                    response.headers,
+                    response.content,
+                )
+        return response
+
+    def _cached_response(
+        self, entry: CacheEntry, body: bytes, prepared, proxy=None
+    ) -> requests.Response:
+        response = requests.Response()
+        response.status_code = entry.status
+        response.reason = entry.reason
+        response.headers = requests.structures.CaseInsensitiveDict(entry.headers)
+        response._content = body if prepared.method.upper() != "HEAD" else b""
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = entry.url
+        response.request = prepared
+        # the proxy of the revalidation, None when answered without one
+        response.proxy = proxy
+        response.from_cache = True
+        return response
+
+    def map(
+        self, requests: Iterable, workers: int = 8
+    ) -> Iterable[Tuple[Any, Union[requests.Response, Exception], Any]]:
+        """
+        sends many requests from a pool of ```workers``` threads, and yields
+        a ```(request, response or exception, proxy)``` tuple as each one completes.
+        the scheduler spreads the threads over the proxies.
+
+        requests are taken from ```requests``` only when a worker is free,
+        so it can be a (lazy) iterator over millions of items.
+        an item is a url, a ```(method, url)``` or ```(method, url, kwargs)``` tuple,
+        or a dict of keyword arguments for ```request()```, including "url" and optionally "method".
+
+            with RequestsSession(tor, pool_per_proxy=True) as session:
+                for request, resp, proxy in session.map(urls, workers=20):
+                    ...
+
+        :param requests: iterable of requests
+        :param workers: (int) number of threads, so max requests in flight
+        """
+        results = queue.Queue()
+        pending = iter(requests)
+        running = 0
+        with ThreadPoolExecutor(workers) as executor:
+            while True:
+                while running < workers:
+                    try:
+                        request = next(pending)
+                    except StopIteration:
+                        break
+                    executor.submit(self._map_one, request, results)
+                    running += 1
+                if not running:
+                    break
+                result = results.get()
+                running -= 1
+                yield result
+
+    def _map_one(self, request, results: queue.Queue):
+        # the proxy of an earlier request of this thread is not reported for this one
+        self._local.last_proxy = None
+        result = None
+        try:
+            # a malformed item is the result of that item, like a failed request
+            method, url, kwargs = _request_args(request)
+            result = self.request(method, url, **kwargs)
+        except Exception as e:
+            result = e
+        finally:
+            # map() waits for a result of every item
+            results.put((request, result, getattr(self._local, "last_proxy", None)))
+
+    def get_adapter(self, url):
+        proxy = getattr(self._local, "proxy", None)
+        if self.pool_per_proxy and proxy is not None:
+            if url.lower().startswith(("http://", "https://")):
+                return self._adapter_for(proxy)
+        return super().get_adapter(url)
+
+    def _adapter_for(self, proxy) -> _ProxyAdapter:
+        adapter = self._proxy_adapters.get(proxy)
+        if adapter is None:
+            with self._adapters_lock:
+                adapter = self._proxy_adapters.get(proxy)
+                if adapter is None:
+                    adapter = _ProxyAdapter(
+                        pool_maxsize=self._pool_maxsize, pool_block=self._pool_block
+                    )
+                    self._proxy_adapters[proxy] = adapter
+        return adapter
+
+    def close(self):
+        super().close()
+        with self._adapters_lock:
+            for adapter in self._proxy_adapters.values():
+                adapter.close()
+            self._proxy_adapters.clear()
+
+    def _drop_proxy_manager(self, proxy_url: str):
+        adapters = list(self.adapters.values()) + list(self._proxy_adapters.values())
+        for adapter in adapters:
+            manager = getattr(adapter, "proxy_manager", {}).pop(proxy_url, None)
+            if manager is not None:
+                manager.clear()
@@ -0,0 +1,328 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import ipaddress
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from typing import Optional
+
+__all__ = ["TorResolver"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+log = logging.getLogger(__name__)
+
+_TYPE_A = 1
+_CLASS_IN = 1
+_NXDOMAIN = 3
+_SOCKS_HOST_UNREACHABLE = 4
+
+
+def _dns_query(qid: int, host: str) -> bytes:
+    # a standard query with recursion desired, for the A records of host
+    name = b"".join(
+        struct.pack("!B", len(label)) + label
+        for label in host.rstrip(".").encode("idna").split(b".")
+    )
+    return (
+        struct.pack("!HHHHHH", qid, 0x0100, 1, 0, 0, 0)
+        + name
+        + b"\x00"
+        + struct.pack("!HH", _TYPE_A, _CLASS_IN)
+    )
+
+
+def _skip_name(data: bytes, offset: int) -> int:
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            # a compression pointer ends the name
+            return offset + 2
+        offset += 1 + length
+        if not length:
+            return offset
+
+
+def _parse_dns_reply(data: bytes) -> tuple[int, int, list[str], int]:
+    """
+    returns ```(id, rcode, addresses, ttl)``` of a reply, ttl being the lowest of the A records
+    """
+    qid, flags, qdcount, ancount, _, _ = struct.unpack_from("!HHHHHH", data)
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(data, offset) + 4
+    addresses = []
+    ttl = None
+    for _ in range(ancount):
+        offset = _skip_name(data, offset)
+        rtype, rclass, rttl, length = struct.unpack_from("!HHIH", data, offset)
+        offset += 10
+        if rtype == _TYPE_A and rclass == _CLASS_IN and length == 4:
+            addresses.append(socket.inet_ntoa(data[offset : offset + 4]))
+            ttl = rttl if ttl is None else min(ttl, rttl)
+        offset += length
+    return qid, flags & 0x0F, addresses, ttl or 0
+
+
+class _DNSProtocol(asyncio.DatagramProtocol):
+    def __init__(self, qid: int, waiter: asyncio.Future):
+        self.qid = qid
+        self.waiter = waiter
+
+    def datagram_received(self, data, addr):
+        if self.waiter.done() or len(data) < 12:
+            return
+        if struct.unpack_from("!H", data)[0] == self.qid:
+            self.waiter.set_result(data)
+
+    def error_received(self, exc):
+        if not self.waiter.done():
+            self.waiter.set_exception(exc)
+
+
+class TorResolver:
+    """
+    resolves names through tor, never through the local resolver: over the ```DNSPort```
+    of the tor process, or with the RESOLVE socks extension (see ```SocksProxy.resolve```)
+    when there is no DNSPort or it does not answer.
+
+    answers are cached for their ttl, bounded by ```min_ttl``` and ```max_ttl```
+    (socks answers carry none, so they are kept ```ttl``` seconds), and names which do not
+    resolve are kept ```negative_ttl``` seconds. the cache holds at most ```maxsize``` names
+    and is shared across threads, so all sessions of a ```Tor``` use ```tor.resolver```.
+    concurrent lookups of the same name wait for a single query.
+
+        address = await tor.resolver.resolve("example.com")
+        tor.resolver.cached("example.com")   # without waiting, None when not cached
+
+    :param tor: the ```Tor``` whose DNSPort and proxies are used
+    :param ttl: (float) seconds a socks answer is cached
+    :param min_ttl: (float) min seconds a DNSPort answer is cached
+    :param max_ttl: (float) max seconds a DNSPort answer is cached
+    :param negative_ttl: (float) seconds a name which does not resolve is cached
+    :param maxsize: (int) max cached names, the least recently used are dropped first
+    :param timeout: (float) seconds a lookup may take
+    """
+
+    def __init__(
+        self,
+        tor=None,
+        ttl: float = 300,
+        min_ttl: float = 30,
+        max_ttl: float = 3600,
+        negative_ttl: float = 30,
+        maxsize: int = 4096,
+        timeout: float = 10,
+    ):
+        self.tor = tor
+        self.ttl = ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    @property
+    def dns_port(self) -> Optional[int]:
+        config = getattr(self.tor, "config", None)
+        if config is None or not getattr(self.tor, "running", False):
+            return None
+        return config.dns_port or None
+
+    def cached(self, host: str) -> Optional[str]:
+        """
+        returns the cached address of ```host``` (or ```host``` itself when it is an ip address),
+        or None when it is not cached, expired or did not resolve
+        """
+        if _is_address(host):
+            return host
+        entry = self._get(host.lower(), count=False)
+        return entry[0] if entry else None
+
+    async def resolve(self, host: str, proxy=None) -> str:
+        """
+        returns the address of ```host```, from the cache or looked up through tor.
+        raises ```socket.gaierror``` when it does not resolve
+
+        :param proxy: optional ```SocksProxy``` for the RESOLVE fallback. default: picked by the scheduler
+        """
+        addresses = await self.resolve_all(host, proxy)
+        return addresses[0]
+
+    async def resolve_all(self, host: str, proxy=None) -> list[str]:
+        """
+        like ```resolve```, but returns all addresses of ```host```
+        """
+        if _is_address(host):
+            return [host]
+        name = host.lower()
+        entry = self._get(name)
+        if entry is not None:
+            return self._answer(host, entry)
+        task = self._inflight.get((asyncio.get_running_loop(), name))
+        if task is None:
+            task = self._start(name, proxy)
+        else:
+            self.coalesced += 1
+        # a waiter which is cancelled does not cancel the lookup of the others
+        return self._answer(host, await asyncio.shield(task))
+
+    def prefetch(self, host: str, proxy=None):
+        """
+        looks ```host``` up in the background when it is not cached
+        """
+        if self.cached(host) is not None:
+            return
+        name = host.lower()
+        if (asyncio.get_running_loop(), name) not in self._inflight:
+            self.misses += 1
+            self._start(name, proxy)
+
+    def _start(self, name: str, proxy=None) -> asyncio.Task:
+        loop = asyncio.get_running_loop()
+        key = (loop, name)
+        task = loop.create_task(self._lookup(name, proxy))
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._inflight.pop(key, None))
+        # retrieves the exception, in case nobody waits for it anymore
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    def invalidate(self, host: str = None):
+        """
+        drops ```host``` (default: all names) from the cache
+        """
+        with self._lock:
+            if host is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(host.lower(), None)
+
+    def stats(self) -> dict:
+        return dict(
+            names=len(self._entries),
+            hits=self.hits,
+            misses=self.misses,
+            coalesced=self.coalesced,
+            failures=self.failures,
+        )
+
+    def _get(self, name: str, count: bool = True) -> Optional[list]:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                addresses, expires = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(name)
+                    self.hits += count
+                    return addresses
+                del self._entries[name]
+            self.misses += count
+            return None
+
+    def _put(self, name: str, addresses: list, ttl: float):
+        with self._lock:
+            self._entries[name] = (addresses, time.monotonic() + ttl)
+            self._entries.move_to_end(name)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _answer(host: str, addresses: list) -> list[str]:
+        if not addresses:
+            raise socket.gaierror(
+                socket.EAI_NONAME, "%s does not resolve through tor" % host
+            )
+        return addresses
+
+    async def _lookup(self, name: str, proxy=None) -> list:
+        port = self.dns_port
+        if port:
+            try:
+                addresses, ttl = await self._query(name, port)
+            except (OSError, asyncio.TimeoutError) as e:
+                log.debug("dns port lookup of %s failed: %r" % (name, e))
+            else:
+                if addresses:
+                    ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+                else:
+                    self.failures += 1
+                    ttl = self.negative_ttl
+                self._put(name, addresses, ttl)
+                return addresses
+        if proxy is None:
+            proxy = self.tor.scheduler.pick(self.tor.scheduler.proxies)
+        if proxy is None:
+            raise socket.gaierror(
+                socket.EAI_AGAIN, "no proxy to resolve %s through" % name
+            )
+        from .tor import SocksError
+
+        try:
+            address = await asyncio.wait_for(proxy.resolve(name), self.timeout)
+        except SocksError as e:
+            if e.code != _SOCKS_HOST_UNREACHABLE:
+                raise
+            # tor's answer to a name which does not resolve
+            self.failures += 1
+            self._put(name, [], self.negative_ttl)
+            return []
+        self._put(name, [address], self.ttl)
+        return [address]
+
+    async def _query(self, name: str, port: int) -> tuple[list, float]:
+        loop = asyncio.get_running_loop()
+        qid = struct.unpack("!H", os.urandom(2))[0]
+        waiter = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DNSProtocol(qid, waiter), remote_addr=("127.0.0.1", port)
+        )
+        try:
+            transport.sendto(_dns_query(qid, name))
+            reply = await asyncio.wait_for(waiter, self.timeout)
+        finally:
+            transport.close()
+        try:
+            _, rcode, addresses, ttl = _parse_dns_reply(reply)
+        except (struct.error, IndexError) as e:
+            # a truncated or garbled reply, the lookup falls back to socks
+            raise OSError("dns port sent a garbled reply for %s: %r" % (name, e))
+        if rcode not in (0, _NXDOMAIN):
+            raise OSError("dns port answered %s with rcode %d" % (name, rcode))
+        return addresses, ttl
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "%s(%d names, hits = %d, misses = %d, coalesced = %d)" % (
+            self.__class__.__name__,
+            len(self),
+            self.hits,
+            self.misses,
+            self.coalesced,
+        )
+
+
+def _is_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
@@ -0,0 +1,531 @@
+from __future__ import annotations
+
+import bisect
+import collections
+import hashlib
+import itertools
+import logging
+import math
+import random
+import threading
+import time
+from typing import Callable
+from typing import Union
+
+from .breaker import CircuitBreaker
+from .breaker import is_circuit_failure
+from .exits import ExitIndex
+
+__all__ = [
+    "ProxyScheduler",
+    "RoundRobinScheduler",
+    "LeastOutstandingScheduler",
+    "EWMAScheduler",
+    "PowerOfTwoScheduler",
+    "ConsistentHashScheduler",
+    "DistinctExitScheduler",
+    "SCHEDULERS",
+    "create_scheduler",
+]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+log = logging.getLogger(__name__)
+
+
+def _closed(proxies: list) -> list:
+    # the proxies whose breaker lets a request through, or all when there are none
+    available = [
+        p
+        for p in proxies
+        if getattr(p, "breaker", None) is None or p.breaker.available()
+    ]
+    return available or proxies
+
+
+DEFAULT_STRATEGY = "least_outstanding"
+
+
+class ProxyScheduler:
+    """
+    picks the proxy to use for the next request.
+
+    the scheduler keeps a live in-flight counter and an exponentially weighted
+    moving average (ewma) of the observed latency for every proxy. strategies
+    subclass this and implement ```_pick```.
+
+    a single scheduler is meant to be shared by all sessions using the same
+    Tor instance, so every session sees the load the others put on a proxy.
+    it is thread-safe, since RequestsSession is used from threads.
+
+    proxies whose circuit breaker (```SocksProxy.breaker```) is open are skipped,
+    unless every proxy is. the outcome passed to ```release``` feeds the breakers.
+    proxies whose ewma is more than ```outlier``` times the median of the others are
+    passed over as well, except for a single request every ```outlier_retry``` seconds,
+    which tells when they got faster again.
+
+    :param source: where to get the proxies from. either an object having a
+                   ```proxies``` attribute (like ```Tor```), a callable returning
+                   a list of proxies, or a list of proxies.
+    :param alpha: (float) weight of a new latency sample in the ewma
+    :param error_penalty: (float) latency (in seconds) to record for a request
+                          which failed on the circuit (see ```breaker.is_circuit_failure```)
+    :param outlier: (float) latency, relative to the median, beyond which a proxy is passed over.
+                    None keeps every proxy
+    :param outlier_retry: (float) seconds between the requests sent to a proxy passed over
+    """
+
+    name = None
+    # the strategy routes by key. the connector then leaves the choice to it,
+    # instead of preferring proxies with an idle connection
+    affinity = False
+    # the strategy passes over proxies which are a lot slower than the others
+    skips_outliers = True
+
+    def __init__(
+        self,
+        source=None,
+        alpha: float = 0.3,
+        error_penalty: float = 10.0,
+        outlier: float = 4.0,
+        outlier_retry: float = 10.0,
+    ):
+        self._source = source
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.outlier = outlier
+        self.outlier_retry = outlier_retry
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._ewma = {}
+        # proxy -> time.monotonic() of its last latency sample
+        self._sampled = {}
+
+    @property
+    def proxies(self) -> list:
+        source = self._source
+        if source is None:
+            return []
+        if hasattr(source, "proxies"):
+            return source.proxies
+        if callable(source):
+            return source()
+        return source
+
+    def in_flight(self, proxy) -> int:
+        return self._in_flight.get(proxy, 0)
+
+    def latency(self, proxy) -> float:
+        """
+        returns the best known latency for ```proxy```:
+        the ewma of observed requests, or the last latency measured by the proxy itself.
+        returns 0 when nothing is known yet.
+        """
+        ewma = self._ewma.get(proxy)
+        if ewma is not None:
+            return ewma
+        return proxy.latency or 0
+
+    def pick(self, proxies: list = None, key=None, warm=None):
+        """
+        returns the proxy to use, without accounting it as in-flight.
+
+        :param key: optional routing key (like the target host),
+                    used by strategies with ```affinity```
+        :param warm: optional set of proxies having an idle connection for ```key```,
+                     which strategies with ```affinity``` may prefer
+        """
+        if proxies is None:
+            proxies = self.proxies
+        with self._lock:
+            return self._select(proxies, key, warm)
+
+    def acquire(self, proxies: list = None, key=None, warm=None):
+        """
+        picks a proxy and marks it as in-flight.
+        every call must be paired with a call to ```release```
+        """
+        if proxies is None:
+            proxies = self.proxies
+        with self._lock:
+            proxy = self._select(proxies, key, warm)
+            self._in_flight[proxy] = self._in_flight.get(proxy, 0) + 1
+        breaker = getattr(proxy, "breaker", None)
+        if breaker:
+            breaker.acquired()
+        return proxy
+
+    def release(
+        self,
+        proxy,
+        latency: float = None,
+        error: Union[BaseException, bool] = False,
+    ):
+        """
+        marks a request on ```proxy``` as done and feeds its outcome back.
+        a release without latency and error (a cancelled request) is no outcome.
+
+        :param latency: (float) observed latency in seconds, if any
+        :param error: the exception the request failed with, or True.
+                      a failure of the circuit records ```error_penalty``` as latency,
+                      other errors (like an http error status) only their latency
+        """
+        breaker = getattr(proxy, "breaker", None)
+        if breaker:
+            if error or latency is not None:
+                breaker.record(error)
+            else:
+                breaker.cancelled()
+        if error is True or (error and is_circuit_failure(error)):
+            latency = max(latency or 0, self.error_penalty)
+        with self._lock:
+            count = self._in_flight.get(proxy, 0) - 1
+            if count > 0:
+                self._in_flight[proxy] = count
+            else:
+                self._in_flight.pop(proxy, None)
+            if latency is not None:
+                self._observe(proxy, latency)
+
+    def observe(self, proxy, latency: float):
+        """
+        feeds a latency sample for ```proxy``` which is not tied to a request
+        """
+        with self._lock:
+            self._observe(proxy, latency)
+
+    def forget(self, proxy=None):
+        """
+        drops the latency history of ```proxy```, or of all proxies when omitted.
+        useful after a new circuit has been requested.
+        """
+        with self._lock:
+            if proxy is None:
+                self._ewma.clear()
+                self._sampled.clear()
+            else:
+                self._ewma.pop(proxy, None)
+                self._sampled.pop(proxy, None)
+
+    def share(self, other: ProxyScheduler):
+        """
+        counts the requests in flight and the latencies together with ```other```,
+        so either of them sees the load the other puts on a proxy.
+        the requests in flight of this scheduler so far are dropped, so share before using it
+        """
+        if other is not self:
+            self._lock = other._lock
+            self._in_flight = other._in_flight
+            self._ewma = other._ewma
+            self._sampled = other._sampled
+
+    def _select(self, proxies: list, key=None, warm=None):
+        if not proxies:
+            raise LookupError("no proxies available to schedule")
+        if CircuitBreaker.tripped:
+            proxies = _closed(proxies)
+        if self.outlier and self.skips_outliers and len(proxies) > 2:
+            proxies = self._usual(proxies)
+        if len(proxies) == 1:
+            return proxies[0]
+        if key is not None and self.affinity:
+            return self._pick_key(proxies, key, warm)
+        return self._pick(proxies)
+
+    def _usual(self, proxies: list) -> list:
+        # the proxies which are not a lot slower than the median,
+        # and the ones passed over whose retry is due
+        known = sorted(l for l in (self._ewma.get(p) for p in proxies) if l)
+        if len(known) < 3:
+            return proxies
+        limit = self.outlier * known[len(known) // 2]
+        now = time.monotonic()
+        usual = [
+            p
+            for p in proxies
+            if self._ewma.get(p, 0) <= limit
+            or (
+                not self._in_flight.get(p)
+                and now - self._sampled.get(p, 0) >= self.outlier_retry
+            )
+        ]
+        return usual or proxies
+
+    def _explored(self, proxies: list) -> list:
+        # a proxy we know nothing about takes a single request until it is measured,
+        # instead of all the requests sent before the first one comes back
+        measured = [p for p in proxies if self.latency(p) or not self._in_flight.get(p)]
+        return measured or proxies
+
+    def _observe(self, proxy, latency: float):
+        self._sampled[proxy] = time.monotonic()
+        ewma = self._ewma.get(proxy)
+        if ewma is None:
+            self._ewma[proxy] = latency
+        else:
+            self._ewma[proxy] = self.alpha * latency + (1 - self.alpha) * ewma
+
+    def _default_latency(self, proxies: list) -> float:
+        # proxies we know nothing about are assumed to be as fast as the
+        # fastest known one, so they get explored
+        known = [l for l in (self.latency(p) for p in proxies) if l]
+        if known:
+            return min(known)
+        return 1.0
+
+    def _pick(self, proxies: list):
+        raise NotImplementedError
+
+    def _pick_key(self, proxies: list, key, warm=None):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "%s(proxies = %d, in flight = %d)" % (
+            self.__class__.__name__,
+            len(self.proxies),
+            sum(self._in_flight.values()),
+        )
+
+
+class RoundRobinScheduler(ProxyScheduler):
+    """
+    hands out the proxies one after another, ignoring load and latency.
+    """
+
+    name = "round_robin"
+    skips_outliers = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._counter = itertools.count()
+
+    def _pick(self, proxies: list):
+        return proxies[next(self._counter) % len(proxies)]
+
+
+class LeastOutstandingScheduler(ProxyScheduler):
+    """
+    picks the proxy with the fewest requests in flight.
+    ties are broken round-robin, so an idle pool is still rotated.
+    """
+
+    name = "least_outstanding"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._counter = itertools.count()
+
+    def _pick(self, proxies: list):
+        n = len(proxies)
+        offset = next(self._counter) % n
+        best = None
+        best_count = None
+        for i in range(n):
+            proxy = proxies[(offset + i) % n]
+            count = self._in_flight.get(proxy, 0)
+            if best is None or count < best_count:
+                best, best_count = proxy, count
+                if not count:
+                    break
+        return best
+
+
+class EWMAScheduler(ProxyScheduler):
+    """
+    picks a random proxy, weighted by the inverse of its ewma latency.
+    a circuit which is 10 times slower gets 10 times less traffic.
+    """
+
+    name = "ewma"
+
+    def _pick(self, proxies: list):
+        proxies = self._explored(proxies)
+        default = self._default_latency(proxies)
+        weights = [1 / (self.latency(p) or default) for p in proxies]
+        return random.choices(proxies, weights)[0]
+
+
+class PowerOfTwoScheduler(ProxyScheduler):
+    """
+    samples two random proxies and picks the one with the lowest cost,
+    where cost is ```(in flight + 1) * ewma latency```.
+    this combines load and latency while avoiding the herd behaviour
+    of always picking the single best proxy.
+    """
+
+    name = "power_of_two"
+
+    def _pick(self, proxies: list):
+        proxies = self._explored(proxies)
+        if len(proxies) == 1:
+            return proxies[0]
+        a, b = random.sample(proxies, 2)
+        default = self._default_latency(proxies)
+        if self._cost(a, default) <= self._cost(b, default):
+            return a
+        return b
+
+    def _cost(self, proxy, default: float) -> float:
+        return (self._in_flight.get(proxy, 0) + 1) * (self.latency(proxy) or default)
+
+
+class ConsistentHashScheduler(LeastOutstandingScheduler):
+    """
+    sticky routing: maps a routing key (by default the target host) to a proxy
+    on a consistent hash ring, so requests to the same site keep using the same
+    circuit, with its warm connections and tls sessions.
+
+    the load is bounded: a proxy with more than ```balance``` times the average
+    number of requests in flight is passed over for the next one on the ring.
+    of the first ```spread``` proxies of a key on the ring, one with an idle
+    connection for it is preferred, so the connections of an overflowing site are reused.
+    adding, removing or ejecting a proxy only remaps the keys of that proxy.
+    requests without a key are spread like ```LeastOutstandingScheduler```.
+
+    :param replicas: (int) points per proxy on the ring
+    :param balance: (float) max load of a proxy, relative to the average. > 1
+    :param spread: (int) number of proxies per key which may be used to reuse a connection
+    """
+
+    name = "consistent_hash"
+    affinity = True
+
+    def __init__(
+        self,
+        *args,
+        replicas: int = 100,
+        balance: float = 2.0,
+        spread: int = 3,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.replicas = replicas
+        self.balance = balance
+        self.spread = spread
+        self._rings = collections.OrderedDict()
+
+    def _pick_key(self, proxies: list, key, warm=None):
+        hashes, owners = self._ring(proxies)
+        total = sum(self._in_flight.get(p, 0) for p in proxies)
+        capacity = math.ceil(self.balance * (total + 1) / len(proxies))
+        start = bisect.bisect(hashes, _hash(str(key)))
+        seen = set()
+        first = None
+        for i in range(len(owners)):
+            proxy = owners[(start + i) % len(owners)]
+            if proxy in seen:
+                continue
+            seen.add(proxy)
+            if self._in_flight.get(proxy, 0) < capacity:
+                if not warm or proxy in warm:
+                    return proxy
+                if first is None:
+                    first = proxy
+            if first is not None and len(seen) >= self.spread:
+                break
+        if first is not None:
+            return first
+        return owners[start % len(owners)]
+
+    def _ring(self, proxies: list) -> tuple:
+        # the rings of the last few proxy lists, since the scheduler is
+        # asked with the pool, and with the pool minus an ejected proxy
+        ident = tuple(proxies)
+        ring = self._rings.get(ident)
+        if ring is None:
+            points = sorted(
+                (
+                    (_hash("%s:%s#%d" % (*proxy, i)), proxy)
+                    for proxy in proxies
+                    for i in range(self.replicas)
+                ),
+                key=lambda point: point[0],
+            )
+            ring = [h for h, _ in points], [p for _, p in points]
+            self._rings[ident] = ring
+            if len(self._rings) > 8:
+                self._rings.popitem(last=False)
+        else:
+            self._rings.move_to_end(ident)
+        return ring
+
+
+class DistinctExitScheduler(ProxyScheduler):
+    """
+    spreads the requests over the exits instead of over the socks ports.
+    proxies sharing a public ip are one exit; the exit with the fewest requests
+    in flight is picked (ties round-robin, so consecutive requests go out over
+    different exits), then its least busy proxy.
+    proxies with an unknown public ip count as an exit of their own.
+    """
+
+    name = "distinct_exits"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._counter = itertools.count()
+        self.index = ExitIndex()
+
+    def _pick(self, proxies: list):
+        groups = self.index.groups(proxies)
+        n = len(groups)
+        offset = next(self._counter) % n
+        best = None
+        best_count = None
+        for i in range(n):
+            group = groups[(offset + i) % n]
+            count = sum(self._in_flight.get(p, 0) for p in group)
+            if best is None or count < best_count:
+                best, best_count = group, count
+                if not count:
+                    break
+        return min(best, key=lambda p: self._in_flight.get(p, 0))
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(value.encode(), digest_size=8).digest(), "big"
+    )
+
+
+SCHEDULERS = {
+    cls.name: cls
+    for cls in (
+        RoundRobinScheduler,
+        LeastOutstandingScheduler,
+        EWMAScheduler,
+        PowerOfTwoScheduler,
+        ConsistentHashScheduler,
+        DistinctExitScheduler,
+    )
+}
+
+
+def create_scheduler(
+    strategy: Union[str, ProxyScheduler, Callable, None] = None, source=None, **kwargs
+) -> ProxyScheduler:
+    """
+    returns a scheduler for ```source```
+
+    :param strategy: name of the strategy (one of ```SCHEDULERS```),
+                     a ProxyScheduler subclass, or an existing ProxyScheduler instance
+                     which is returned as-is. defaults to ```DEFAULT_STRATEGY```
+    :param source: see ```ProxyScheduler```
+    """
+    if isinstance(strategy, ProxyScheduler):
+        return strategy
+    if strategy is None:
+        strategy = DEFAULT_STRATEGY
+    if isinstance(strategy, str):
+        try:
+            strategy = SCHEDULERS[strategy]
+        except KeyError:
+            raise ValueError(
+                "unknown scheduler strategy %r. choose one of %s"
+                % (strategy, ", ".join(SCHEDULERS))
+            )
+    return strategy(source, **kwargs)
@@ -2,8 +2,10 @@ from __future__ import annotations
 
 import asyncio
 import asyncio.subprocess
+import collections
 from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+import functools
 import logging
 import os
 from pathlib import Path
@@ -11,19 +13,33 @@ import re
 import socket
 import datetime
 import ssl
+import struct
 import time
 import shutil
+import urllib.parse
 from typing import Optional
 
-import aiohttp_socks.utils
-from stem import Signal as _Signal
-from stem import SocketClosed
-from stem.control import Controller as _Controller
-
+from . import exits
 from . import utils
-from .utils import PublicIPService
-
-__all__ = ["SocksProxy", "Tor", "TorRC"]
+from .autoscale import Autoscaler
+from .breaker import CircuitBreaker
+from .breaker import create_breaker
+from .control import ControlClient
+from .control import ControlClosed
+from .control import ControlError
+from .control import parse_keywords
+from .control import hash_control_password
+from .discovery import ExitDiscovery
+from .health import HealthMonitor
+from .health import ProxyState
+from .health import ProxyRegistry
+from .metrics import ProxyMetrics
+from .metrics import collect
+from .resolver import TorResolver
+from .scheduler import ProxyScheduler
+from .scheduler import create_scheduler
+
+__all__ = ["SocksProxy", "SocksError", "Tor", "TorRC"]
 
 
 def __getattr__(name):
@@ -34,6 +50,7 @@ def __getattr__(name):
 log = logging.getLogger(__name__)
 DEBUG = False
 DEFAULT_PORT = 10080
+BOOTSTRAP_TIMEOUT = 120
 INSTANCES = []
 
 if DEBUG:
@@ -62,6 +79,118 @@ def _check_requirements(tor: Tor = None):
         return False
 
 
+SOCKS5_CONNECT = 0x01
+# tor extensions, see socks-extensions.txt
+SOCKS5_RESOLVE = 0xF0
+SOCKS5_RESOLVE_PTR = 0xF1
+
+SOCKS5_ERRORS = {
+    0x01: "general SOCKS server failure",
+    0x02: "connection not allowed by ruleset",
+    0x03: "network unreachable",
+    0x04: "host unreachable",
+    0x05: "connection refused",
+    0x06: "TTL expired",
+    0x07: "command not supported",
+    0x08: "address type not supported",
+    # tor extended errors for onion services (ExtendedErrors on the SocksPort)
+    0xF0: "onion service descriptor can not be found",
+    0xF1: "onion service descriptor is invalid",
+    0xF2: "onion service introduction failed",
+    0xF3: "onion service rendezvous failed",
+    0xF4: "onion service missing client authorization",
+    0xF5: "onion service wrong client authorization",
+    0xF6: "onion service invalid address",
+    0xF7: "onion service introduction timed out",
+}
+
+_IPV4 = re.compile(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$")
+
+
+class SocksError(ConnectionError):
+    """
+    the socks proxy refused the request.
+    ```code``` is the reply code from the proxy, if any (see ```SOCKS5_ERRORS```)
+    """
+
+    def __init__(self, message: str, code: int = None):
+        super().__init__(message)
+        self.code = code
+
+
+@functools.lru_cache(maxsize=None)
+def _default_ssl_context() -> ssl.SSLContext:
+    # loading the ca certificates is expensive, so the context is shared
+    return ssl.create_default_context()
+
+
+@functools.lru_cache(maxsize=1024)
+def _pack_address(host: str) -> bytes:
+    if _IPV4.match(host):
+        return b"\x01" + socket.inet_aton(host)
+    if ":" in host:
+        return b"\x04" + socket.inet_pton(socket.AF_INET6, host.strip("[]"))
+    name = host.encode("idna")
+    if len(name) > 255:
+        raise ValueError("hostname too long: %s" % host)
+    return b"\x03" + bytes([len(name)]) + name
+
+
+def _socks5_request(
+    command: int, host: str, port: int, username: str = None, password: str = None
+) -> bytes:
+    """
+    the complete client side of a socks5 handshake: greeting, authentication and request.
+    only one method is offered, so the request can follow without waiting for the choice
+    """
+    if username:
+        user = username.encode()
+        passwd = (password or "").encode()
+        greeting = b"\x05\x01\x02\x01%c%s%c%s" % (len(user), user, len(passwd), passwd)
+    else:
+        greeting = b"\x05\x01\x00"
+    return (
+        greeting
+        + bytes([5, command, 0])
+        + _pack_address(host)
+        + struct.pack("!H", port)
+    )
+
+
+async def _read_socks5_reply(reader: asyncio.StreamReader) -> tuple[str, int]:
+    """
+    reads the replies to ```_socks5_request``` and returns the bound (address, port)
+    """
+    try:
+        version, method = await reader.readexactly(2)
+        if version != 0x05:
+            raise SocksError("not a socks5 proxy")
+        if method == 0xFF:
+            raise SocksError("no acceptable authentication method")
+        if method == 0x02:
+            _, status = await reader.readexactly(2)
+            if status != 0x00:
+                raise SocksError("socks5 authentication failed")
+        _, reply, _, address_type = await reader.readexactly(4)
+        if reply != 0x00:
+            raise SocksError(
+                SOCKS5_ERRORS.get(reply, "unknown socks5 error %#x" % reply), reply
+            )
+        if address_type == 0x01:
+            address = socket.inet_ntoa(await reader.readexactly(4))
+        elif address_type == 0x04:
+            address = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+        elif address_type == 0x03:
+            (length,) = await reader.readexactly(1)
+            address = (await reader.readexactly(length)).decode()
+        else:
+            raise SocksError("invalid address type %#x in socks5 reply" % address_type)
+        (port,) = struct.unpack("!H", await reader.readexactly(2))
+    except asyncio.IncompleteReadError:
+        raise SocksError("socks5 proxy closed the connection")
+    return address, port
+
+
 class ProxyType(Enum):
     SOCKS4 = 1
     SOCKS5 = 2
@@ -90,16 +219,71 @@ class SocksProxy:
         self.loop: asyncio.BaseEventLoop = None
         self._public_ip = ""
         self._public_ip_provided_by = None
+        # fingerprint of the exit relay, when found through the control port
+        self.exit_fingerprint: Optional[str] = None
         self._latency = 0
+        self._circuit_epoch = 0
+        self._generation = 0
+        self.metrics = ProxyMetrics()
+        self.breaker: Optional[CircuitBreaker] = create_breaker(self)
 
     @property
     def latency(self):
         return self._latency
 
+    @property
+    def generation(self) -> int:
+        """
+        counts the new circuits of this proxy, by ```Tor.newnym``` or ```renew_circuit```
+        """
+        return self._generation
+
     @property
     def socks_url(self) -> str:
         return "%s://%s:%d" % (self.scheme, self.host, self.port)
 
+    def socks_url_for(self, username: str = None, password: str = None) -> str:
+        """
+        returns the socks url including credentials, for circuit isolation
+        """
+        credentials = self.credentials_for(username, password)
+        if not credentials:
+            return self.socks_url
+        return "%s://%s:%s@%s:%d" % (
+            self.scheme,
+            urllib.parse.quote(credentials[0], safe=""),
+            urllib.parse.quote(credentials[1], safe=""),
+            self.host,
+            self.port,
+        )
+
+    def credentials_for(
+        self, username: str = None, password: str = None
+    ) -> Optional[tuple[str, str]]:
+        """
+        returns the socks credentials to send for ```username``` and ```password```,
+        tagged with the epoch of ```renew_circuit```, or None when there are none
+        """
+        if self._circuit_epoch:
+            # socks clients only authenticate with a non-empty password
+            username = "%s~%d" % (username or "aionion", self._circuit_epoch)
+            password = password or "aionion"
+        if not username:
+            return None
+        return username, password or ""
+
+    def renew_circuit(self):
+        """
+        moves new connections of this proxy to a fresh circuit, leaving the other ports alone.
+        tor has no per port NEWNYM, but it isolates streams by socks credentials,
+        so this changes the credentials sent from now on
+        """
+        self._circuit_epoch += 1
+        self._generation += 1
+        self.public_ip = ""
+        self._latency = 0
+        log.debug("%s renews its circuit (epoch %d)" % (self, self._circuit_epoch))
+
     @property
     def host_port_tuple(self):
         return tuple(self)
@@ -112,7 +296,9 @@ class SocksProxy:
     def public_ip(self, val):
         if val != self._public_ip:
             self._newnym_ts = datetime.datetime.now()
-        self._public_ip = val
+            self._public_ip = val
+            self.exit_fingerprint = None
+            exits.changed()
 
     async def open_connection(
         self,
@@ -121,33 +307,60 @@ class SocksProxy:
         ssl_context: ssl.SSLContext = None,
         server_hostname: str = None,
         limit: int = 2**16,
+        username: str = None,
+        password: str = None,
+        native: bool = True,
     ):
+        """
+        opens a connection to host:port through this proxy.
+
+        :param username: (str) optional socks5 username. with ```password```, tor uses
+                         a separate circuit per distinct credential pair
+        :param native: (bool) use the built-in socks5 client (default)
+                       instead of aiohttp_socks
+        """
         if port in (443, 8443) or ssl_context:
             if not ssl_context:
-                ssl_context = ssl.create_default_context()
+                ssl_context = _default_ssl_context()
             if not server_hostname:
                 # server_hostname should be passed when using ssl
                 # instead of directly throwing an exception
                 # first try to 'fix' this
-                if not re.search(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$", host):
+                if not _IPV4.match(host):
                     # host does not look like an ip address
                     # set it as the server_hostname
                     server_hostname = host
 
+        if native:
+            return await self._open_connection(
+                host,
+                port,
+                ssl_context=ssl_context,
+                server_hostname=server_hostname,
+                limit=limit,
+                username=username,
+                password=password,
+            )
+        import aiohttp_socks.utils
+
         cstart = time.perf_counter()
         r, w = await aiohttp_socks.utils.open_connection(
-            proxy_url=self.socks_url,
+            proxy_url=self.socks_url_for(username, password),
             host=host,
             port=port,
             proxy_port=self.port,
             proxy_host=self.host,
             proxy_type=aiohttp_socks.ProxyType.SOCKS5,
+            username=username,
+            password=password,
             ssl=ssl_context,
             server_hostname=server_hostname,
             limit=limit,
         )
         cstop = time.perf_counter()
         self._latency = cstop - cstart
+        self.metrics.observe("connect", self._latency)
+        self.metrics.connection_opened(tracked=False)
         return r, w
 
     async def _open_connection(
@@ -158,65 +371,79 @@ class SocksProxy:
         ssl_context: ssl.SSLContext = None,
         server_hostname: str = None,
         limit=2**16,
+        username: str = None,
+        password: str = None,
         **kw,
     ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
-        import struct
-
+        """
+        native socks5 client. the greeting, authentication and CONNECT
+        are sent in a single write, and the replies read back in one go.
+        tls is only started when ```ssl_context``` is given.
+        """
+        username, password = self.credentials_for(username, password) or (None, None)
         cstart = time.perf_counter()
-        # connect to the proxy
-        preader, pwriter = await asyncio.open_connection(self.host, self.port, **kw)
-
-        # we do not authenticate to our local proxies
-        pwriter.write(bytearray([0x05, 0x01, 0x00]))
-
-        # so we don't need to read the response either
-        _ = await preader.read(2)
-        # print( _ )
-
-        host_packed = b""
-        typ = 0x03  # assuming a hostname default
+        reader, writer = await asyncio.open_connection(
+            self.host, self.port, limit=limit, **kw
+        )
+        try:
+            writer.write(
+                _socks5_request(SOCKS5_CONNECT, host, port, username, password)
+            )
+            await _read_socks5_reply(reader)
+            connected = time.perf_counter()
+            self.metrics.observe("connect", connected - cstart)
+            if ssl_context is not None:
+                if hasattr(writer, "start_tls"):
+                    await writer.start_tls(
+                        ssl_context, server_hostname=server_hostname or host
+                    )
+                else:
+                    await _upgrade_stream_tls(
+                        reader,
+                        writer,
+                        ssl_context,
+                        server_side=False,
+                        server_hostname=server_hostname or host,
+                    )
+                self.metrics.observe("tls", time.perf_counter() - connected)
+        except BaseException:
+            writer.close()
+            raise
+        self._latency = time.perf_counter() - cstart
+        # raw streams are not followed, so only the total number of connections is known
+        self.metrics.connection_opened(tracked=False)
+        return reader, writer
 
-        if re.search(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$", host):
-            # its an ip address
-            host_packed = socket.inet_aton(host)
-            # but it could also be an ip
-            typ = 0x01
+    async def resolve(
+        self, host: str, username: str = None, password: str = None
+    ) -> str:
+        """
+        resolves ```host``` through tor (the RESOLVE socks extension)
+        and returns the ip address
+        """
+        return await self._socks5_command(
+            SOCKS5_RESOLVE, host, username=username, password=password
+        )
 
-        elif re.search(r"([^0-9]{2,3})+", host):
-            # server_hostname = host
-            # as we already filtered ip addresses. this is probably a dns name
-            host_packed = struct.pack(f"!B{len(host)}s", len(host), host.encode())
-            # or just the hostname
-            typ = 0x03
+    async def resolve_ptr(
+        self, address: str, username: str = None, password: str = None
+    ) -> str:
+        """
+        reverse resolves an ip address through tor (the RESOLVE_PTR socks extension)
+        and returns the hostname
+        """
+        return await self._socks5_command(
+            SOCKS5_RESOLVE_PTR, address, username=username, password=password
+        )
 
-        else:
-            # probaby ip6
-            typ = 0x04
-            # not implemented yet
-        # print('host packed : ', host_packed)
-        port_packed = struct.pack("!H", port)
-        pwriter.write(bytearray([0x05, 0x01, 0x00, typ, *host_packed, *port_packed]))
-
-        _ = await preader.read(6)
-        loop = asyncio.get_running_loop()
-
-        # here the real shit happens
-        if ssl_context is not None or port == 443:
-            # if not server_hostname:
-            #     if host:
-            #         best luck
-            # server_hostname = host
-            # else:
-            #     raise Exception( "you need server_hostname when you use ssl/ttls" )
-            await _upgrade_stream_tls(
-                preader,
-                pwriter,
-                ssl_context,
-                server_side=False,
-                server_hostname=server_hostname,
-            )
-        self._latency = time.perf_counter() - cstart
-        return preader, pwriter
+    async def _socks5_command(self, command: int, host: str, **credentials) -> str:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(_socks5_request(command, host, 0, **credentials))
+            address, _ = await _read_socks5_reply(reader)
+            return address
+        finally:
+            writer.close()
 
     def __iter__(self):
         return iter([self.host, self.port])
@@ -239,14 +466,48 @@ class SocksProxy:
         )
 
 
+def _parse_socks_port(port) -> tuple[str, int]:
+    # a SocksPort entry is either a port or "host:port"
+    host = "127.0.0.1"
+    if isinstance(port, str) and ":" in port:
+        host, port = port.split(":")
+    return host, int(port)
+
+
 class Tor(object):
     _EXECUTOR = ThreadPoolExecutor()
 
-    def __init__(self, num_socks=15, start_port=DEFAULT_PORT):
+    def __init__(
+        self,
+        num_socks=15,
+        start_port=DEFAULT_PORT,
+        scheduler=None,
+        health=None,
+        breaker=None,
+        autoscale=None,
+        max_per_exit: int = None,
+        ip_lookup: str = "control",
+        resolver: dict = None,
+    ):
         """
         Creates a Tor proxy process
         :param dict settings: torrc settings (optional)
             key_name,value will be translated to a line of: KeyName str(value)
+        :param scheduler: name of a scheduler strategy (see ```scheduler.SCHEDULERS```)
+            or a ProxyScheduler instance. it is shared by all sessions using this instance.
+        :param health: (dict) optional settings for the ```health.HealthMonitor```
+            which probes the proxies in the background
+        :param breaker: (dict) optional settings for the ```breaker.CircuitBreaker```
+            of every proxy, or False to turn the breakers off
+        :param autoscale: (dict) settings for an ```autoscale.Autoscaler```
+            which adds and removes socks ports while running, or True for the defaults
+        :param max_per_exit: (int) optional. when more proxies than this turn out to share
+            an exit ip, the extra ones get a fresh circuit. see ```diversify_exits```
+        :param ip_lookup: (str) how the health probes find the exit of a proxy:
+            "control" asks the control port (```discovery.ExitDiscovery```),
+            falling back to "http", a lookup through the proxy at a public ip service
+        :param resolver: (dict) optional settings for the ```resolver.TorResolver```,
+            which resolves names over the DNSPort and is shared by all sessions using this instance
         """
 
         self.config = None
@@ -256,11 +517,36 @@ class Tor(object):
         self._exception = None
         self._running = False
         self._process = None
-        self._proxies = []
-        self._controller = None
+        self.registry = ProxyRegistry()
+        self.discovery: Optional[ExitDiscovery] = None
+        health = dict(health or {})
+        if ip_lookup == "control":
+            self.discovery = ExitDiscovery(self)
+            health.setdefault("probe", self.discovery.lookup)
+        elif ip_lookup != "http":
+            raise ValueError("unknown ip lookup %r" % ip_lookup)
+        self.monitor = HealthMonitor(self.registry, **health)
+        self._breaker = breaker
+        self.max_per_exit = max_per_exit
+        self._exit_renewals = collections.Counter()
+        if max_per_exit:
+            self.monitor.on_check = self._on_check
+        self._controller: Optional[ControlClient] = None
+        self._controller_lock = None
+        self._data_directory: Optional[utils.DataDirectory] = None
         self._tasks = set()
+        # the loop tor was started on, its tasks run there whichever thread asks for them
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._socks_ports_set = None
+        self._newnym = None
         self._num_socks = num_socks
         self._start_port = start_port
+        self.scheduler: ProxyScheduler = create_scheduler(scheduler, self)
+        self.resolver = TorResolver(self, **(resolver or {}))
+        self.autoscaler: Optional[Autoscaler] = None
+        if autoscale:
+            settings = autoscale if isinstance(autoscale, dict) else {}
+            self.autoscaler = Autoscaler(self, **settings)
 
     @property
     def process(self) -> asyncio.subprocess.Process:
@@ -272,7 +558,14 @@ class Tor(object):
             return True
         return False
 
-    async def start(self, torrc: TorRC = None):
+    async def start(self, torrc: TorRC = None, timeout: float = BOOTSTRAP_TIMEOUT):
+        """
+        starts the tor process and waits until it is bootstrapped.
+
+        :param torrc: (TorRC) optional configuration. by default a warm data directory
+                      is claimed (see ```utils.DataDirectory```) and free ports are picked
+        :param timeout: (float) max seconds to wait for the bootstrap to complete
+        """
         await asyncio.get_running_loop().run_in_executor(
             self._EXECUTOR, _check_requirements, self
         )
@@ -282,18 +575,9 @@ class Tor(object):
                 torrc = self.config
 
         if not torrc:
-            i = 0
-            data_directory = utils.TOR_DATA_FOLDER
-            while _data_dir_locked(data_directory):
-                new_data_directory = data_directory.with_name(str(i))
-                log.warning(
-                    f"{data_directory} is locked. trying another ({new_data_directory})"
-                )
-                i += 1
-                data_directory = new_data_directory
-
-            if not data_directory.exists():
-                data_directory.mkdir(parents=True, exist_ok=True)
+            if not self._data_directory:
+                self._data_directory = utils.DataDirectory.claim()
+            data_directory = self._data_directory.path
 
             running_instances = [t for t in INSTANCES]
             if len(running_instances) > 0:
@@ -311,8 +595,11 @@ class Tor(object):
                 data_directory=data_directory,
             )
 
+        self._loop = asyncio.get_running_loop()
         torrc.set_notify_on_change(self._on_config_change)
         self.config = torrc
+        self._sync_registry()
+        self.status_bootstrap = 0
 
         coro = asyncio.subprocess.create_subprocess_exec(
             self.binary_path,
@@ -324,148 +611,399 @@ class Tor(object):
             stdin=asyncio.subprocess.PIPE,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.STDOUT,
+            env=utils.tor_environment(self.binary_path),
         )
         self._process = await coro
-        retry = 3
+        # tor blocks when nobody reads its output
+        task = asyncio.ensure_future(self._log_output(self._process))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        try:
+            await asyncio.wait_for(self._wait_bootstrapped(), timeout)
+        except asyncio.TimeoutError:
+            log.warning(
+                "tor did not bootstrap within %ss (at %d%%)"
+                % (timeout, self.status_bootstrap)
+            )
+        if not self.running:
+            log.error("tor exited with code %s" % self.process.returncode)
+        else:
+            self.monitor.start()
+            if self.autoscaler:
+                self.autoscaler.start()
+        if self not in INSTANCES:
+            INSTANCES.append(self)
+        return self
+
+    async def _log_output(self, process: asyncio.subprocess.Process):
         while True:
-            line = None
-            try:
-                line = await asyncio.wait_for(self.process.stdout.readline(), 1)
-                log.debug(line)
-            except asyncio.TimeoutError:
-                pass
+            line = await process.stdout.readline()
             if not line:
-                # print( retry )
-                if not retry:
-                    break
-                if self.status_bootstrap > 0:
-                    continue
-                retry -= 1
-                continue
+                break
+            log.debug(line)
+
+    async def _wait_bootstrapped(self):
+        """
+        follows the bootstrap through STATUS_CLIENT events on the control port
+        until it is complete or the process exits
+        """
+        bootstrapped = asyncio.Event()
+
+        def on_status(event):
+            if event.args.split(" ", 2)[1:2] == ["BOOTSTRAP"]:
+                self._update_bootstrap(event.keywords(), bootstrapped)
+
+        delay = 0.05
+        controller = None
+        while self.running:
             try:
-                self.status_bootstrap = int(
-                    re.search(rb"Bootstrapped ([0-9]+)%", line)[1]
+                controller = await self.get_controller()
+                break
+            except (OSError, ControlError):
+                # control port not listening yet, or the cookie is not written yet
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.5)
+        if not controller:
+            return
+
+        await controller.add_event_listener(on_status, "STATUS_CLIENT")
+        try:
+            # the bootstrap may have progressed before we subscribed
+            phase = await controller.get_info("status/bootstrap-phase")
+            self._update_bootstrap(
+                parse_keywords(phase["status/bootstrap-phase"]), bootstrapped
+            )
+            exited = asyncio.ensure_future(self.process.wait())
+            waiter = asyncio.ensure_future(bootstrapped.wait())
+            try:
+                await asyncio.wait(
+                    [exited, waiter], return_when=asyncio.FIRST_COMPLETED
                 )
-                log.info("bootstrapped %s" % self.status_bootstrap)
-                if self.status_bootstrap == 100:
-                    break
-            except TypeError:
-                pass
-        if self not in INSTANCES:
-            INSTANCES.append(self)
-        return self
+            finally:
+                exited.cancel()
+                waiter.cancel()
+        finally:
+            if controller.is_alive():
+                await controller.remove_event_listener(on_status)
+
+    def _update_bootstrap(self, keywords: dict, bootstrapped: asyncio.Event):
+        try:
+            progress = int(keywords["PROGRESS"])
+        except (KeyError, ValueError):
+            return
+        if progress != self.status_bootstrap:
+            log.info("bootstrapped %s" % progress)
+        self.status_bootstrap = progress
+        if progress == 100:
+            bootstrapped.set()
 
     @property
-    def controller(self) -> _Controller:
-        if not self._controller:
-            if not self.process:
-                return
-            if not self.status_bootstrap == 100:
-                return
-            self._controller = _Controller.from_port(port=self.config.control_port)
-            self._controller.authenticate()
-        elif not self._controller.is_alive():
-            self._controller = None
-            return self.controller
+    def controller(self) -> Optional[ControlClient]:
+        """
+        the connected control client, or None when there is none (yet).
+        use ```await get_controller()``` to connect.
+        """
+        if self._controller and self._controller.is_alive():
+            return self._controller
+        return None
+
+    async def get_controller(self) -> Optional[ControlClient]:
+        """
+        returns an authenticated control client, connecting when needed.
+        returns None when tor is not running.
+        """
+        if self.controller:
+            return self._controller
+        if not self.running:
+            return
+        if not self._controller_lock:
+            self._controller_lock = asyncio.Lock()
+        async with self._controller_lock:
+            if not self.controller:
+                controller = await ControlClient.connect(port=self.config.control_port)
+                try:
+                    await controller.authenticate(
+                        password=self.config.control_password,
+                        cookie_path=Path(self.config.data_directory)
+                        / "control_auth_cookie",
+                    )
+                except BaseException:
+                    await controller.close()
+                    raise
+                self._controller = controller
         return self._controller
 
+    def _spawn(self, coro):
+        """
+        runs ```coro``` as a background task on the loop tor was started on,
+        from that loop or from any other thread. returns the ```asyncio.Task```
+        (or a ```concurrent.futures.Future``` from another thread), or None
+        when that loop is gone
+        """
+        loop = self._loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if loop is not None and loop is running:
+            task = loop.create_task(self._tracked(coro))
+            self._tasks.add(task)
+            return task
+        try:
+            if loop is None or loop.is_closed():
+                raise RuntimeError("tor has no running event loop")
+            return asyncio.run_coroutine_threadsafe(self._tracked(coro), loop)
+        except RuntimeError as e:
+            coro.close()
+            log.warning("%s could not schedule %s: %s" % (self, coro.__name__, e))
+            return None
+
+    async def _tracked(self, coro):
+        # cancelled by stop() like the other background tasks
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            return await coro
+        finally:
+            self._tasks.discard(task)
+
     def _on_config_change(self, key, val):
-        if not self.controller:
-            return asyncio.get_running_loop().call_later(
-                1, self._on_config_change, key, val
-            )
+        task = self._spawn(self._set_conf(key, val))
+        if task is not None and key == "socks_port":
+            # the new ports are handed out once tor listens on them
+            task.add_done_callback(self._on_socks_ports_set)
+            self._socks_ports_set = task
+
+    def _on_socks_ports_set(self, task):
+        if task.cancelled():
+            return
+        if task.exception():
+            log.warning("could not change the socks ports: %r" % task.exception())
+            return
+        self._sync_registry()
 
+    async def add_socks_ports(self, count: int = 1) -> list[SocksProxy]:
+        """
+        opens ```count``` more socks ports on the running process.
+        sessions pick them up as soon as tor listens on them
+
+        :return: (list) the new proxies
+        """
+        ports = list(self.config.socks_port)
+        used = {_parse_socks_port(p)[1] for p in ports}
+        used.update(
+            (
+                self.config.control_port,
+                self.config.dns_port,
+                self.config.http_tunnel_port,
+            )
+        )
+        port = max(used)
+        new = []
+        for _ in range(count):
+            port = utils.free_port(port + 1)
+            while port in used:
+                port = utils.free_port(port + 1)
+            used.add(port)
+            new.append(port)
+        self.config.socks_port = ports + new
+        await asyncio.shield(asyncio.wrap_future(self._socks_ports_set))
+        return [self.registry.get("127.0.0.1", port) for port in new]
+
+    async def remove_socks_ports(self, proxies: list, drain_timeout: float = 30):
+        """
+        closes the socks ports of ```proxies```. they are no longer handed out right away,
+        and the ports are closed once their requests in flight are done
+        (or after ```drain_timeout``` seconds)
+        """
+        keys = {tuple(p) for p in proxies}
+        self.registry.drain(proxies)
+        deadline = time.monotonic() + drain_timeout
+        while time.monotonic() < deadline and any(
+            self.scheduler.in_flight(p) for p in proxies
+        ):
+            await asyncio.sleep(0.05)
+        self.config.socks_port = [
+            p for p in self.config.socks_port if _parse_socks_port(p) not in keys
+        ]
+        await asyncio.shield(asyncio.wrap_future(self._socks_ports_set))
+
+    async def _set_conf(self, key, val):
         key = "".join(k.capitalize() for k in key.split("_"))
 
         if isinstance(val, int):
             val = [str(val)]
         if isinstance(val, list):
             val = [str(v) for v in val]
-        try:
-            self.controller.set_conf(key, val)
-        except SocketClosed:
-            self._controller = None
-            self._on_config_change(key, val)
+        while True:
+            controller = await self.get_controller()
+            if not controller:
+                await asyncio.sleep(1)
+                continue
+            try:
+                return await controller.set_conf(key, val)
+            except ControlClosed:
+                self._controller = None
 
     @property
-    def proxies(self):
-        def on_done_latency(task: asyncio.Task):
-            name = task.get_name()
-            try:
-                self._tasks.discard(task)
-                proxy = task.result()
-                if not proxy:
-                    exc = task.exception()
-                    raise exc
-            except Exception as e:
-                try:
-                    proxy = [_ for _ in self._proxies if str(_.port) == str(name)][0]
-                    task = asyncio.ensure_future(
-                        PublicIPService.get_ip(proxy, timeout=5)
-                    )
-                    # print('RE ADDING TASK %s FOR PROXY %s' % (task, proxy))
-                    task.set_name(proxy.port)
-                    task.add_done_callback(on_done_latency)
-
-                    self._tasks.add(task)
-                    return
-                except IndexError:
-                    pass
-                except:
-                    log.debug(
-                        "on done latency - inner exception -  exception re-adding task",
-                        exc_info=True,
-                    )
+    def proxies(self) -> list[SocksProxy]:
+        """
+        the usable proxies: all socks ports which are not dead.
+        this is a plain read of the registry, the probing happens in ```self.monitor```
+        """
+        return self.registry.proxies
 
-        # store the proxies in a local variable
-        # so we can reuse them (and save on latency calcs)
-        prxs = []
-        for p in self._proxies:
-            prxs.append(p)
-        self._proxies.clear()
-        host = "127.0.0.1"
-
-        if self.config:
-            for port in self.config.socks_port:
-                candidate = [p for p in prxs if p.port == port]
-                if candidate:
-                    proxy = candidate[0]
-                elif isinstance(port, (str)):
-                    if ":" in port:
-                        host, port = port.split(":")
-                    proxy = SocksProxy(host=host, port=int(port))
-                else:
-                    proxy = SocksProxy(host="127.0.0.1", port=int(port))
-
-                if not proxy.latency or not proxy.public_ip:
-                    if not any([t.get_name() == str(proxy.port) for t in self._tasks]):
-                        # if not proxy.port in self._tasks:
-                        # only update latency/ip when not already scheduled
-                        task = asyncio.ensure_future(
-                            PublicIPService.get_ip(proxy, timeout=5)
-                        )
-                        task.set_name(proxy.port)
-                        task.add_done_callback(on_done_latency)
-                        self._tasks.add(task)
-                self._proxies.append(proxy)
-        return self._proxies
-
-    def newnym(self):
-        if self.controller.get_newnym_wait() > 0:
+    def stats(self) -> dict:
+        """
+        returns the metrics of every proxy (see ```metrics.ProxyMetrics```),
+        with its health state and in-flight requests, and pool wide totals.
+        ```metrics.to_prometheus(tor.stats())``` renders it for prometheus
+        """
+        stats = collect(self.registry.all, [self.registry], self.scheduler)
+        stats["pool"]["dns"] = self.resolver.stats()
+        return stats
+
+    def _sync_registry(self):
+        proxies = []
+        for port in self.config.socks_port if self.config else []:
+            host, port = _parse_socks_port(port)
+            proxies.append(self.registry.get(host, port) or SocksProxy(host, port))
+        added = self.registry.sync(proxies)
+        for proxy in added:
+            proxy.breaker = create_breaker(proxy, self._breaker)
+        self.monitor.recheck(added)
+
+    def newnym(self) -> bool:
+        """
+        requests new circuits for all socks ports without waiting for tor, like it always did:
+        the signal is sent by a task on the loop tor runs on, also when called from another thread.
+        returns True once that task is queued, False when tor does not accept a NEWNYM yet
+        or there is no control connection.
+        use ```await newnym_async()``` to know when the new circuits are in place
+        """
+        controller = self.controller
+        if not controller or controller.get_newnym_wait() > 0:
+            return False
+        if self._newnym and not self._newnym.done():
+            # the one before is still on its way
             return False
-        self.controller.signal(_Signal.NEWNYM)
-        self._proxies.clear()
-        self.proxies
+        task = self._spawn(self.newnym_async())
+        if task is None:
+            return False
+        self._newnym = task
+        task.add_done_callback(self._on_newnym)
+        return True
+
+    def _on_newnym(self, task):
+        if not task.cancelled() and task.exception():
+            log.warning("could not request new circuits: %r" % task.exception())
+
+    async def newnym_async(self) -> bool:
+        """
+        requests new circuits for all socks ports, connecting the controller when needed.
+        returns False when tor does not accept a NEWNYM yet
+        """
+        controller = await self.get_controller()
+        if not controller or controller.get_newnym_wait() > 0:
+            return False
+        await controller.signal("NEWNYM")
+        for proxy in self.registry:
+            # invalidates the cached ip and the kept connections of the old circuit
+            proxy._generation += 1
+            proxy.public_ip = ""
+            proxy._latency = 0
+            if proxy.breaker:
+                # every circuit is new
+                proxy.breaker.reset()
+        self.scheduler.forget()
+        self.monitor.recheck()
         return True
 
+    def exits(self) -> dict:
+        """
+        returns ```{public ip: [proxies]}``` of the proxies with a known public ip
+        """
+        groups = {}
+        for proxy in self.registry:
+            if proxy.public_ip:
+                groups.setdefault(proxy.public_ip, []).append(proxy)
+        return groups
+
+    def diversify_exits(self, max_per_exit: int = 1, max_renewals: int = 3) -> list:
+        """
+        gives the proxies beyond ```max_per_exit``` on the same exit a fresh circuit
+        (see ```SocksProxy.renew_circuit```) and has their exit looked up again.
+        the busiest proxies of an exit keep theirs. a proxy is renewed at most
+        ```max_renewals``` times in a row, in case there are not enough exits to go around.
+
+        :return: (list) the renewed proxies
+        """
+        renewed = []
+        crowded = set()
+        for proxies in self.exits().values():
+            if len(proxies) <= max_per_exit:
+                continue
+            proxies.sort(key=self.scheduler.in_flight, reverse=True)
+            for proxy in proxies[max_per_exit:]:
+                crowded.add(proxy)
+                if self._exit_renewals[proxy] < max_renewals:
+                    self._exit_renewals[proxy] += 1
+                    proxy.renew_circuit()
+                    renewed.append(proxy)
+        for proxy in list(self._exit_renewals):
+            if proxy not in crowded and proxy.public_ip:
+                del self._exit_renewals[proxy]
+        if renewed:
+            log.debug("renewing %d circuits sharing an exit" % len(renewed))
+            self.monitor.recheck(renewed)
+        return renewed
+
+    def _on_check(self, proxy, state):
+        if state is ProxyState.HEALTHY:
+            self.diversify_exits(self.max_per_exit)
+
     def _clear_latency(self):
-        for _ in self.proxies:
+        for _ in self.registry:
             _._latency = None
 
     def stop(self):
-        self.process.kill()
+        """
+        stops tor without waiting for it: kills the process and cancels the background tasks.
+        in a coroutine use ```await aclose()```, which also waits until both are gone
+        """
+        self._shutdown()
+
+    async def aclose(self):
+        """
+        stops tor and waits until the process exited and the background tasks are finished
+        """
+        process = self.process
+        tasks = self._shutdown()
+        if process:
+            await process.wait()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _shutdown(self) -> list[asyncio.Task]:
+        if self.running:
+            self.process.kill()
+        tasks = [self.monitor.stop()]
+        if self.discovery:
+            self.discovery.close()
+        if self.autoscaler:
+            tasks.append(self.autoscaler.stop())
+        tasks.extend(self._tasks)
+        for task in self._tasks:
+            task.cancel()
+        # the control connection ends together with the process
+        self._controller = None
         self.config = None
-        INSTANCES.remove(self)
+        self.registry.clear()
+        if self._data_directory:
+            self._data_directory.release()
+            self._data_directory = None
+        if self in INSTANCES:
+            INSTANCES.remove(self)
+        return [task for task in tasks if task]
 
     def __repr__(self):
         nports = ""
@@ -474,23 +1012,6 @@ class Tor(object):
         return f"<{self.__class__.__name__} < running {self.running}, {nports} >"
 
 
-def _data_dir_locked(datadir: Path):
-    try:
-        b = datadir / "control_auth_cookie"
-        b2 = datadir / "lock"
-        b.unlink(missing_ok=True)
-        b2.unlink(missing_ok=True)
-    except OSError:
-        return True
-    except PermissionError:
-        return True
-    except FileNotFoundError:
-        return False
-    except BaseException as e:
-        raise e
-    return False
-
-
 class TorRC(dict):
     def __init__(
         self,
@@ -502,7 +1023,7 @@ class TorRC(dict):
         new_circuit_period=15,
         cookie_authentication=1,
         enforce_distinct_subnets=0,
-        hashed_control_password="qwerty",
+        hashed_control_password=None,
     ):
         self._notify_on_change = None
 
@@ -524,13 +1045,21 @@ class TorRC(dict):
         self.new_circuit_period = new_circuit_period
         self.cookie_authentication = cookie_authentication
         self.enforce_distinct_subnets = enforce_distinct_subnets
-        # self.hashed_control_password = [
-        #      hashed_control_password for n in range( len( self.socks_port ) )]
-        #
+        # the plain text password is kept for authenticating our own controller.
+        # tor only gets the hash
+        self._control_password = hashed_control_password
+        if hashed_control_password:
+            self.hashed_control_password = hash_control_password(
+                hashed_control_password
+            )
 
         super().__init__(self.__dict__)
         super().__setattr__("__dict__", self)
 
+    @property
+    def control_password(self):
+        return self._control_password
+
     def set_notify_on_change(self, callback):
         self._notify_on_change = callback
 
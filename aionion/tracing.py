@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import collections
+import json
+import logging
+import random
+import threading
+import time
+from typing import Optional
+from typing import Union
+
+__all__ = ["RequestTracer", "create_tracer"]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(name)
+
+
+log = logging.getLogger(__name__)
+
+
+class RequestTracer:
+    """
+    times the phases of a sample of the ```ClientSession``` requests:
+
+        queued  - waiting for a free connection from the pool
+        socks   - socks handshake, including tor building the circuit and stream
+        tls     - tls handshake with the target
+        connect - the whole new connection (socks + tls)
+        send    - from connected until the request headers are sent
+        wait    - from sent until the response headers arrived (the server and the circuit)
+        total   - the whole request, up to the response headers
+
+    each record is tagged with the proxy used. the records of the last ```keep```
+    sampled requests are in ```records```, and optionally appended to ```log_path```
+    as compact json lines:
+
+        {"t": 1700000000.1, "m": "GET", "u": "https://example.com/", "p": "127.0.0.1:10080",
+         "s": 200, "r": 1, "ph": {"queued": 0.0, "wait": 0.21, "total": 0.23}}
+
+    sampled requests report their latency to the scheduler without the time
+    they were queued for a connection, which is not the proxy's doing.
+
+    :param sample_rate: (float) share of the requests to trace, 0..1
+    :param log_path: (str) optional file to append the records to
+    :param keep: (int) number of recent records to keep in memory
+    """
+
+    def __init__(self, sample_rate: float = 0.1, log_path: str = None, keep=1000):
+        self.sample_rate = sample_rate
+        self.log_path = log_path
+        self.records = collections.deque(maxlen=keep)
+        self._log_file = None
+        self._log_lock = threading.Lock()
+        from aiohttp import TraceConfig
+
+        self.trace_config = TraceConfig()
+        self.trace_config.on_connection_queued_start.append(self._on_queued_start)
+        self.trace_config.on_connection_queued_end.append(self._on_queued_end)
+        self.trace_config.on_connection_create_start.append(self._on_create_start)
+        self.trace_config.on_connection_create_end.append(self._on_create_end)
+        self.trace_config.on_connection_reuseconn.append(self._on_reuseconn)
+        self.trace_config.on_request_headers_sent.append(self._on_headers_sent)
+        self.trace_config.on_request_end.append(self._on_request_end)
+        self.trace_config.on_request_exception.append(self._on_request_exception)
+
+    def sample(self) -> Optional[dict]:
+        """
+        returns a new phases dict when the next request should be traced, otherwise None
+        """
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            return {"_start": time.perf_counter()}
+        return None
+
+    def close(self):
+        with self._log_lock:
+            if self._log_file:
+                self._log_file.close()
+                self._log_file = None
+
+    @staticmethod
+    def _phases() -> Optional[dict]:
+        from .integrations import _request_slot
+
+        slot = _request_slot.get()
+        return slot.phases if slot is not None else None
+
+    @staticmethod
+    def _mark(name: str):
+        # stores the time of an event, relative to the start of the request
+        phases = RequestTracer._phases()
+        if phases is not None:
+            phases["_" + name] = time.perf_counter()
+        return phases
+
+    async def _on_queued_start(self, session, ctx, params):
+        self._mark("queued")
+
+    async def _on_queued_end(self, session, ctx, params):
+        phases = self._phases()
+        if phases is not None and "_queued" in phases:
+            phases["queued"] = phases.get("queued", 0) + (
+                time.perf_counter() - phases.pop("_queued")
+            )
+
+    async def _on_create_start(self, session, ctx, params):
+        self._mark("connect")
+
+    async def _on_create_end(self, session, ctx, params):
+        phases = self._mark("connected")
+        if phases is not None and "_connect" in phases:
+            phases["connect"] = phases["_connected"] - phases["_connect"]
+            phases["reused"] = 0
+
+    async def _on_reuseconn(self, session, ctx, params):
+        phases = self._mark("connected")
+        if phases is not None:
+            phases["reused"] = 1
+
+    async def _on_headers_sent(self, session, ctx, params):
+        self._mark("sent")
+
+    async def _on_request_end(self, session, ctx, params):
+        phases = self._phases()
+        if phases is not None:
+            self._finish(phases, params.method, params.url, params.response.status)
+
+    async def _on_request_exception(self, session, ctx, params):
+        phases = self._phases()
+        if phases is not None:
+            self._finish(phases, params.method, params.url, None, params.exception)
+
+    def _finish(self, phases: dict, method, url, status=None, error=None):
+        from .integrations import _request_slot
+
+        now = time.perf_counter()
+        start = phases["_start"]
+        connected = phases.get("_connected")
+        sent = phases.get("_sent")
+        if connected and sent:
+            phases["send"] = sent - connected
+        if sent and status is not None:
+            phases["wait"] = now - sent
+        phases["total"] = now - start
+        slot = _request_slot.get()
+        proxy = slot.proxy if slot is not None else None
+        record = {
+            "t": round(time.time(), 3),
+            "m": method,
+            "u": str(url),
+            "p": "%s:%d" % tuple(proxy) if proxy is not None else None,
+            "s": status,
+            "ph": {
+                k: round(v, 6)
+                for k, v in phases.items()
+                if k[0] != "_" and k != "reused"
+            },
+        }
+        if "reused" in phases:
+            record["r"] = phases["reused"]
+        if error is not None:
+            record["e"] = type(error).__name__
+        self.records.append(record)
+        if self.log_path:
+            self._write(record)
+
+    def _write(self, record: dict):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._log_lock:
+            try:
+                if not self._log_file:
+                    self._log_file = open(self.log_path, "a", encoding="utf-8")
+                self._log_file.write(line)
+            except OSError:
+                log.warning(
+                    "could not write trace log %s" % self.log_path, exc_info=True
+                )
+                self.log_path = None
+
+    def __repr__(self):
+        return "%s(sample_rate = %s, records = %d)" % (
+            self.__class__.__name__,
+            self.sample_rate,
+            len(self.records),
+        )
+
+
+def create_tracer(
+    tracing: Union[float, RequestTracer, None] = None,
+) -> Optional[RequestTracer]:
+    """
+    returns ```tracing``` when it is a RequestTracer already, a new one
+    using ```tracing``` as sample rate, or None when tracing is off
+    """
+    if isinstance(tracing, RequestTracer) or tracing is None:
+        return tracing
+    if not tracing:
+        return None
+    return RequestTracer(sample_rate=float(tracing))
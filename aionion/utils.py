@@ -1,30 +1,23 @@
-import io
 import json
 import logging
 import os
 from pathlib import Path
 import re
 import socket
-import ssl
 import sys
-import tarfile
+from typing import Any
 from typing import AnyStr
 from typing import Awaitable
 from typing import Callable
-from typing import IO
+from typing import Mapping
+from typing import Tuple
 from typing import Union
-import urllib.parse
 
 import async_timeout
-import bs4
 import time
 
-try:
-    # python >= 3.9
-    from packaging.version import Version
-except ImportError:
-    # python < 3.9
-    from distutils.version import LooseVersion as Version
+from .ipcache import IPCache
+from .ipcache import RateLimiter
 
 WIN = sys.platform.startswith("win")
 MAC = sys.platform.startswith("darwin")
@@ -83,11 +76,125 @@ TOR_VERSION_REGEX = re.compile(r"[+-]?([0-9]*[.])?[0-9]+")
 URL_BASE = "https://dist.torproject.org/torbrowser/"
 URL_PLAT_NAME = WIN and "windows" or MAC and "osx" or UNIX and "linux"
 
-# fix for linux not finding libcrypto
-if UNIX | MAC:
-    os.environ["LD_LIBRARY_PATH"] = os.pathsep.join(
-        [os.environ.get("LD_LIBRARY_PATH", ""), str(TOR_BIN_FOLDER / "tor")]
+
+def tor_environment(binary_path: Union[str, Path] = TOR_BIN_EXECUTABLE) -> dict:
+    """
+    the environment for a tor process. the expert bundle ships its own libcrypto
+    next to the binary, which the linker finds through LD_LIBRARY_PATH.
+    only the tor process gets it, so importing aionion leaves the environment alone
+    """
+    env = dict(os.environ)
+    if UNIX | MAC:
+        env["LD_LIBRARY_PATH"] = os.pathsep.join(
+            [env.get("LD_LIBRARY_PATH", ""), str(Path(binary_path).parent)]
+        )
+    return env
+
+
+class DataDirectory:
+    """
+    a tor data directory claimed for exclusive use by one Tor instance.
+
+    data directories are kept between runs in numbered slots below a base folder,
+    so tor finds its cached consensus, descriptors and guards on the next start
+    instead of downloading them again. a slot is claimed with an os level lock,
+    which is released when the process exits, so a crashed run never leaves
+    a slot blocked.
+
+    example:
+        data_dir = DataDirectory.claim()
+        ...
+        data_dir.release()
+    """
+
+    # files which make a warm start. in order of importance
+    CACHE_FILES = (
+        "cached-microdesc-consensus",
+        "cached-consensus",
+        "cached-microdescs",
+        "cached-certs",
     )
+    LOCK_FILE = "aionion.lock"
+
+    def __init__(self, path: Path, fd: int):
+        self.path = path
+        self._fd = fd
+
+    @classmethod
+    def claim(cls, base: Union[str, Path] = None) -> "DataDirectory":
+        """
+        claims the warmest free slot below ```base``` (default ```TOR_DATA_FOLDER```),
+        or a new one when all are in use
+        """
+        base = Path(base or TOR_DATA_FOLDER)
+        base.mkdir(parents=True, exist_ok=True)
+        slots = [p for p in base.iterdir() if p.is_dir() and p.name.isdigit()]
+        for path in sorted(slots, key=cls._warmth, reverse=True):
+            claimed = cls._try_claim(path)
+            if claimed:
+                return claimed
+        n = len(slots)
+        while True:
+            path = base / str(n)
+            path.mkdir(parents=True, exist_ok=True)
+            claimed = cls._try_claim(path)
+            if claimed:
+                return claimed
+            n += 1
+
+    @classmethod
+    def _warmth(cls, path: Path) -> float:
+        for name in cls.CACHE_FILES:
+            try:
+                return (path / name).stat().st_mtime
+            except OSError:
+                continue
+        return 0
+
+    @classmethod
+    def _try_claim(cls, path: Path):
+        fd = os.open(path / cls.LOCK_FILE, os.O_CREAT | os.O_RDWR)
+        try:
+            if WIN:
+                import msvcrt
+
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        log.debug(
+            "claimed data directory %s (warm: %s)" % (path, cls._warmth(path) > 0)
+        )
+        return cls(path, fd)
+
+    @property
+    def warm(self) -> bool:
+        return self._warmth(self.path) > 0
+
+    def release(self):
+        if self._fd is None:
+            return
+        # closing the descriptor drops the lock
+        os.close(self._fd)
+        self._fd = None
+
+    def __fspath__(self):
+        return str(self.path)
+
+    def __str__(self):
+        return str(self.path)
+
+    def __repr__(self):
+        return "%s(%s, warm = %s, claimed = %s)" % (
+            self.__class__.__name__,
+            self.path,
+            self.warm,
+            self._fd is not None,
+        )
 
 
 def configure_console():
@@ -101,7 +208,8 @@ def configure_console():
     # must be windows
     from platform import win32_ver
 
-    if Version(win32_ver()[1]) >= Version("10.0.10586"):
+    build = tuple(int(n) for n in win32_ver()[1].split(".") if n.isdigit())
+    if build >= (10, 0, 10586):
         # noinspection PyUnboundLocalVariable
         windll.kernel32.SetConsoleMode(windll.kernel32.GetStdHandle(-11), 7)
         logging.getLogger(__package__).debug("windows console set to modern mode")
@@ -110,65 +218,13 @@ def configure_console():
 def download(
     output_dir: Union[str, Path] = TOR_BIN_FOLDER, version: Union[int, float] = 0
 ):
-    version = str(version)
-    output_dir = Path(output_dir)
-
-    try:
-        from urllib.request import urlopen
-    except ImportError:
-        # noinspection PyUnresolvedReferences
-        from urllib2 import urlopen
-
-    output_dir.mkdir(755, True, True)
-
-    # we don't like ssl error in this case
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-
-    with urlopen(URL_BASE, context=ctx) as response:
-        soup = bs4.BeautifulSoup(response, "lxml")
-        links = soup.find_all("a", href=TOR_VERSION_REGEX)
-        high_to_low = sort_href_version_ref(links)
-        highest = high_to_low[0]
-        next_url = urllib.parse.urljoin(URL_BASE, highest[1])  # 1 is index of value
-        log.info("moving to next url : %s " % next_url)
-
-    with urlopen(next_url, context=ctx) as response:
-        soup = bs4.BeautifulSoup(response, "lxml")
-        arch = "64"
-        plat = URL_PLAT_NAME
-        download_type = "expert-bundle"
-        ext = "tar.gz"
-        elems = soup.find_all(
-            "a",
-            href=lambda x: all([w in x for w in (plat, arch, download_type)])
-            and x.endswith(ext),
-        )
-        log.debug("found links:")
-        for elem in elems:
-            log.debug(elem.attrs.get("href"))
-        elem = elems[0]  # assuming first is best
-        log.debug("picked %s as the best candidate" % elem.attrs.get("href"))
-        next_url = urllib.parse.urljoin(next_url, elem.attrs.get("href"))
-        with urlopen(next_url) as response:
-            fileobj = io.BytesIO(response.read())
-            unpack_tar(fileobj, output_dir)
-
-
-def unpack_tar(buffer: IO, output_dir: Union[str, Path]):
-    tf = tarfile.open(fileobj=buffer)
-    for name in tf.getnames():
-        log.info("completed: %s" % name)
-    tf.extractall(output_dir)
-
+    """
+    installs the newest (or the given) tor expert bundle into ```output_dir```.
+    see ```installer.TorInstaller``` for the cache, the mirror and offline installs
+    """
+    from .installer import TorInstaller
 
-def sort_href_version_ref(elements):
-    versions = {
-        float(TOR_VERSION_REGEX.search(a.attrs.get("href"))[0]): a.attrs.get("href")
-        for a in elements
-    }
-    return [x for x in sorted(versions.items(), key=lambda i: i[0], reverse=True)]
+    return TorInstaller().install(output_dir, version=str(version) if version else None)
 
 
 def run_in_background_thread(tor):
@@ -204,6 +260,23 @@ def run_in_background_thread(tor):
     return bgt
 
 
+def _request_args(request) -> Tuple[str, Any, dict]:
+    """
+    normalizes an item of ```fetch_many``` / ```map``` to (method, url, kwargs).
+    an item is a url, a (method, url) or (method, url, kwargs) tuple,
+    or a dict of keyword arguments including "url" and optionally "method"
+    """
+    if isinstance(request, Mapping):
+        kwargs = dict(request)
+        method = kwargs.pop("method", "GET")
+        url = kwargs.pop("url")
+    elif isinstance(request, tuple):
+        method, url, kwargs = (*request, {})[:3]
+    else:
+        method, url, kwargs = "GET", request, {}
+    return method, url, kwargs
+
+
 def free_port(hint: int = 0) -> int:
     """
     returns a free port available to bind
@@ -223,6 +296,18 @@ def free_port(hint: int = 0) -> int:
 
 
 class PublicIPService:
+    """
+    looks up the public ip of a proxy at one of the ```APIS```, which also measures its latency.
+
+    the result is cached per circuit (see ```ipcache.IPCache```), so a lookup of a circuit
+    which was looked up less than ```cache.ttl``` seconds ago does not go out again.
+    the lookups use http/1.1 keep-alive, and the connection is kept for the next lookup
+    through the same proxy, as long as its circuit does not change and it was idle
+    for less than ```keepalive``` seconds. new connections (and their tls handshakes)
+    to the apis are rate limited for all proxies together by ```rate_limit```.
+    lookups over an ```open_connection``` of their own are neither pooled nor rate limited.
+    """
+
     APIS = [
         # tuples containing
         #  host
@@ -234,8 +319,22 @@ class PublicIPService:
         ("ip.seeip.org", 443, "/json", "ip"),
     ]
 
+    cache = IPCache()
+    rate_limit = RateLimiter(rate=10, burst=10)
+    keepalive = 30
+    # (event loop, proxy host, proxy port, api host) -> (generation, idle since, reader, writer)
+    _idle = {}
+
     @classmethod
-    async def get_ip(cls, proxy, timeout=2):
+    async def get_ip(cls, proxy, timeout=2, cached=True):
+        """
+        :param cached: (bool) answer from the cache when the current circuit was looked up recently
+        """
+        if cached:
+            entry = cls.cache.get(proxy)
+            if entry:
+                proxy.public_ip, proxy._latency, proxy._public_ip_provided_by = entry
+                return proxy
         return await cls(proxy, timeout).lookup()
 
     def __init__(self, proxy, timeout=2):
@@ -246,39 +345,40 @@ class PublicIPService:
     async def lookup(self, open_connection: Callable[[str, int], Awaitable] = None):
         """
         :param open_connection: optional: the open_connection function to use
-                                default: use the one from self.proxy
+                                default: use the one from self.proxy, and keep the connection
         """
+        pooled = not open_connection
         if not open_connection:
             open_connection = self.proxy.open_connection
-        success = None
-        result = None
         napis = len(self.APIS)
-        reader = None
-        writer = None
         for idx, (host, port, path, key) in enumerate(self.APIS):
             try:
+                connection = self._checkout(host) if pooled else None
+                if pooled and not connection:
+                    # outside of the timeout, waiting for our turn is not a failure
+                    await self.rate_limit.acquire()
                 async with async_timeout.timeout(self.timeout):
-                    reader, writer = await open_connection(host, port)
-                    writer.write(
-                        f"GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n\r\n".encode()
-                    )
-                    headers = await reader.readuntil(b"\r\n\r\n")
-                    # self.log.debug( 'headers: %s' % headers.decode() )
-                    body = await reader.read()
-                    body_str = body.decode()
-                    # self.log.debug( 'body: %s' % body_str )
-                    json_response = json.loads(body_str)
-                    result = json_response[key]
-                    self.proxy.public_ip = result
-                    self.proxy._public_ip_provided_by = host
-                    success = True
-                    self.log.debug(f"found ip {result} from {host} for proxy: {self}")
-                    break
+                    if connection:
+                        try:
+                            body, latency = await self._request(connection, host, path)
+                        except (ConnectionError, asyncio.IncompleteReadError):
+                            # the server closed the idle connection meanwhile
+                            connection = None
+                    if not connection:
+                        connection = await open_connection(host, port)
+                        body, latency = await self._request(connection, host, path)
+                    result = json.loads(body.decode())[key]
+                self.proxy.public_ip = result
+                self.proxy._public_ip_provided_by = host
+                self.proxy._latency = latency
+                self.cache.put(self.proxy, result, latency, host)
+                self.log.debug(f"found ip {result} from {host} for proxy: {self.proxy}")
+                break
             except (
                 asyncio.TimeoutError,
-                json.JSONDecodeError,
-                UnicodeDecodeError,
-                KeyError,
+                asyncio.IncompleteReadError,
+                ValueError,
+                LookupError,
             ) as e:
                 if idx >= napis - 1:
                     self.log.debug(
@@ -290,14 +390,97 @@ class PublicIPService:
                         )
                     )
                 continue
-            finally:
-                if writer:
-                    if not writer.is_closing():
-                        log.debug(f"closing writer to {host}:{port}")
-                        writer.close()
-                        await writer.wait_closed()
         return self.proxy
 
+    async def _request(self, connection, host: str, path: str) -> tuple[bytes, float]:
+        """
+        sends one request over ```connection``` and returns the body and the round trip time.
+        the connection is kept for the next lookup when the server allows it, else closed
+        """
+        reader, writer = connection
+        try:
+            start = time.perf_counter()
+            writer.write(
+                f"GET {path} HTTP/1.1\r\nHost: {host}\r\nAccept: application/json\r\n\r\n".encode()
+            )
+            status, body, keep_alive = await _read_http_response(reader)
+            latency = time.perf_counter() - start
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive:
+            self._checkin(host, reader, writer)
+        else:
+            writer.close()
+        if status != 200:
+            raise LookupError(f"{host} answered with status {status}")
+        return body, latency
+
+    def _checkout(self, host: str):
+        self._close_idle()
+        key = (asyncio.get_running_loop(), self.proxy.host, self.proxy.port, host)
+        entry = self._idle.pop(key, None)
+        if not entry:
+            return None
+        generation, _, reader, writer = entry
+        if generation != self.proxy.generation or reader.at_eof():
+            # the connection still uses the old circuit
+            writer.close()
+            return None
+        return reader, writer
+
+    def _checkin(self, host: str, reader, writer):
+        key = (asyncio.get_running_loop(), self.proxy.host, self.proxy.port, host)
+        entry = self._idle.get(key)
+        if entry:
+            entry[3].close()
+        self._idle[key] = (self.proxy.generation, time.monotonic(), reader, writer)
+
+    @classmethod
+    def _close_idle(cls):
+        loop = asyncio.get_running_loop()
+        expired = time.monotonic() - cls.keepalive
+        for key, (_, since, _, writer) in list(cls._idle.items()):
+            if key[0].is_closed():
+                cls._idle.pop(key, None)
+            elif key[0] is loop and since < expired:
+                cls._idle.pop(key, None)
+                writer.close()
+
+
+async def _read_http_response(reader) -> tuple[int, bytes, bool]:
+    """
+    reads an http/1.x response and returns its status, body
+    and whether the connection can be used for another request
+    """
+    head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+    version, status = head[0].split(" ", 2)[:2]
+    headers = {}
+    for line in head[1:]:
+        name, _, value = line.partition(":")
+        if name:
+            headers[name.strip().lower()] = value.strip()
+    keep_alive = (
+        version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+    )
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            if not size:
+                # skip the trailers
+                while await reader.readuntil(b"\r\n") != b"\r\n":
+                    pass
+                break
+            chunks.append((await reader.readexactly(size + 2))[:-2])
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        body = await reader.read()
+        keep_alive = False
+    return int(status), body, keep_alive
+
 
 import asyncio
 from itertools import islice
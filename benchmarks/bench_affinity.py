@@ -0,0 +1,100 @@
+"""
+new connections and latency when requests to many sites rotate over the proxies,
+versus sticky routing by consistent hashing of the target host.
+also reports the share of sites which move when a proxy is removed.
+
+    python -m benchmarks.bench_affinity [--requests 4000] [--sites 40] [--ports 10]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import aionion
+from aionion.scheduler import create_scheduler
+from benchmarks.standins import HttpServer
+from benchmarks.standins import SocksServer
+from benchmarks.standins import StandInTor
+from benchmarks.standins import Timer
+from benchmarks.standins import summary
+
+
+async def run(strategy, nrequests, concurrency, nports, nsites, setup_delay):
+    socks = await SocksServer(nports, {i: setup_delay for i in range(nports)}).start()
+    # every site has its own loopback address, so it is a different host
+    sites = [
+        await HttpServer(host="127.0.0.%d" % (i + 2), tls=True).start()
+        for i in range(nsites)
+    ]
+    tor = StandInTor(socks, strategy)
+    connector = aionion.ProxyConnectTor(tor, limit=100)
+    latencies = []
+    routes = set()
+    queue = iter(range(nrequests))
+    rng = random.Random(1)
+
+    async with aionion.ClientSession(tor, connector=connector) as session:
+
+        async def worker():
+            for _ in queue:
+                site = rng.choice(sites)
+                start = time.perf_counter()
+                async with session.get(site.url, ssl=False) as resp:
+                    await resp.read()
+                routes.add((site.host, resp.proxy.port))
+                latencies.append(time.perf_counter() - start)
+
+        with Timer() as timer:
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+    await socks.stop()
+    for site in sites:
+        await site.stop()
+    result = dict(
+        strategy=strategy,
+        connections=socks.connections,
+        proxies_per_site=round(len(routes) / nsites, 2),
+    )
+    result.update(summary(latencies, timer.elapsed))
+    return result
+
+
+def remapped(strategy, nports, nkeys=10000):
+    """
+    share of keys routed to another proxy after one of the proxies is removed
+    """
+    proxies = [("127.0.0.1", 10000 + i) for i in range(nports)]
+    scheduler = create_scheduler(strategy, proxies)
+    before = [scheduler.pick(proxies, key=k) for k in range(nkeys)]
+    after = [scheduler.pick(proxies[1:], key=k) for k in range(nkeys)]
+    return sum(a != b for a, b in zip(before, after)) / nkeys
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--ports", type=int, default=10)
+    parser.add_argument("--sites", type=int, default=40)
+    parser.add_argument("--setup-delay", type=float, default=0.02)
+    args = parser.parse_args()
+
+    for strategy in ("least_outstanding", "consistent_hash"):
+        result = asyncio.run(
+            run(
+                strategy,
+                args.requests,
+                args.concurrency,
+                args.ports,
+                args.sites,
+                args.setup_delay,
+            )
+        )
+        result["remapped_on_removal"] = round(remapped(strategy, args.ports), 3)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+failed requests with and without circuit breakers, against local SOCKS stand-ins
+where a few ports (dead circuits) fail every request.
+
+    python -m benchmarks.bench_breaker [--requests 2000] [--dead 2]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+from python_socks import ProxyError
+
+import aionion
+from aionion.breaker import create_breaker
+from benchmarks.standins import HttpServer
+from benchmarks.standins import SocksServer
+from benchmarks.standins import StandInTor
+from benchmarks.standins import Timer
+from benchmarks.standins import summary
+
+
+async def run(breaker, nrequests, concurrency, nports, ndead):
+    failures = {i: 1.0 for i in range(ndead)}
+    socks = await SocksServer(nports, failures=failures).start()
+    http = await HttpServer().start()
+    tor = StandInTor(socks, "round_robin")
+    for proxy in tor.proxies:
+        proxy.breaker = create_breaker(proxy, breaker)
+    latencies = []
+    errors = 0
+    queue = iter(range(nrequests))
+
+    # a new connection per request, so the idle connections do not hide the dead ports
+    connector = aionion.ProxyConnectTor(tor, force_close=True)
+    async with aionion.ClientSession(tor, connector=connector) as session:
+
+        async def worker():
+            nonlocal errors
+            for _ in queue:
+                start = time.perf_counter()
+                try:
+                    async with session.get(http.url) as resp:
+                        await resp.read()
+                except (aiohttp.ClientError, ProxyError):
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        with Timer() as timer:
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+    await socks.stop()
+    await http.stop()
+    result = dict(breaker=breaker is not False, errors=errors)
+    result.update(summary(latencies, timer.elapsed))
+    result["trips"] = sum(p.breaker.trips for p in tor.proxies if p.breaker)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--ports", type=int, default=10)
+    parser.add_argument("--dead", type=int, default=2, help="number of failing ports")
+    parser.add_argument("--failures", type=int, default=3)
+    parser.add_argument("--cooldown", type=float, default=1.0)
+    args = parser.parse_args()
+
+    settings = dict(failures=args.failures, cooldown=args.cooldown)
+    for breaker in (False, settings):
+        result = asyncio.run(
+            run(breaker, args.requests, args.concurrency, args.ports, args.dead)
+        )
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
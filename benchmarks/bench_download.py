@@ -0,0 +1,72 @@
+"""
+time to download one large file in a single stream versus in parallel ranges,
+over local SOCKS stand-ins with the bandwidth of a tor circuit, one of them much slower.
+
+    python -m benchmarks.bench_download [--size 8000000] [--bandwidth 400000] [--segments 8]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+
+import aionion
+from aionion.download import SegmentedDownload
+from benchmarks.standins import HttpServer
+from benchmarks.standins import SocksServer
+from benchmarks.standins import StandInTor
+from benchmarks.standins import Timer
+
+
+async def run(segments, size, nports, bandwidth, slow):
+    body = os.urandom(size)
+    rates = {i: bandwidth for i in range(nports)}
+    rates[nports - 1] = slow
+    socks = await SocksServer(nports, bandwidth=rates).start()
+    http = await HttpServer(body, ranges=True).start()
+    tor = StandInTor(socks, "round_robin")
+    async with aionion.ClientSession(tor) as session:
+        download = SegmentedDownload(
+            session, http.url, segments=segments, min_segment=256 * 1024
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            with Timer() as timer:
+                path = await download.run(os.path.join(tmp, "file"))
+            digest = hashlib.sha256(path.read_bytes()).hexdigest()
+    await socks.stop()
+    await http.stop()
+    return dict(
+        segments=segments,
+        seconds=round(timer.elapsed, 3),
+        mbytes_per_second=round(size / timer.elapsed / 1e6, 3),
+        proxies=len(download.proxies_used),
+        taken_over=download.taken_over,
+        failures=download.failures,
+        intact=digest == hashlib.sha256(body).hexdigest(),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=8_000_000)
+    parser.add_argument("--ports", type=int, default=10)
+    parser.add_argument(
+        "--bandwidth", type=float, default=400_000, help="bytes/s per circuit"
+    )
+    parser.add_argument(
+        "--slow", type=float, default=20_000, help="bytes/s of the slow circuit"
+    )
+    parser.add_argument("--segments", type=int, default=8)
+    args = parser.parse_args()
+
+    for segments in (1, args.segments):
+        result = asyncio.run(
+            run(segments, args.size, args.ports, args.bandwidth, args.slow)
+        )
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+compares ClientSession.fetch_many with utils.limited_as_completed
+for the same requests over local SOCKS stand-ins, reporting throughput
+and the cpu time used by the process. with slow proxies (```--delay```)
+the loop is mostly waiting, which is where busy polling shows.
+
+    python -m benchmarks.bench_fetch_many [--requests 2000] [--concurrency 100] [--delay 0.5]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import aionion
+from aionion import utils
+from benchmarks.standins import HttpServer
+from benchmarks.standins import SocksServer
+from benchmarks.standins import StandInTor
+from benchmarks.standins import Timer
+
+
+async def with_limited_as_completed(session, urls, concurrency):
+    async def fetch(url):
+        async with session.get(url) as resp:
+            return await resp.read()
+
+    done = 0
+    for next_result in utils.limited_as_completed(
+        (fetch(url) for url in urls), concurrency
+    ):
+        await next_result
+        done += 1
+    return done
+
+
+async def with_fetch_many(session, urls, concurrency):
+    done = 0
+    async for _, resp, _ in session.fetch_many(urls, concurrency=concurrency):
+        if isinstance(resp, Exception):
+            raise resp
+        done += 1
+    return done
+
+
+async def run(name, nrequests, concurrency, nports, delay):
+    socks = await SocksServer(nports, {i: delay for i in range(nports)}).start()
+    http = await HttpServer().start()
+    tor = StandInTor(socks, "least_outstanding")
+    urls = (http.url for _ in range(nrequests))
+    async with aionion.ClientSession(tor) as session:
+        cpu = time.process_time()
+        with Timer() as timer:
+            runner = (
+                with_fetch_many if name == "fetch_many" else with_limited_as_completed
+            )
+            done = await runner(session, urls, concurrency)
+        cpu = time.process_time() - cpu
+    await socks.stop()
+    await http.stop()
+    return dict(
+        helper=name,
+        requests=done,
+        rps=round(done / timer.elapsed, 1),
+        cpu_s=round(cpu, 3),
+        cpu_utilization=round(cpu / timer.elapsed, 2),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--ports", type=int, default=10)
+    parser.add_argument("--delay", type=float, default=0.5)
+    args = parser.parse_args()
+
+    for name in ("limited_as_completed", "fetch_many"):
+        result = asyncio.run(
+            run(name, args.requests, args.concurrency, args.ports, args.delay)
+        )
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+tail latency with and without hedged requests, against local SOCKS stand-ins
+where a few ports (bad circuits) are a lot slower than the others.
+
+    python -m benchmarks.bench_hedging [--requests 1000] [--budget 0.1]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import aionion
+from aionion.hedging import HedgePolicy
+from benchmarks.standins import HttpServer
+from benchmarks.standins import SocksServer
+from benchmarks.standins import StandInTor
+from benchmarks.standins import Timer
+from benchmarks.standins import summary
+
+SLOW_DELAY = 1.0
+BASE_DELAY = 0.01
+
+
+async def run(hedging, nrequests, concurrency, nports, nslow):
+    delays = {i: SLOW_DELAY if i < nslow else BASE_DELAY for i in range(nports)}
+    socks = await SocksServer(nports, delays).start()
+    http = await HttpServer().start()
+    # round robin keeps sending to the slow ports, like circuits which are slow at random
+    tor = StandInTor(socks, "round_robin")
+    connector = aionion.ProxyConnectTor(tor, force_close=True)
+    latencies = []
+    queue = iter(range(nrequests))
+
+    async with aionion.ClientSession(
+        tor, connector=connector, hedging=hedging
+    ) as session:
+
+        async def worker():
+            for _ in queue:
+                start = time.perf_counter()
+                async with session.get(http.url) as resp:
+                    await resp.read()
+                latencies.append(time.perf_counter() - start)
+
+        with Timer() as timer:
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+    await socks.stop()
+    await http.stop()
+    result = dict(hedging=bool(hedging), **summary(latencies, timer.elapsed))
+    if hedging:
+        result.update(hedging.stats())
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--ports", type=int, default=20)
+    parser.add_argument("--slow", type=int, default=1, help="number of slow ports")
+    parser.add_argument("--budget", type=float, default=0.1)
+    parser.add_argument("--percentile", type=float, default=90)
+    args = parser.parse_args()
+
+    for hedging in (None, HedgePolicy(args.percentile, budget=args.budget)):
+        result = asyncio.run(
+            run(hedging, args.requests, args.concurrency, args.ports, args.slow)
+        )
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
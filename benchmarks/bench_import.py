@@ -0,0 +1,122 @@
+"""
+import time of the entry points of aionion, each in a fresh interpreter, against a budget.
+an entry point must also not load the listed heavy modules, which are only needed
+by the other entry points. the slowest modules of every import are taken from -X importtime.
+
+    python -m benchmarks.bench_import [--runs 5] [--scale 1.0]
+
+exits with 1 when an import is over its budget (in ms, times ```--scale``` for slow machines)
+or loads a module it should not. ```benchmarks.suite``` runs the same check.
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# statement -> (budget in ms, modules it must not load)
+BUDGETS = {
+    "import aionion": (
+        100,
+        ("aiohttp", "aiohttp_socks", "python_socks", "requests", "urllib3", "bs4"),
+    ),
+    "from aionion import TorRC": (
+        250,
+        ("aiohttp", "aiohttp_socks", "python_socks", "requests", "urllib3", "bs4"),
+    ),
+    "from aionion import RequestsSession": (400, ("aiohttp", "aiohttp_socks", "bs4")),
+    "from aionion import ClientSession": (600, ("requests", "urllib3", "bs4")),
+}
+
+_CHILD = """
+import json, os, sys, time
+before = set(sys.modules)
+start = time.perf_counter()
+%s
+elapsed = time.perf_counter() - start
+print(json.dumps(dict(
+    ms=elapsed * 1000,
+    modules=sorted(set(sys.modules) - before),
+    environ=os.environ.get("LD_LIBRARY_PATH") != %r,
+)))
+"""
+
+
+def measure(statement: str) -> dict:
+    """
+    runs ```statement``` in a fresh interpreter and returns its import time,
+    the modules it loaded and the slowest of them
+    """
+    proc = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            _CHILD % (statement, os.environ.get("LD_LIBRARY_PATH")),
+        ],
+        capture_output=True,
+        text=True,
+        cwd=ROOT,
+        check=True,
+    )
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    loaded = set(result["modules"])
+    slowest = []
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() in loaded:
+            slowest.append((int(parts[0].split(":")[1]), parts[2].strip()))
+    slowest.sort(reverse=True)
+    result["slowest"] = {name: round(us / 1000, 1) for us, name in slowest[:5]}
+    return result
+
+
+def check(runs: int = 5, scale: float = 1.0) -> list[dict]:
+    """
+    measures every entry point ```runs``` times and returns one result per entry point,
+    with ```ok``` False when it is over its budget or loads a module it should not
+    """
+    results = []
+    for statement, (budget, forbidden) in BUDGETS.items():
+        samples = [measure(statement) for _ in range(runs)]
+        median = statistics.median(s["ms"] for s in samples)
+        loaded = set(samples[0]["modules"])
+        unwanted = sorted(loaded.intersection(forbidden))
+        results.append(
+            dict(
+                statement=statement,
+                ms=round(median, 1),
+                budget_ms=round(budget * scale, 1),
+                modules=len(loaded),
+                unwanted=unwanted,
+                changes_environment=samples[0]["environ"],
+                slowest=samples[0]["slowest"],
+                ok=median <= budget * scale
+                and not unwanted
+                and not samples[0]["environ"],
+            )
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="budget factor")
+    args = parser.parse_args()
+
+    results = check(args.runs, args.scale)
+    for result in results:
+        print(json.dumps(result))
+    sys.exit(0 if all(r["ok"] for r in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+time to install tor with an empty cache versus a warm one, from a mirror served
+over a local http server, and offline from a mirror directory.
+the releases are fake expert bundles of ```--size``` bytes with their checksums.
+
+    python -m benchmarks.bench_install [--size 20000000] [--installs 5]
+"""
+
+import argparse
+import functools
+import hashlib
+from http.server import SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import io
+import json
+import os
+from pathlib import Path
+import tarfile
+import tempfile
+import threading
+
+from aionion.installer import TorInstaller
+from benchmarks.standins import Timer
+
+
+def make_release(mirror: Path, version: str, size: int):
+    directory = mirror / version
+    directory.mkdir(parents=True)
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tf:
+        for name, data, mode in (
+            ("tor/tor", b"#!/bin/sh\necho tor\n", 0o755),
+            ("tor/libcrypto.so", os.urandom(size), 0o644),
+            ("data/geoip", b"geoip", 0o644),
+        ):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = mode
+            tf.addfile(info, io.BytesIO(data))
+    name = "tor-expert-bundle-linux-x86_64-%s.tar.gz" % version
+    (directory / name).write_bytes(buffer.getvalue())
+    (directory / "sha256sums-signed-build.txt").write_text(
+        "%s  %s\n" % (hashlib.sha256(buffer.getvalue()).hexdigest(), name)
+    )
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    requests = 0
+
+    def log_message(self, *args):
+        _QuietHandler.requests += 1
+
+
+def run(mirror, root: Path, installs: int) -> dict:
+    cache = root / ("cache-%s" % abs(hash(mirror)))
+    results = []
+    for i in range(installs):
+        _QuietHandler.requests = 0
+        installer = TorInstaller(cache_dir=cache, mirror=mirror)
+        with Timer() as timer:
+            installer.install(root / ("out-%d" % i))
+        results.append(
+            dict(
+                seconds=round(timer.elapsed, 3),
+                downloaded=installer.downloaded,
+                http_requests=_QuietHandler.requests,
+            )
+        )
+    return dict(cold=results[0], warm=results[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=20_000_000)
+    parser.add_argument("--installs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        mirror = root / "mirror"
+        for version in ("13.0.9", "13.5.1"):
+            make_release(mirror, version, args.size)
+        server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), functools.partial(_QuietHandler, directory=str(mirror))
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = "http://127.0.0.1:%d/" % server.server_port
+            print(json.dumps(dict(mirror="http", **run(url, root, args.installs))))
+        finally:
+            server.shutdown()
+        print(json.dumps(dict(mirror="directory", **run(mirror, root, args.installs))))
+
+
+if __name__ == "__main__":
+    main()
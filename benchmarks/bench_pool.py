@@ -0,0 +1,66 @@
+"""
+requests/sec of ClientSession with and without keep-alive connection pooling.
+every new connection pays a (simulated) SOCKS handshake and tor stream setup.
+
+    python -m benchmarks.bench_pool [--requests 2000] [--concurrency 20] [--setup-delay 0.05]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import aionion
+from benchmarks.standins import HttpServer
+from benchmarks.standins import SocksServer
+from benchmarks.standins import StandInTor
+from benchmarks.standins import Timer
+from benchmarks.standins import summary
+
+
+async def run(pooled, nrequests, concurrency, nports, setup_delay):
+    socks = await SocksServer(nports, {i: setup_delay for i in range(nports)}).start()
+    http = await HttpServer().start()
+    tor = StandInTor(socks)
+    connector = aionion.ProxyConnectTor(tor, force_close=not pooled)
+    latencies = []
+    queue = iter(range(nrequests))
+
+    async with aionion.ClientSession(tor, connector=connector) as session:
+
+        async def worker():
+            for _ in queue:
+                start = time.perf_counter()
+                async with session.get(http.url) as resp:
+                    await resp.read()
+                latencies.append(time.perf_counter() - start)
+
+        with Timer() as timer:
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+    await socks.stop()
+    await http.stop()
+    return dict(
+        pooled=pooled,
+        connections=socks.connections,
+        **summary(latencies, timer.elapsed),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--ports", type=int, default=10)
+    parser.add_argument("--setup-delay", type=float, default=0.05)
+    args = parser.parse_args()
+
+    for pooled in (False, True):
+        result = asyncio.run(
+            run(pooled, args.requests, args.concurrency, args.ports, args.setup_delay)
+        )
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+compares the proxy scheduler strategies against local SOCKS stand-ins
+where a few ports are a lot slower than the others.
+
+the requests arrive at a fixed ```--rate``` per second, like the traffic of a service,
+so their latency is the one of the proxy they got and not the time they waited for
+a free worker. ```--rate 0``` sends them from ```--concurrency``` workers instead,
+as fast as they complete, which measures the throughput.
+```--warmup``` requests are sent first and not measured, so the schedulers know
+the ports, like they would after a while in a long running process.
+```slow_requests``` counts the measured requests which went to the slow ports.
+
+    python -m benchmarks.bench_scheduler [--requests 2000] [--rate 150] [--warmup 200]
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import time
+
+import aionion
+from aionion.scheduler import SCHEDULERS
+from benchmarks.standins import HttpServer
+from benchmarks.standins import SocksServer
+from benchmarks.standins import StandInTor
+from benchmarks.standins import Timer
+from benchmarks.standins import summary
+
+# port index -> delay. the rest of the ports answer immediately (+ base delay)
+SKEWED_DELAYS = {0: 0.8, 1: 0.4, 2: 0.2}
+BASE_DELAY = 0.01
+
+
+async def run(strategy, nrequests, rate, concurrency, nports, warmup):
+    delays = {i: SKEWED_DELAYS.get(i, BASE_DELAY) for i in range(nports)}
+    per_port = collections.Counter()
+    socks = await SocksServer(
+        nports, delays, on_request=lambda index, *_: per_port.update([index])
+    ).start()
+    http = await HttpServer().start()
+    tor = StandInTor(socks, strategy)
+    latencies = []
+
+    # new connection per request, so every request goes through the scheduler
+    connector = aionion.ProxyConnectTor(tor, force_close=True)
+
+    async with aionion.ClientSession(tor, connector=connector) as session:
+
+        async def request(record):
+            start = time.perf_counter()
+            async with session.get(http.url) as resp:
+                await resp.read()
+            if record:
+                latencies.append(time.perf_counter() - start)
+
+        async def send(count, record):
+            if not rate:
+                queue = iter(range(count))
+
+                async def worker():
+                    for _ in queue:
+                        await request(record)
+
+                await asyncio.gather(*[worker() for _ in range(concurrency)])
+                return
+            tasks = []
+            start = time.perf_counter()
+            for i in range(count):
+                # on schedule, whether the requests before are done or not
+                await asyncio.sleep(max(0, start + i / rate - time.perf_counter()))
+                tasks.append(asyncio.ensure_future(request(record)))
+            await asyncio.gather(*tasks)
+
+        await send(warmup, False)
+        per_port.clear()
+        with Timer() as timer:
+            await send(nrequests, True)
+
+    await socks.stop()
+    await http.stop()
+    return dict(
+        strategy=strategy,
+        **summary(latencies, timer.elapsed),
+        slow_requests={
+            "%sms" % int(SKEWED_DELAYS[i] * 1000): per_port[i]
+            for i in SKEWED_DELAYS
+            if i < nports
+        },
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument(
+        "--rate", type=float, default=150, help="requests/s, 0 for a closed loop"
+    )
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--ports", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--strategy", action="append", choices=list(SCHEDULERS))
+    args = parser.parse_args()
+
+    for strategy in args.strategy or SCHEDULERS:
+        result = asyncio.run(
+            run(
+                strategy,
+                args.requests,
+                args.rate,
+                args.concurrency,
+                args.ports,
+                args.warmup,
+            )
+        )
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+handshake cost of the native socks5 client in ```SocksProxy.open_connection```
+compared with aiohttp_socks, against a local SOCKS stand-in.
+
+    python -m benchmarks.bench_socks [--connections 2000] [--concurrency 1]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from aionion.tor import SocksProxy
+from benchmarks.standins import HttpServer
+from benchmarks.standins import SocksServer
+from benchmarks.standins import Timer
+from benchmarks.standins import summary
+
+
+async def run(native, nconnections, concurrency, username):
+    socks = await SocksServer(1).start()
+    http = await HttpServer().start()
+    proxy = SocksProxy("127.0.0.1", socks.ports[0])
+    latencies = []
+    queue = iter(range(nconnections))
+
+    async def worker():
+        for _ in queue:
+            start = time.perf_counter()
+            reader, writer = await proxy.open_connection(
+                http.host, http.port, username=username, password="x", native=native
+            )
+            latencies.append(time.perf_counter() - start)
+            writer.close()
+
+    cpu = time.process_time()
+    with Timer() as timer:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    cpu = time.process_time() - cpu
+    await socks.stop()
+    await http.stop()
+    return dict(
+        client="native" if native else "aiohttp_socks",
+        auth=bool(username),
+        cpu_per_handshake_us=round(cpu / nconnections * 1e6, 1),
+        **summary(latencies, timer.elapsed),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=1)
+    args = parser.parse_args()
+
+    for username in (None, "isolated"):
+        for native in (False, True):
+            result = asyncio.run(
+                run(native, args.connections, args.concurrency, username)
+            )
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+time-to-first-usable-proxy of Tor.start for a cold and a warm data directory,
+using a fake tor binary (benchmarks/fake_tor.py), so it runs offline.
+
+    python -m benchmarks.bench_startup [--cold 3] [--warm 0.3]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from pathlib import Path
+import tempfile
+import time
+
+from aionion import utils
+from aionion.tor import SocksProxy
+from aionion.tor import Tor
+from benchmarks.standins import HttpServer
+
+FAKE_TOR = Path(__file__).resolve().parent / "fake_tor.py"
+
+
+async def first_usable_proxy(tor: Tor, http: HttpServer):
+    while True:
+        for port in tor.config.socks_port:
+            proxy = SocksProxy("127.0.0.1", port)
+            try:
+                reader, writer = await proxy.open_connection(http.host, http.port)
+            except OSError:
+                continue
+            writer.write(b"GET / HTTP/1.0\r\n\r\n")
+            await reader.read()
+            writer.close()
+            return proxy
+        await asyncio.sleep(0.01)
+
+
+async def run(label, http):
+    tor = Tor(5)
+    tor.binary_path = FAKE_TOR
+    start = time.perf_counter()
+    await tor.start()
+    started = time.perf_counter()
+    await first_usable_proxy(tor, http)
+    usable = time.perf_counter()
+    result = dict(
+        start=label,
+        warm_data_directory=label == "warm",
+        bootstrap_s=round(started - start, 3),
+        first_usable_proxy_s=round(usable - start, 3),
+    )
+    await tor.aclose()
+    return result
+
+
+async def main(args):
+    os.environ["FAKE_TOR_COLD"] = str(args.cold)
+    os.environ["FAKE_TOR_WARM"] = str(args.warm)
+    http = await HttpServer().start()
+    with tempfile.TemporaryDirectory() as tmp:
+        # claim data directories below a fresh folder, so the first start is cold
+        utils.TOR_DATA_FOLDER = Path(tmp)
+        for label in ("cold", "warm"):
+            print(json.dumps(await run(label, http)))
+    await http.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cold", type=float, default=3)
+    parser.add_argument("--warm", type=float, default=0.3)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+a fake tor binary for benchmarks. accepts the command line aionion passes to tor,
+opens the control port (cookie authentication) and the socks ports,
+and reports its bootstrap progress through STATUS_CLIENT events and stdout.
+socks ports set with SETCONF SocksPort are opened and closed while running.
+
+every socks port (and socks username on it, like IsolateSOCKSAuth) gets a circuit
+to one of FAKE_TOR_EXITS exit relays (default 8). the streams are reported as STREAM
+events, and GETINFO circuit-status and ns/id/<fingerprint> describe the circuits and exits.
+the DNSPort answers the names in FAKE_TOR_HOSTS ("name=address,...", default localhost).
+
+a cold start (no cached consensus in the data directory) takes FAKE_TOR_COLD seconds
+(default 3), a warm start FAKE_TOR_WARM seconds (default 0.3). the cached consensus
+is written when the bootstrap completes.
+"""
+
+import asyncio
+import hashlib
+import itertools
+import os
+from pathlib import Path
+import random
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.standins import ControlServer  # noqa: E402
+from benchmarks.standins import DnsServer  # noqa: E402
+from benchmarks.standins import SocksServer  # noqa: E402
+
+CACHE_FILE = "cached-microdesc-consensus"
+PHASES = [(0, "starting"), (10, "conn_done"), (40, "loading_keys"), (75, "enough_dirinfo"), (90, "ap_handshake_done"), (100, "done")]  # fmt: skip
+
+
+def parse_args(argv):
+    options = {}
+    args = iter(argv)
+    for arg in args:
+        if arg.startswith("--"):
+            options.setdefault(arg[2:], []).append(next(args))
+        elif arg == "__OwningControllerProcess":
+            next(args)
+    return options
+
+
+async def main():
+    options = parse_args(sys.argv[1:])
+    data_directory = Path(options.get("DataDirectory", ["."])[0])
+    data_directory.mkdir(parents=True, exist_ok=True)
+    warm = (data_directory / CACHE_FILE).exists()
+    duration = float(
+        os.environ.get("FAKE_TOR_WARM" if warm else "FAKE_TOR_COLD", 0.3 if warm else 3)
+    )
+
+    cookie = os.urandom(32)
+    (data_directory / "control_auth_cookie").write_bytes(cookie)
+    socks = SocksServer(ports=[int(p) for p in options.get("SocksPort", [])])
+    control = None
+    relays = [
+        hashlib.sha1(b"exit%d" % i).hexdigest().upper()
+        for i in range(int(os.environ.get("FAKE_TOR_EXITS", 8)))
+    ]
+    circuits = {}
+    circuit_ids = itertools.count(1)
+    stream_ids = itertools.count(1)
+
+    def on_request(idx, source, cmd, host, port, username):
+        isolation = idx, username
+        if isolation not in circuits:
+            circuits[isolation] = next(circuit_ids), random.randrange(len(relays))
+            control.info["circuit-status"] = "\n".join(
+                "%d BUILT $%s~guard,$%s~middle,$%s~exit%d PURPOSE=GENERAL"
+                % (cid, relays[0], relays[-1], relays[exit], exit)
+                for cid, exit in circuits.values()
+            )
+        circuit, _ = circuits[isolation]
+        stream = next(stream_ids)
+        resolve = cmd == 0xF0
+        target = "%s:%d" % (host, port)
+        control.emit(
+            "STREAM %d %s 0 %s SOURCE_ADDR=%s PURPOSE=%s"
+            % (stream, "NEWRESOLVE" if resolve else "NEW", target, source, "USER")
+        )
+        control.emit(
+            "STREAM %d %s %d %s"
+            % (stream, "SENTRESOLVE" if resolve else "SENTCONNECT", circuit, target)
+        )
+
+    async def on_conf(key, values):
+        if key != "SocksPort":
+            return
+        ports = {int(p.rsplit(":", 1)[-1]) for p in values}
+        for port in socks.open_ports - ports:
+            await socks.close_port(port)
+        for port in sorted(ports - socks.open_ports):
+            await socks.listen(port)
+
+    control = ControlServer(cookie=cookie, on_conf=on_conf)
+    for i, fingerprint in enumerate(relays):
+        control.info["ns/id/%s" % fingerprint] = (
+            "r exit%d AAAA BBBB 2026-01-01 00:00:00 198.51.100.%d 9001 0\n"
+            "s Exit Fast Running Stable Valid" % (i, i + 1)
+        )
+    socks.on_request = on_request
+
+    def progress(pct, tag):
+        phase = 'NOTICE BOOTSTRAP PROGRESS=%d TAG=%s SUMMARY="%s"' % (pct, tag, tag)
+        control.info["status/bootstrap-phase"] = phase
+        control.emit("STATUS_CLIENT " + phase)
+        print("[notice] Bootstrapped %d%% (%s)" % (pct, tag), flush=True)
+
+    progress(0, "starting")
+    await control.start(int(options["ControlPort"][0]))
+    # tor's option names are case insensitive, aionion passes --DnsPort
+    dns_port = {k.lower(): v for k, v in options.items()}.get("dnsport")
+    if dns_port:
+        hosts = os.environ.get("FAKE_TOR_HOSTS", "localhost=127.0.0.1")
+        records = dict(h.split("=") for h in hosts.split(",") if h)
+        await DnsServer(records).start(int(dns_port[0]))
+    for pct, tag in PHASES[1:]:
+        await asyncio.sleep(duration / (len(PHASES) - 1))
+        if pct == 90:
+            await socks.start()
+        progress(pct, tag)
+    (data_directory / CACHE_FILE).write_text("fake consensus")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,517 @@
+"""
+local stand-ins for the tor network, so benchmarks run offline.
+
+    SocksServer   - a minimal SOCKS5 server (with tor's RESOLVE extensions). per port it can
+                    delay the reply, limit the bandwidth and fail a share of the requests
+    HttpServer    - a tiny HTTP/1.1 keep-alive server returning a fixed body, optionally over tls
+    StandInTor    - quacks like ```aionion.Tor``` for the sessions, using SocksServer ports
+    ControlServer - a fake tor control port
+    DnsServer     - a fake tor DNSPort, answering A queries from a table
+"""
+
+import asyncio
+import collections
+import functools
+from pathlib import Path
+import random
+import re
+import shutil
+import socket
+import ssl
+import struct
+import subprocess
+import tempfile
+import time
+
+from aionion.scheduler import create_scheduler
+from aionion.tor import SocksProxy
+
+
+class SocksServer:
+    """
+    SOCKS5 server listening on one or more local ports.
+
+    :param delays: dict of port index -> delay in seconds before replying to CONNECT
+    :param bandwidth: dict of port index -> max bytes per second, per connection and direction
+    :param failures: dict of port index -> share (0..1) of requests answered with a failure
+    :param on_request: optional callable(port index, source "host:port", command, host, port, username),
+                       called for every request before it is answered
+    """
+
+    def __init__(
+        self,
+        nports=10,
+        delays: dict = None,
+        host="127.0.0.1",
+        ports=None,
+        bandwidth: dict = None,
+        failures: dict = None,
+        on_request=None,
+    ):
+        self.host = host
+        self.nports = len(ports) if ports else nports
+        self._bind_ports = ports or [0] * nports
+        self.delays = delays or {}
+        self.bandwidth = bandwidth or {}
+        self.failures = failures or {}
+        self.failed = 0
+        self.ports = []
+        self._servers = []
+        self.connections = 0
+        self.usernames = collections.Counter()
+        self.on_request = on_request
+
+    async def start(self):
+        for port in self._bind_ports:
+            await self.listen(port)
+        return self
+
+    async def listen(self, port=0) -> int:
+        """
+        opens one more port, returns its number
+        """
+        idx = len(self._servers)
+        server = await asyncio.start_server(
+            lambda r, w, idx=idx: self._handle(idx, r, w), self.host, port
+        )
+        self._servers.append(server)
+        self.ports.append(server.sockets[0].getsockname()[1])
+        return self.ports[-1]
+
+    @property
+    def open_ports(self) -> set:
+        return {p for p, s in zip(self.ports, self._servers) if s.is_serving()}
+
+    async def close_port(self, port: int):
+        for p, server in zip(self.ports, self._servers):
+            if p == port and server.is_serving():
+                server.close()
+                await server.wait_closed()
+
+    async def stop(self):
+        for server in self._servers:
+            if server.is_serving():
+                server.close()
+                await server.wait_closed()
+
+    async def _handle(self, idx, reader, writer):
+        username = None
+        try:
+            ver, nmethods = await reader.readexactly(2)
+            methods = await reader.readexactly(nmethods)
+            if 0x02 in methods:
+                # username/password, like tor's IsolateSOCKSAuth
+                writer.write(b"\x05\x02")
+                _, ulen = await reader.readexactly(2)
+                username = (await reader.readexactly(ulen)).decode()
+                (plen,) = await reader.readexactly(1)
+                await reader.readexactly(plen)
+                self.usernames[username] += 1
+                writer.write(b"\x01\x00")
+            else:
+                writer.write(b"\x05\x00")
+            ver, cmd, _, atyp = await reader.readexactly(4)
+            if atyp == 0x01:
+                host = socket.inet_ntop(socket.AF_INET, await reader.readexactly(4))
+            elif atyp == 0x04:
+                host = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+            else:
+                (length,) = await reader.readexactly(1)
+                host = (await reader.readexactly(length)).decode()
+            (port,) = struct.unpack("!H", await reader.readexactly(2))
+            if self.on_request:
+                source = "%s:%d" % writer.get_extra_info("peername")[:2]
+                self.on_request(idx, source, cmd, host, port, username)
+            delay = self.delays.get(idx, 0)
+            if delay:
+                await asyncio.sleep(delay)
+            if random.random() < self.failures.get(idx, 0):
+                self.failed += 1
+                writer.write(b"\x05\x01\x00\x01" + bytes(6))
+                writer.close()
+                return
+            if cmd == 0xF0:
+                # tor's RESOLVE extension
+                try:
+                    address = socket.gethostbyname(host)
+                except OSError:
+                    writer.write(b"\x05\x04\x00\x01" + bytes(6))
+                    writer.close()
+                    return
+                writer.write(b"\x05\x00\x00\x01" + socket.inet_aton(address) + bytes(2))
+                writer.close()
+                return
+            if cmd == 0xF1:
+                # tor's RESOLVE_PTR extension
+                name = socket.gethostbyaddr(host)[0].encode()
+                writer.write(b"\x05\x00\x00\x03%c%s\x00\x00" % (len(name), name))
+                writer.close()
+                return
+            try:
+                ureader, uwriter = await asyncio.open_connection(host, port)
+            except OSError:
+                writer.write(b"\x05\x05\x00\x01" + bytes(6))
+                writer.close()
+                return
+            self.connections += 1
+            writer.write(b"\x05\x00\x00\x01" + socket.inet_aton("127.0.0.1") + bytes(2))
+            rate = self.bandwidth.get(idx)
+            await asyncio.gather(
+                _pipe(reader, uwriter, rate),
+                _pipe(ureader, writer, rate),
+                return_exceptions=True,
+            )
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+            writer.close()
+
+
+async def _pipe(reader, writer, rate: float = None):
+    try:
+        while True:
+            data = await reader.read(min(2**16, int(rate)) if rate else 2**16)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+            if rate:
+                await asyncio.sleep(len(data) / rate)
+    finally:
+        writer.close()
+
+
+@functools.lru_cache(maxsize=None)
+def self_signed_cert() -> tuple[str, str]:
+    """
+    creates a certificate for "localhost" with openssl and returns (certfile, keyfile)
+    """
+    if not shutil.which("openssl"):
+        raise RuntimeError("openssl is needed for the tls stand-ins")
+    folder = Path(tempfile.mkdtemp(prefix="aionion-bench-"))
+    cert, key = str(folder / "cert.pem"), str(folder / "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1"]
+        + ["-keyout", key, "-out", cert, "-subj", "/CN=localhost"]
+        + ["-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1"],
+        check=True,
+        capture_output=True,
+    )
+    return cert, key
+
+
+def client_ssl_context() -> ssl.SSLContext:
+    """
+    a client context trusting the stand-in certificate
+    """
+    return ssl.create_default_context(cafile=self_signed_cert()[0])
+
+
+class HttpServer:
+    """
+    HTTP/1.1 server answering every request with ```body```
+
+    :param tls: (bool) serve https with a self signed certificate for localhost,
+                see ```client_ssl_context```
+    :param ranges: (bool) answer "Range: bytes=a-b" requests with the part of the body
+    """
+
+    def __init__(
+        self,
+        body: bytes = b'{"origin": "127.0.0.1"}',
+        host="127.0.0.1",
+        tls=False,
+        ranges=False,
+    ):
+        self.body = body
+        self.host = host
+        self.tls = tls
+        self.ranges = ranges
+        self.requests = 0
+        self.port = None
+        self._server = None
+
+    @property
+    def url(self):
+        return "%s://%s:%d/" % ("https" if self.tls else "http", self.host, self.port)
+
+    async def start(self):
+        context = None
+        if self.tls:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(*self_signed_cert())
+        self._server = await asyncio.start_server(
+            self._handle, self.host, 0, ssl=context
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                self.requests += 1
+                close = b"connection: close" in head.lower() or b"HTTP/1.0" in head
+                status, body, extra = b"200 OK", self.body, b""
+                match = re.search(rb"(?i)\r\nrange: bytes=(\d+)-(\d*)", head)
+                if self.ranges and match:
+                    start = int(match.group(1))
+                    end = min(
+                        int(match.group(2) or len(self.body) - 1), len(self.body) - 1
+                    )
+                    if start >= len(self.body):
+                        status, body = b"416 Range Not Satisfiable", b""
+                        extra = b"Content-Range: bytes */%d\r\n" % len(self.body)
+                    else:
+                        status, body = (
+                            b"206 Partial Content",
+                            self.body[start : end + 1],
+                        )
+                        extra = b"Content-Range: bytes %d-%d/%d\r\n" % (
+                            start,
+                            end,
+                            len(self.body),
+                        )
+                if self.ranges:
+                    extra += b'Accept-Ranges: bytes\r\nETag: "%d"\r\n' % len(self.body)
+                if close:
+                    extra += b"Connection: close\r\n"
+                writer.write(
+                    b"HTTP/1.1 %s\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: %d\r\n%s\r\n" % (status, len(body), extra)
+                )
+                # large bodies are sent as the client reads them
+                for i in range(0, len(body), 2**16):
+                    writer.write(body[i : i + 2**16])
+                    await writer.drain()
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class StandInTor:
+    """
+    exposes the attributes sessions need from ```aionion.Tor```
+    """
+
+    def __init__(self, socks: SocksServer, scheduler=None):
+        self.proxies = [SocksProxy(socks.host, port) for port in socks.ports]
+        self.scheduler = create_scheduler(scheduler, self)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0
+    k = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def summary(latencies, elapsed):
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+
+
+class DnsServer(asyncio.DatagramProtocol):
+    """
+    answers A queries over udp, like tor's DNSPort. names in ```records``` get their address,
+    others NXDOMAIN.
+
+    :param records: dict of name -> address
+    :param ttl: (int) ttl of the answers
+    :param delay: (float) seconds to wait before answering
+    """
+
+    def __init__(self, records: dict = None, ttl: int = 60, delay: float = 0.0):
+        self.records = dict(records or {})
+        self.ttl = ttl
+        self.delay = delay
+        self.queries = collections.Counter()
+        self.port = None
+        self._transport = None
+
+    async def start(self, port=0):
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: self, local_addr=("127.0.0.1", port)
+        )
+        self.port = self._transport.get_extra_info("sockname")[1]
+        return self
+
+    async def stop(self):
+        self._transport.close()
+
+    def datagram_received(self, data, addr):
+        asyncio.ensure_future(self._answer(data, addr))
+
+    async def _answer(self, data, addr):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        qid = data[:2]
+        offset, labels = 12, []
+        while data[offset]:
+            labels.append(data[offset + 1 : offset + 1 + data[offset]].decode())
+            offset += 1 + data[offset]
+        question = data[12 : offset + 5]
+        name = ".".join(labels).lower()
+        self.queries[name] += 1
+        address = self.records.get(name)
+        if address is None:
+            header = qid + struct.pack("!HHHHH", 0x8183, 1, 0, 0, 0)
+            self._transport.sendto(header + question, addr)
+            return
+        header = qid + struct.pack("!HHHHH", 0x8180, 1, 1, 0, 0)
+        answer = b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, self.ttl, 4)
+        answer += socket.inet_aton(address)
+        self._transport.sendto(header + question + answer, addr)
+
+
+class ControlServer:
+    """
+    fake tor control port. understands enough of the protocol for ```aionion.control```:
+    PROTOCOLINFO, AUTHENTICATE (cookie or none), GETINFO, GETCONF, SETCONF, SIGNAL and SETEVENTS.
+
+    :param cookie: (bytes) expected cookie. None accepts any authentication
+    :param info: dict of GETINFO key -> value
+    :param delay: (float) seconds to wait before answering each command
+    :param on_conf: optional async callable(key, values), awaited for every option
+                    a SETCONF changes, before it is answered
+    """
+
+    def __init__(
+        self, cookie: bytes = None, info: dict = None, delay=0.0, on_conf=None
+    ):
+        self.cookie = cookie
+        self.info = dict(info or {})
+        self.conf = {}
+        self.delay = delay
+        self.on_conf = on_conf
+        self.signals = []
+        self.host = "127.0.0.1"
+        self.port = None
+        self._server = None
+        self._clients = {}
+
+    async def start(self, port=0):
+        self._server = await asyncio.start_server(self._handle, self.host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        for writer in list(self._clients):
+            writer.close()
+        self._server.close()
+        await self._server.wait_closed()
+
+    def emit(self, event: str):
+        """
+        sends ```650 <event>``` to every client which subscribed to its type
+        """
+        etype = event.split(" ", 1)[0]
+        for writer, events in self._clients.items():
+            if etype in events:
+                writer.write(b"650 %s\r\n" % event.encode())
+
+    async def _handle(self, reader, writer):
+        self._clients[writer] = set()
+        authenticated = False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                command, _, args = line.decode().strip().partition(" ")
+                command = command.upper()
+                if command == "PROTOCOLINFO":
+                    methods = "COOKIE" if self.cookie else "NULL"
+                    writer.write(
+                        b'250-PROTOCOLINFO 1\r\n250-AUTH METHODS=%s\r\n250-VERSION Tor="0.4.8.0"\r\n250 OK\r\n'
+                        % methods.encode()
+                    )
+                elif command == "AUTHENTICATE":
+                    if self.cookie and args != self.cookie.hex():
+                        writer.write(b"515 Authentication failed\r\n")
+                        continue
+                    authenticated = True
+                    writer.write(b"250 OK\r\n")
+                elif not authenticated:
+                    writer.write(b"514 Authentication required.\r\n")
+                elif command == "GETINFO":
+                    writer.write(self._getinfo(args.split()))
+                elif command == "GETCONF":
+                    values = self.conf.get(args, [""])
+                    lines = ["%s=%s" % (args, v) for v in values]
+                    writer.write(_reply_lines(lines))
+                elif command == "SETCONF":
+                    # like tor, the values of an option replace the old ones
+                    changes = {}
+                    for key, value in re.findall(r'(\w+)(?:=("[^"]*"|\S+))?', args):
+                        changes.setdefault(key, []).append(value.strip('"'))
+                    self.conf.update(changes)
+                    if self.on_conf:
+                        for key, values in changes.items():
+                            await self.on_conf(key, values)
+                    writer.write(b"250 OK\r\n")
+                elif command == "SIGNAL":
+                    self.signals.append(args)
+                    writer.write(b"250 OK\r\n")
+                elif command == "SETEVENTS":
+                    self._clients[writer] = set(args.split())
+                    writer.write(b"250 OK\r\n")
+                else:
+                    writer.write(
+                        b'510 Unrecognized command "%s"\r\n' % command.encode()
+                    )
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._clients.pop(writer, None)
+            writer.close()
+
+    def _getinfo(self, keys):
+        lines = []
+        for key in keys:
+            if key not in self.info:
+                return b'552 Unrecognized key "%s"\r\n' % key.encode()
+            value = self.info[key]
+            if "\n" in value:
+                lines.append("%s=\n%s" % (key, value))
+            else:
+                lines.append("%s=%s" % (key, value))
+        return _reply_lines(lines)
+
+
+def _reply_lines(lines):
+    out = b""
+    for line in lines:
+        if "\n" in line:
+            first, data = line.split("\n", 1)
+            out += b"250+%s\r\n%s\r\n.\r\n" % (
+                first.encode(),
+                data.replace("\n", "\r\n").encode(),
+            )
+        else:
+            out += b"250-%s\r\n" % line.encode()
+    return out + b"250 OK\r\n"
@@ -0,0 +1,232 @@
+"""
+offline benchmark suite. drives the public entry points of aionion against
+local stand-ins (see standins.py) and reports one JSON document, so results
+can be stored and compared between versions.
+
+scenarios:
+    client_session  - ClientSession.get, keep-alive, ```--concurrency``` tasks
+    requests        - RequestsSession.get from ```--concurrency``` threads
+    open_connection - SocksProxy.open_connection + one request per connection
+    public_ip       - PublicIPService.lookup, with the ip apis served locally
+
+the import time of the entry points is checked against its budget as well
+(see bench_import.py). the suite exits with 1 when an import is over budget.
+
+    python -m benchmarks.suite [--scenario client_session] [--tls] [--delay 0.01]
+                               [--bandwidth 1000000] [--failure-rate 0.01] [--output results.json]
+                               [--import-runs 5] [--import-scale 1.0]
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+import aionion
+from aionion.tor import SocksProxy
+from aionion.utils import PublicIPService
+from benchmarks import bench_import
+from benchmarks.standins import HttpServer
+from benchmarks.standins import SocksServer
+from benchmarks.standins import StandInTor
+from benchmarks.standins import Timer
+from benchmarks.standins import client_ssl_context
+from benchmarks.standins import self_signed_cert
+from benchmarks.standins import summary
+
+SCENARIOS = {}
+
+
+def scenario(func):
+    SCENARIOS[func.__name__] = func
+    return func
+
+
+@scenario
+async def client_session(args, socks, http):
+    tor = StandInTor(socks)
+    ssl_context = client_ssl_context() if args.tls else None
+
+    async with aionion.ClientSession(tor) as session:
+
+        async def request():
+            async with session.get(http.url, ssl=ssl_context) as resp:
+                await resp.read()
+
+        return await _drive(request, args.requests, args.concurrency)
+
+
+@scenario
+async def requests(args, socks, http):
+    tor = StandInTor(socks)
+    session = aionion.RequestsSession(tor)
+    verify = self_signed_cert()[0] if args.tls else True
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+
+        async def request():
+            await loop.run_in_executor(
+                executor, lambda: session.get(http.url, verify=verify).content
+            )
+
+        try:
+            return await _drive(request, args.requests, args.concurrency)
+        finally:
+            session.close()
+
+
+@scenario
+async def open_connection(args, socks, http):
+    proxies = StandInTor(socks).proxies
+    ssl_context = client_ssl_context() if args.tls else None
+    counter = iter(range(args.requests))
+
+    async def request():
+        proxy = proxies[next(counter) % len(proxies)]
+        reader, writer = await proxy.open_connection(
+            http.host, http.port, ssl_context=ssl_context
+        )
+        try:
+            writer.write(b"GET / HTTP/1.0\r\nHost: localhost\r\n\r\n")
+            await reader.read()
+        finally:
+            writer.close()
+
+    return await _drive(request, args.requests, args.concurrency)
+
+
+@scenario
+async def public_ip(args, socks, http):
+    proxies = StandInTor(socks).proxies
+    counter = iter(range(args.requests))
+    # the apis are https, so the lookups always go to the tls stand-in
+    ssl_context = client_ssl_context()
+
+    async def request():
+        proxy = proxies[next(counter) % len(proxies)]
+
+        def open_local(host, port):
+            return proxy.open_connection(http.host, http.port, ssl_context=ssl_context)
+
+        await PublicIPService(proxy, timeout=5).lookup(open_connection=open_local)
+
+    return await _drive(request, args.requests, args.concurrency)
+
+
+async def _drive(request, nrequests, concurrency):
+    latencies = []
+    errors = []
+    queue = iter(range(nrequests))
+
+    async def worker():
+        for _ in queue:
+            start = time.perf_counter()
+            try:
+                await request()
+            except Exception as e:
+                errors.append(type(e).__name__)
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    with Timer() as timer:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    result = summary(latencies, timer.elapsed)
+    result["errors"] = len(errors)
+    return result
+
+
+async def run(name, args):
+    nports = args.ports
+    socks = await SocksServer(
+        nports,
+        delays={i: args.delay for i in range(nports)},
+        bandwidth=(
+            {i: args.bandwidth for i in range(nports)} if args.bandwidth else None
+        ),
+        failures={i: args.failure_rate for i in range(nports)},
+    ).start()
+    http = await HttpServer(
+        b"x" * args.body_size if name != "public_ip" else b'{"origin": "127.0.0.1"}',
+        tls=args.tls or name == "public_ip",
+    ).start()
+    if args.tracemalloc:
+        tracemalloc.start()
+    cpu = time.process_time()
+    try:
+        result = await SCENARIOS[name](args, socks, http)
+    finally:
+        cpu = time.process_time() - cpu
+        await socks.stop()
+        await http.stop()
+    result = dict(scenario=name, **result, cpu_s=round(cpu, 3))
+    if args.tracemalloc:
+        result["peak_memory_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    if resource:
+        # kilobytes on linux, bytes on macos
+        result["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def environment():
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        revision = None
+    return dict(
+        date=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        revision=revision or None,
+        python=sys.version.split()[0],
+        platform=platform.platform(),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--ports", type=int, default=10)
+    parser.add_argument("--delay", type=float, default=0.0, help="connect delay (s)")
+    parser.add_argument("--bandwidth", type=float, help="bytes/s per connection")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--body-size", type=int, default=1024)
+    parser.add_argument("--tls", action="store_true", help="https for all scenarios")
+    parser.add_argument("--tracemalloc", action="store_true", help="peak memory")
+    parser.add_argument("--output", help="write the report to this file")
+    parser.add_argument("--import-runs", type=int, default=5, help="0 skips it")
+    parser.add_argument("--import-scale", type=float, default=1.0, help="budget factor")
+    args = parser.parse_args()
+
+    report = dict(
+        environment=environment(),
+        settings={k: v for k, v in vars(args).items() if k not in ("output",)},
+        results=[asyncio.run(run(name, args)) for name in args.scenario or SCENARIOS],
+    )
+    if args.import_runs:
+        report["imports"] = bench_import.check(args.import_runs, args.import_scale)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+    if not all(r["ok"] for r in report.get("imports", ())):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
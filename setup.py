@@ -26,12 +26,9 @@ setup(
     packages=["aionion"],
     include_package_data=True,
     install_requires=[
-        "bs4",
-        "lxml",
         "aiohttp>=3.8.0",
         "aiohttp_socks>=0.7.0",
-        "stem>=1.8.0",
-        "requests>=2.26",
+        "requests[socks]>=2.26",
         "async_timeout>=4.0.1",
     ],
 )
@@ -0,0 +1,186 @@
+import asyncio
+import os
+
+import pytest
+
+from aionion.control import ControlClient
+from aionion.control import ControlClosed
+from aionion.control import ControlError
+from aionion.control import hash_control_password
+from aionion.control import parse_keywords
+from benchmarks.standins import ControlServer
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 10))
+
+
+async def connect(server, cookie_path=None) -> ControlClient:
+    controller = await ControlClient.connect(port=server.port)
+    await controller.authenticate(cookie_path=cookie_path)
+    return controller
+
+
+@pytest.fixture
+def cookie(tmp_path):
+    path = tmp_path / "control_auth_cookie"
+    path.write_bytes(os.urandom(32))
+    return path
+
+
+def test_authenticate_with_cookie(cookie):
+    async def main():
+        server = await ControlServer(
+            cookie=cookie.read_bytes(), info={"version": "0.4.8.0"}
+        ).start()
+        controller = await connect(server, cookie)
+        assert await controller.get_info("version") == {"version": "0.4.8.0"}
+        await controller.close()
+        await server.stop()
+
+    run(main())
+
+
+def test_authenticate_with_wrong_cookie(cookie, tmp_path):
+    wrong = tmp_path / "wrong_cookie"
+    wrong.write_bytes(os.urandom(32))
+
+    async def main():
+        server = await ControlServer(cookie=cookie.read_bytes()).start()
+        controller = await ControlClient.connect(port=server.port)
+        with pytest.raises(ControlError) as e:
+            await controller.authenticate(cookie_path=wrong)
+        assert e.value.status == 515
+        with pytest.raises(ControlError):
+            await controller.get_info("version")
+        await controller.close()
+        await server.stop()
+
+    run(main())
+
+
+def test_pipelined_replies_are_matched_in_order():
+    info = {"key-%d" % i: "value-%d" % i for i in range(20)}
+
+    async def main():
+        server = await ControlServer(info=info, delay=0.01).start()
+        controller = await connect(server)
+        replies = await asyncio.gather(*[controller.get_info(key) for key in info])
+        assert replies == [{key: value} for key, value in info.items()]
+        await controller.close()
+        await server.stop()
+
+    run(main())
+
+
+def test_multiline_getinfo_and_errors():
+    status = "1 BUILT $A~a,$B~b\n2 BUILT $C~c"
+
+    async def main():
+        server = await ControlServer(
+            info={"version": "0.4.8.0", "circuit-status": status}
+        ).start()
+        controller = await connect(server)
+        assert await controller.get_info("version", "circuit-status") == {
+            "version": "0.4.8.0",
+            "circuit-status": status,
+        }
+        with pytest.raises(ControlError) as e:
+            await controller.get_info("no-such-key")
+        assert e.value.status == 552
+        # the connection is still usable after an error reply
+        assert await controller.get_info("version") == {"version": "0.4.8.0"}
+        await controller.close()
+        await server.stop()
+
+    run(main())
+
+
+def test_set_conf_and_signal():
+    async def main():
+        server = await ControlServer().start()
+        controller = await connect(server)
+        await controller.set_conf("SocksPort", ["9050", "9052"])
+        assert server.conf["SocksPort"] == ["9050", "9052"]
+        assert await controller.get_conf("SocksPort") == ["9050", "9052"]
+        assert controller.get_newnym_wait() == 0
+        await controller.signal("NEWNYM")
+        assert server.signals == ["NEWNYM"]
+        assert controller.get_newnym_wait() > 0
+        await controller.close()
+        await server.stop()
+
+    run(main())
+
+
+def test_events_reach_their_listeners():
+    async def main():
+        server = await ControlServer(info={"version": "0.4.8.0"}).start()
+        controller = await connect(server)
+        received = []
+        from_coroutine = asyncio.Event()
+
+        async def on_stream(event):
+            received.append(("coroutine", event.type, event.args))
+            from_coroutine.set()
+
+        await controller.add_event_listener(
+            lambda event: received.append((event.type, event.keywords())),
+            "STATUS_CLIENT",
+        )
+        await controller.add_event_listener(on_stream, "STREAM")
+        server.emit(
+            'STATUS_CLIENT NOTICE BOOTSTRAP PROGRESS=100 TAG=done SUMMARY="Done"'
+        )
+        server.emit("STREAM 12 SENTRESOLVE 0 example.com:0")
+        # an event between replies does not take the place of a reply
+        assert await controller.get_info("version") == {"version": "0.4.8.0"}
+        await from_coroutine.wait()
+        assert received[0] == (
+            "STATUS_CLIENT",
+            {"PROGRESS": "100", "TAG": "done", "SUMMARY": "Done"},
+        )
+        assert received[1] == ("coroutine", "STREAM", "12 SENTRESOLVE 0 example.com:0")
+
+        await controller.remove_event_listener(on_stream)
+        server.emit("STREAM 13 SENTRESOLVE 0 example.com:0")
+        await controller.get_info("version")
+        assert len(received) == 2
+        await controller.close()
+        await server.stop()
+
+    run(main())
+
+
+def test_closed_connection_fails_pending_requests():
+    async def main():
+        server = await ControlServer(info={"version": "0.4.8.0"}, delay=0.2).start()
+        controller = await connect(server)
+        pending = asyncio.ensure_future(controller.get_info("version"))
+        await asyncio.sleep(0.05)
+        await server.stop()
+        with pytest.raises(ControlClosed):
+            await pending
+        await asyncio.sleep(0.05)
+        assert not controller.is_alive()
+        with pytest.raises(ControlClosed):
+            await controller.get_info("version")
+        await controller.close()
+
+    run(main())
+
+
+def test_parse_keywords():
+    assert parse_keywords('PROGRESS=100 TAG=done SUMMARY="Done \\"now\\""') == {
+        "PROGRESS": "100",
+        "TAG": "done",
+        "SUMMARY": 'Done "now"',
+    }
+
+
+def test_hash_control_password():
+    hashed = hash_control_password("secret", salt=bytes(8))
+    assert hashed.startswith("16:" + "00" * 8 + "60")
+    assert len(hashed) == 3 + 2 * (8 + 1 + 20)
+    assert hashed == hash_control_password("secret", salt=bytes(8))
+    assert hashed != hash_control_password("other", salt=bytes(8))
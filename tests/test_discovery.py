@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+
+import pytest
+
+from aionion.control import ControlClient
+from aionion.discovery import ExitDiscovery
+from aionion.tor import SocksProxy
+from benchmarks.standins import ControlServer
+from benchmarks.standins import SocksServer
+
+EXIT = hashlib.sha1(b"exit").hexdigest().upper()
+GUARD = hashlib.sha1(b"guard").hexdigest().upper()
+NS_ENTRY = (
+    "r exit AAAA BBBB 2026-01-01 00:00:00 198.51.100.7 9001 0\n"
+    "s Exit Fast Running Stable Valid"
+)
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 10))
+
+
+class _Tor:
+    """
+    the parts of ```Tor``` discovery uses, on a stand-in control port
+    """
+
+    running = True
+
+    def __init__(self, control: ControlServer):
+        self.control = control
+        self.controller = None
+        self.subscriptions = 0
+
+    async def get_controller(self):
+        if self.controller is None:
+            self.controller = await ControlClient.connect(port=self.control.port)
+            await self.controller.authenticate()
+            add_event_listener = self.controller.add_event_listener
+
+            async def counted(*args):
+                self.subscriptions += 1
+                return await add_event_listener(*args)
+
+            self.controller.add_event_listener = counted
+        return self.controller
+
+
+async def start(circuit="7", status="FAILED", delay=0.0):
+    """
+    a control port and a socks port, which reports every stream on ```circuit```.
+    circuit "0" reports a stream which tor could not attach, with ```status```
+    """
+    control = await ControlServer(
+        info={
+            "circuit-status": "3 BUILT $%s~guard,$%s~exit PURPOSE=GENERAL\n"
+            "7 BUILT $%s=guard,$%s=exit PURPOSE=GENERAL" % (GUARD, EXIT, GUARD, EXIT),
+            "ns/id/%s" % EXIT: NS_ENTRY,
+        },
+        delay=delay,
+    ).start()
+
+    def on_request(idx, source, cmd, host, port, username):
+        target = "%s:%d" % (host, port)
+        control.emit("STREAM 42 NEWRESOLVE 0 %s SOURCE_ADDR=%s" % (target, source))
+        if circuit == "0":
+            control.emit("STREAM 42 %s 0 %s REASON=TIMEOUT" % (status, target))
+        else:
+            control.emit("STREAM 42 SENTRESOLVE %s %s" % (circuit, target))
+
+    socks = await SocksServer(1, on_request=on_request).start()
+    tor = _Tor(control)
+    proxy = SocksProxy(socks.host, socks.ports[0])
+    discovery = ExitDiscovery(tor, resolve_host="localhost", fallback=False)
+    return control, socks, tor, proxy, discovery
+
+
+async def stop(control, socks, tor):
+    if tor.controller:
+        await tor.controller.close()
+    await socks.stop()
+    await control.stop()
+
+
+def test_discover_finds_the_exit_of_the_circuit():
+    async def main():
+        control, socks, tor, proxy, discovery = await start()
+        await discovery.lookup(proxy)
+        assert proxy.public_ip == "198.51.100.7"
+        assert proxy.exit_fingerprint == EXIT
+        assert proxy._public_ip_provided_by == "control port"
+        assert proxy.latency > 0
+        assert discovery.lookups == 1
+        # the probe connection is forgotten once it is done
+        assert not discovery._sources and not discovery._streams
+
+        # the relay address is cached
+        del control.info["ns/id/%s" % EXIT]
+        proxy.public_ip = ""
+        await discovery.lookup(proxy)
+        assert proxy.public_ip == "198.51.100.7"
+        assert tor.subscriptions == 1
+        await stop(control, socks, tor)
+
+    run(main())
+
+
+def test_exit_of_reads_both_hop_formats():
+    async def main():
+        control, socks, tor, proxy, discovery = await start()
+        controller = await tor.get_controller()
+        control.info["ns/id/%s" % GUARD] = NS_ENTRY.replace("198.51.100.7", "192.0.2.1")
+        assert await discovery.exit_of(controller, "7") == (EXIT, "198.51.100.7")
+        # $FINGERPRINT~nickname, the last hop is the exit
+        assert await discovery.exit_of(controller, "3") == (EXIT, "198.51.100.7")
+        with pytest.raises(LookupError):
+            await discovery.exit_of(controller, "99")
+        await stop(control, socks, tor)
+
+    run(main())
+
+
+def test_unknown_circuit_fails_without_fallback():
+    async def main():
+        control, socks, tor, proxy, discovery = await start(circuit="12")
+        with pytest.raises(LookupError):
+            await discovery.lookup(proxy)
+        assert not proxy.public_ip
+        await stop(control, socks, tor)
+
+    run(main())
+
+
+def test_stream_which_fails_to_attach():
+    async def main():
+        control, socks, tor, proxy, discovery = await start(circuit="0")
+        with pytest.raises(LookupError):
+            await discovery.discover(proxy)
+        await stop(control, socks, tor)
+
+    run(main())
+
+
+def test_cancelled_lookup_leaves_the_subscription_to_the_others():
+    async def main():
+        # every control command takes a while, so the first lookup is
+        # cancelled while the subscription is on its way
+        control, socks, tor, proxy, discovery = await start(delay=0.1)
+        await tor.get_controller()
+        first = asyncio.ensure_future(discovery.lookup(proxy))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        await discovery.lookup(proxy)
+        assert proxy.public_ip == "198.51.100.7"
+        assert tor.subscriptions == 1
+        await stop(control, socks, tor)
+
+    run(main())
+
+
+def test_failed_subscription_is_retried():
+    async def main():
+        control, socks, tor, proxy, discovery = await start()
+        controller = await tor.get_controller()
+        subscribe = controller.add_event_listener
+        failures = [ConnectionError("control port went away")]
+
+        async def flaky(*args):
+            if failures:
+                raise failures.pop()
+            return await subscribe(*args)
+
+        controller.add_event_listener = flaky
+        with pytest.raises(ConnectionError):
+            await discovery.discover(proxy)
+        assert discovery._subscribing is None
+        await discovery.discover(proxy)
+        assert proxy.public_ip == "198.51.100.7"
+        await stop(control, socks, tor)
+
+    run(main())
+
+
+def test_close_cancels_pending_lookups():
+    async def main():
+        # the stream is never attached, so the lookup waits for its circuit
+        control, socks, tor, proxy, discovery = await start(circuit="0", status="NEW")
+        lookup = asyncio.ensure_future(discovery.lookup(proxy))
+        while not discovery._sources:
+            await asyncio.sleep(0.01)
+        discovery.close()
+        with pytest.raises(asyncio.CancelledError):
+            await lookup
+        assert not discovery._sources and discovery._controller is None
+        await stop(control, socks, tor)
+
+    run(main())
@@ -0,0 +1,70 @@
+import hashlib
+import shutil
+
+import pytest
+
+from aionion.installer import InstallError
+from aionion.installer import TorInstaller
+from benchmarks.bench_install import make_release
+
+VERSION = "13.5.1"
+NAME = "tor-expert-bundle-linux-x86_64-%s.tar.gz" % VERSION
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    """
+    a local directory laid out like dist.torproject.org/torbrowser, with an older release
+    """
+    path = tmp_path / "mirror"
+    make_release(path, "13.0.9", 1024)
+    make_release(path, VERSION, 1024)
+    return path
+
+
+def test_install_from_a_local_mirror(mirror, tmp_path):
+    installer = TorInstaller(cache_dir=tmp_path / "cache", mirror=mirror)
+    executable = installer.install(tmp_path / "out")
+    assert executable == tmp_path / "out" / "tor" / "tor"
+    assert executable.read_bytes().startswith(b"#!/bin/sh")
+    assert (tmp_path / "out" / "data" / "geoip").read_bytes() == b"geoip"
+    assert installer.downloaded == (mirror / VERSION / NAME).stat().st_size
+    # only the archive of the newest release is kept, by its checksum
+    digest = hashlib.sha256((mirror / VERSION / NAME).read_bytes()).hexdigest()
+    assert [p.name for p in installer.archives.iterdir()] == [digest + ".tar.gz"]
+
+
+def test_cached_reinstall_downloads_nothing(mirror, tmp_path):
+    TorInstaller(cache_dir=tmp_path / "cache", mirror=mirror).install(tmp_path / "a")
+    # neither the index nor the archive is read again
+    shutil.rmtree(mirror)
+    installer = TorInstaller(cache_dir=tmp_path / "cache", mirror=mirror)
+    executable = installer.install(tmp_path / "b")
+    assert executable.exists()
+    assert installer.downloaded == 0
+
+
+def test_checksum_mismatch_installs_nothing(mirror, tmp_path):
+    (mirror / VERSION / "sha256sums-signed-build.txt").write_text(
+        "%s  %s\n" % ("0" * 64, NAME)
+    )
+    installer = TorInstaller(cache_dir=tmp_path / "cache", mirror=mirror)
+    with pytest.raises(InstallError, match="does not match its checksum"):
+        installer.install(tmp_path / "out")
+    assert not (tmp_path / "out").exists()
+    # the partial download is removed and nothing is cached
+    assert not list(installer.archives.iterdir())
+
+
+def test_local_archive_is_verified(mirror, tmp_path):
+    installer = TorInstaller(cache_dir=tmp_path / "cache")
+    archive = mirror / VERSION / NAME
+    with pytest.raises(InstallError):
+        installer.install(tmp_path / "out", archive=archive, sha256="0" * 64)
+    # the checksums file next to the archive
+    assert installer.install(tmp_path / "out", archive=archive).exists()
+
+    unpublished = tmp_path / NAME
+    shutil.copy(archive, unpublished)
+    with pytest.raises(InstallError, match="no checksum"):
+        installer.install(tmp_path / "out", archive=unpublished)